@@ -0,0 +1,201 @@
+import threading
+
+import numpy as np
+import pandas as pd
+import requests
+
+from build_dataset import openmeteo
+from solar_common import elevation_grid, features
+
+
+# Synthetic systems and their payloads. Everything is seeded, so the same scale always gives the same data.
+START_DATE = pd.Timestamp("2023-01-01")
+UK_LATITUDES = (50.0, 56.0)
+UK_LONGITUDES = (-5.0, 1.0)
+# Share of values that are missing, like the gaps cleaning has to deal with in real data.
+MISSING_RATE = 0.01
+
+
+def make_systems(n_systems, n_days, start_date=START_DATE, seed=0):
+    """
+    Makes a table of PV systems in the UK, in the format of systems.csv.
+
+    Parameters:
+        n_systems (int): Number of systems.
+        n_days (int): Days of output for each system, from start_date.
+        start_date (pd.Timestamp): First day of output.
+        seed (int): Random seed.
+
+    Returns:
+        pd.DataFrame: One row per system.
+    """
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "System ID": np.arange(1000, 1000 + n_systems),
+        "System Size": rng.integers(1000, 8000, n_systems),
+        "Latitude": rng.uniform(*UK_LATITUDES, n_systems).round(4),
+        "Longitude": rng.uniform(*UK_LONGITUDES, n_systems).round(4),
+        "Elevation (m)": rng.uniform(0, 300, n_systems).round(1),
+        "Earliest Output Date": start_date,
+        "Latest Output Date": start_date + pd.Timedelta(days=n_days - 1)
+    })
+
+
+def output_body(sid, date_from, date_to, system_size):
+    # A getoutput.jsp body for one window: outputs newest first, separated by ";", with all 15 fields.
+    dates = pd.date_range(date_from, date_to)[::-1]
+    rng = np.random.default_rng([sid, date_from.toordinal()])
+    season = 1 - np.cos(2 * np.pi * (dates.dayofyear.to_numpy() - 172) / 365)
+    efficiency = (rng.uniform(0.2, 1.0, len(dates)) * (6 - 2.5 * season)).round(3)
+    efficiency[rng.random(len(dates)) < MISSING_RATE] = 0
+    energy = (efficiency * system_size).astype(np.int64)
+    return ";".join(
+        f"{date:%Y%m%d},{wh},{eff},0,0,{wh // 4},12:30,Fine,4.0,12.0,,,,,{wh * 2}"
+        for date, wh, eff in zip(dates, energy, efficiency)
+    ).encode()
+
+
+def make_response(body, status_code=200):
+    # A requests.Response holding body, which works with response.text, response.json() and iter_content().
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = body
+    response._content_consumed = True
+    response.encoding = "utf-8"
+    return response
+
+
+class PVOutputSession:
+    """
+    Stands in for the requests session in build_dataset.pvoutput, answering getstatistic.jsp and
+    getoutput.jsp from synthetic data instead of the API. Bodies are generated once and then reused.
+
+    Parameters:
+        systems (pd.DataFrame): Systems from make_systems().
+    """
+
+    def __init__(self, systems):
+        self.systems = systems.set_index("System ID")
+        self.bodies = {}
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def get(self, url, params=None, **kwargs):
+        with self.lock:
+            self.calls += 1
+        sid = int(params["sid1"])
+        system = self.systems.loc[sid]
+        service = url.rsplit("/", 1)[-1]
+        if service == "getstatistic.jsp":
+            start, end = system["Earliest Output Date"], system["Latest Output Date"]
+            return make_response(f"5000000,0,8000,0,30000,2.500,1000,{start:%Y%m%d},{end:%Y%m%d},6.100,"
+                                 f"{end:%Y%m%d}".encode())
+        if service == "getoutput.jsp":
+            key = (sid, params["df"], params["dt"])
+            if key not in self.bodies:
+                self.bodies[key] = output_body(sid, pd.Timestamp(params["df"]), pd.Timestamp(params["dt"]),
+                                               int(system["System Size"]))
+            return make_response(self.bodies[key])
+        return make_response(b"Bad request 400: Unknown service", 400)
+
+
+def write_elevation_grid(filepath, resolution=0.05):
+    # A coarse synthetic elevation grid over the UK, for the webapp's elevation lookups.
+    min_lat, max_lat, min_lon, max_lon = elevation_grid.UK_BOUNDS
+    lats = min_lat + np.arange(int(round((max_lat - min_lat) / resolution)) + 1) * resolution
+    n_cols = int(round((max_lon - min_lon) / resolution)) + 1
+    grid = np.repeat((50 + np.abs(lats * 7) % 200)[:, None], n_cols, axis=1)
+    return elevation_grid.save_grid(filepath, grid, elevation_grid.UK_BOUNDS, resolution)
+
+
+class _Variable:
+    def __init__(self, values):
+        self.values = values
+
+    def ValuesAsNumpy(self):
+        return self.values
+
+
+class _Daily:
+    def __init__(self, start, n_days, variables):
+        self.start = start
+        self.n_days = n_days
+        self.variables = variables
+
+    def Time(self):
+        return self.start
+
+    def TimeEnd(self):
+        return self.start + self.n_days * 86400
+
+    def Interval(self):
+        return 86400
+
+    def Variables(self, index):
+        return _Variable(self.variables[index])
+
+
+class _Response:
+    def __init__(self, latitude, longitude, daily):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.daily = daily
+
+    def Latitude(self):
+        return self.latitude
+
+    def Longitude(self):
+        return self.longitude
+
+    def Daily(self):
+        return self.daily
+
+
+def daily_values(names, n_days, rng):
+    # float32 arrays like the ones openmeteo_requests decodes (see features.WEATHER_RANGES), with MISSING_RATE of
+    # them NaN.
+    values = []
+    for name in names:
+        column = features.synthetic_weather(n_days, rng, [name])[name].astype(np.float32)
+        column[rng.random(n_days) < MISSING_RATE] = np.nan
+        values.append(column)
+    return values
+
+
+class OpenMeteoClient:
+    """
+    Stands in for openmeteo_requests.Client. Requests with start_date and end_date get daily history
+    for those dates, and requests without get a forecast for forecast_days from today.
+
+    Parameters:
+        forecast_days (int): Days in a forecast. Default is 7, like the API.
+    """
+
+    def __init__(self, forecast_days=7):
+        self.forecast_days = forecast_days
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def weather_api(self, url, params, **kwargs):
+        with self.lock:
+            self.calls += 1
+        latitudes = np.atleast_1d(params["latitude"])
+        longitudes = np.atleast_1d(params["longitude"])
+        if "start_date" in params:
+            start = pd.Timestamp(params["start_date"])
+            n_days = (pd.Timestamp(params["end_date"]) - start).days + 1
+        else:
+            start = pd.Timestamp.now().normalize()
+            n_days = self.forecast_days
+        responses = []
+        for latitude, longitude in zip(latitudes, longitudes):
+            rng = np.random.default_rng([int(abs(latitude) * 1e4), int(abs(longitude) * 1e4), start.toordinal()])
+            daily = _Daily(int(start.timestamp()), n_days, daily_values(params["daily"], n_days, rng))
+            responses.append(_Response(float(latitude), float(longitude), daily))
+        return responses
+
+
+def unlimited_rate_limiter():
+    # The real limits would make the benchmark measure sleeping rather than frame building.
+    return openmeteo.make_rate_limiter(requests_per_minute=10 ** 9, weight_per_minute=10 ** 12,
+                                       weight_per_day=10 ** 15)
@@ -0,0 +1,304 @@
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from build_dataset import combine_data, data_cleaning, openmeteo, pvoutput
+from solar_common import features
+from benchmarks import payloads
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+# Stages slower (or using more memory) than the baseline by more than this fraction are regressions.
+DEFAULT_THRESHOLD = 0.15
+# Differences smaller than these are noise, whatever the fraction.
+MIN_SECONDS = 0.005
+MIN_MIB = 1.0
+# Distinct sites requested from /predict in each run.
+PREDICT_SITES = 20
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    # Versions and hardware that results depend on, so runs from different machines are not compared by accident.
+    import sklearn
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "sklearn": sklearn.__version__
+    }
+
+
+def measure(func, repeats):
+    """
+    Times a stage and measures its peak memory. The first call is a warm-up and is not timed. Peak
+    memory is measured in a separate call, because tracemalloc slows down allocation-heavy code.
+
+    Parameters:
+        func (callable): The stage. Returns the number of rows it processed.
+        repeats (int): Number of timed calls.
+
+    Returns:
+        dict: Rows, each call's time, the min and median times, rows per second and peak memory.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = func()
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {
+        "rows": rows,
+        "times_s": [round(t, 6) for t in times],
+        "min_s": round(min(times), 6),
+        "median_s": round(statistics.median(times), 6),
+        "rows_per_s": round(rows / min(times), 1) if min(times) > 0 else None,
+        "peak_mib": round(peak / 1048576, 3)
+    }
+
+
+def train_model(cleaned, filepath, n_estimators):
+    # A small forest with the real model's features, for the model load and /predict stages.
+    from sklearn.ensemble import RandomForestRegressor
+    import joblib
+
+    data = data_cleaning.weather_code_to_category(cleaned)
+    feature_names = [column for column in data.columns
+                     if column not in ("System ID", "Date", "Efficiency (kWh/kW)")]
+    rf = RandomForestRegressor(n_estimators=n_estimators, max_depth=12, random_state=0, n_jobs=-1)
+    rf.fit(data[feature_names], data["Efficiency (kWh/kW)"])
+    joblib.dump(rf, filepath, compress=3)
+    return filepath
+
+
+def pipeline_stages(n_systems, n_days, workdir):
+    # Returns the data pipeline stages as (name, function) pairs, and the cleaned dataset for the model.
+    systems = payloads.make_systems(n_systems, n_days)
+    session = payloads.PVOutputSession(systems)
+    client = payloads.OpenMeteoClient()
+    start_date = systems["Earliest Output Date"].iloc[0]
+    end_date = systems["Latest Output Date"].iloc[0]
+    query = systems[["System ID", "Latitude", "Longitude", "Earliest Output Date", "Latest Output Date"]]
+    dataset_path = os.path.join(workdir, "dataset.csv")
+
+    def parse_outputs():
+        dfs = [pvoutput.get_output_from_id(sid, start_date, end_date, session=session)
+               for sid in systems["System ID"]]
+        return sum(len(df) for df in dfs)
+
+    def build_weather():
+        df = openmeteo.get_weather_for_locations(query.copy(), save_csv=False, open_meteo=client,
+                                                 limiter=payloads.unlimited_rate_limiter(), grid_resolution=None)
+        return len(df)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        pvoutput_df = pd.concat([pvoutput.get_output_from_id(sid, start_date, end_date, session=session)
+                                 for sid in systems["System ID"]], ignore_index=True)
+        weather_df = openmeteo.get_weather_for_locations(query.copy(), save_csv=False, open_meteo=client,
+                                                         limiter=payloads.unlimited_rate_limiter(),
+                                                         grid_resolution=None)
+        dataset = combine_data.combine_weather_and_pvoutput(weather_df, pvoutput_df, dataset_path, overwrite=True,
+                                                            system_df=systems)
+        cleaned = data_cleaning.clean_dataset(dataset)
+    feature_names = [column for column in cleaned.columns
+                     if column not in ("System ID", "Date", "Efficiency (kWh/kW)", "weather_code")]
+    feature_names += features.WEATHER_DUMMIES
+
+    def combine():
+        return len(combine_data.combine_weather_and_pvoutput(weather_df, pvoutput_df, dataset_path, overwrite=True,
+                                                             system_df=systems))
+
+    stages = [
+        ("pvoutput_parse", parse_outputs),
+        ("weather_frames", build_weather),
+        ("combine", combine),
+        ("clean_dataset", lambda: len(data_cleaning.clean_dataset(dataset))),
+        ("weather_code_to_category", lambda: len(data_cleaning.weather_code_to_category(cleaned))),
+        ("build_matrix", lambda: len(features.build_matrix(cleaned, feature_names)[0]))
+    ]
+    return stages, cleaned
+
+
+def serving_stages(model_path, workdir):
+    """
+    Returns the model load and /predict stages. The webapp is imported from workdir with the model at
+    model_path, and its upstream clients are swapped for the stubs in payloads.
+    """
+    webapp_dir = os.path.join(REPO_ROOT, "webapp")
+    if webapp_dir not in sys.path:
+        sys.path.insert(0, webapp_dir)
+    import model_loading
+
+    app_model = os.path.join(workdir, "rf_100_v1.pkl")
+    if os.path.abspath(model_path) != app_model:
+        if os.path.exists(app_model):
+            os.remove(app_model)
+        os.symlink(os.path.abspath(model_path), app_model)
+    # The caches must start empty and stay in this process, so that cold requests go to the stubbed upstream.
+    os.environ.pop("CACHE_DIR", None)
+    os.environ["ELEVATION_GRID"] = payloads.write_elevation_grid(os.path.join(workdir, "uk_elevation.npy"))
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            import app as webapp
+    finally:
+        os.chdir(cwd)
+    webapp.open_meteo = payloads.OpenMeteoClient()
+    client = webapp.app.test_client()
+    rng = np.random.default_rng(1)
+    sites = [{"latitude": round(float(lat), 4), "longitude": round(float(lon), 4), "power_rating": 4}
+             for lat, lon in zip(rng.uniform(*payloads.UK_LATITUDES, PREDICT_SITES),
+                                 rng.uniform(*payloads.UK_LONGITUDES, PREDICT_SITES))]
+
+    def predict(cold):
+        def run():
+            if cold:
+                webapp.forecast_cache.clear()
+            for site in sites:
+                response = client.post("/predict", json=site)
+                if response.status_code != 200:
+                    raise RuntimeError(f"/predict returned {response.status_code}: {response.get_data(as_text=True)}")
+            return len(sites)
+        return run
+
+    def load(loader, **kwargs):
+        def run():
+            loader(app_model, **kwargs)
+            return 1
+        return run
+
+    return [
+        ("model_load_joblib", load(model_loading.load_model)),
+        ("model_load_compact", load(model_loading.load_compact_model, mmap=True)),
+        ("predict_cold", predict(cold=True)),
+        ("predict_cached", predict(cold=False))
+    ]
+
+
+def run_benchmarks(n_systems=20, n_days=365, repeats=3, model_path=None, n_estimators=20):
+    """
+    Runs every stage on synthetic data of n_systems systems with n_days of history each.
+
+    Parameters:
+        n_systems (int): Number of PV systems.
+        n_days (int): Days of history per system.
+        repeats (int): Timed calls per stage.
+        model_path (str): Model for the load and /predict stages. Default is a small forest trained
+            on the synthetic dataset with n_estimators trees.
+        n_estimators (int): Trees in the default model.
+
+    Returns:
+        dict: Environment, scale and the results of each stage, ready to be saved as JSON.
+    """
+    results = {
+        "environment": environment(),
+        "scale": {"systems": n_systems, "days": n_days, "repeats": repeats},
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "stages": {}
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        stages, cleaned = pipeline_stages(n_systems, n_days, workdir)
+        if model_path is None:
+            model_path = train_model(cleaned, os.path.join(workdir, "rf_100_v1.pkl"), n_estimators)
+            results["scale"]["n_estimators"] = n_estimators
+        else:
+            results["scale"]["model"] = os.path.basename(model_path)
+        stages += serving_stages(model_path, workdir)
+
+        for name, func in stages:
+            result = measure(func, repeats)
+            results["stages"][name] = result
+            print(f"{name:<26} {result['rows']:>9} rows  min {result['min_s'] * 1000:>9.2f} ms  "
+                  f"median {result['median_s'] * 1000:>9.2f} ms  peak {result['peak_mib']:>8.2f} MiB")
+    return results
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """
+    Compares two sets of results stage by stage.
+
+    Parameters:
+        baseline (dict): Results from run_benchmarks(), e.g. from the main branch.
+        current (dict): Results to check.
+        threshold (float): Allowed fractional increase in median time and peak memory.
+
+    Returns:
+        list: (stage, metric, baseline value, current value) for each regression.
+    """
+    if baseline["scale"] != current["scale"]:
+        print(f"WARNING: Different scales, {baseline['scale']} and {current['scale']}.")
+    for key in ("cpus", "platform"):
+        if baseline["environment"].get(key) != current["environment"].get(key):
+            print(f"WARNING: Different {key}, {baseline['environment'].get(key)} and {current['environment'].get(key)}.")
+
+    regressions = []
+    for name, result in current["stages"].items():
+        if name not in baseline["stages"]:
+            print(f"{name:<26} new stage")
+            continue
+        before = baseline["stages"][name]
+        changes = []
+        for metric, noise in (("median_s", MIN_SECONDS), ("peak_mib", MIN_MIB)):
+            old, new = before[metric], result[metric]
+            change = (new - old) / old if old else 0.0
+            changes.append(f"{metric} {old:.4g} -> {new:.4g} ({change:+.0%})")
+            if change > threshold and new - old > noise:
+                regressions.append((name, metric, old, new))
+        flag = "REGRESSION" if any(regression[0] == name for regression in regressions) else ""
+        print(f"{name:<26} {'  '.join(changes)}  {flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    # Usage: python -m benchmarks.run [n_systems=20] [n_days=365] [results.json] [repeats=3] [model.pkl]
+    #        python -m benchmarks.run compare baseline.json results.json [threshold=0.15]
+    # Run from the root of the repository. compare exits with status 1 if any stage regressed.
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        with open(sys.argv[2]) as f:
+            baseline = json.load(f)
+        with open(sys.argv[3]) as f:
+            current = json.load(f)
+        threshold = float(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_THRESHOLD
+        regressions = compare(baseline, current, threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {threshold:.0%}.")
+            sys.exit(1)
+        print("No regressions.")
+    else:
+        n_systems = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+        n_days = int(sys.argv[2]) if len(sys.argv) > 2 else 365
+        commit = git_commit()
+        output = sys.argv[3] if len(sys.argv) > 3 else f"benchmark_{commit[:8] if commit else 'results'}.json"
+        repeats = int(sys.argv[4]) if len(sys.argv) > 4 else 3
+        model_path = sys.argv[5] if len(sys.argv) > 5 else None
+
+        results = run_benchmarks(n_systems, n_days, repeats, model_path)
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results to {output}")
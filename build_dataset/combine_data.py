@@ -1,22 +1,32 @@
+import os
+import tempfile
+import time
+
+import numpy as np
 import pandas as pd
 
-from . import utils
+from . import schema, storage, utils
+
+# The only PVOutput columns kept in the dataset. Parquet inputs are read with just these columns.
+PVOUTPUT_COLUMNS = ["System ID", "Date", "Efficiency (kWh/kW)"]
 
 
-def combine_weather_and_pvoutput(weather_df, pvoutput_df, filepath):
+def combine_weather_and_pvoutput(weather_df, pvoutput_df, filepath, overwrite=False, file_format="csv", by_month=False,
+                                 system_df=None):
+    # If system_df has an "Elevation (m)" column, it is added to the dataset for each System ID.
     if weather_df is None:
         print("No weather data.")
         return
-    if isinstance(weather_df, str):
-        weather_df = pd.read_csv(weather_df, parse_dates=["date"])
-    if isinstance(pvoutput_df, str):
-        with open(pvoutput_df, "r") as file:
-            split_idx = next((idx for idx, line in enumerate(file) if line.strip("\n,") == ""), 0)
-        pvoutput_df = pd.read_csv(
-            pvoutput_df,
-            parse_dates=["Date"],
-            header=split_idx
-        )
+    if isinstance(weather_df, str) and storage.is_parquet_path(weather_df):
+        weather_df = storage.read_parquet(weather_df)
+    elif isinstance(weather_df, str):
+        weather_df = schema.read_csv(weather_df, "weather")
+    if isinstance(pvoutput_df, str) and storage.is_parquet_path(pvoutput_df):
+        pvoutput_df = storage.read_parquet(pvoutput_df, columns=PVOUTPUT_COLUMNS)
+    elif isinstance(pvoutput_df, str):
+        pvoutput_df = schema.read_csv(pvoutput_df, "pvoutput", header=output_header_row(pvoutput_df))
+    weather_df = schema.enforce(weather_df, "weather")
+    pvoutput_df = schema.enforce(pvoutput_df, "pvoutput")
 
     dataset = pd.merge(pvoutput_df, weather_df, left_on=["System ID", "Date"], right_on=["id", "date"], how="inner")
     dataset.drop(columns=['Energy Generated (Wh)',
@@ -24,8 +34,145 @@ def combine_weather_and_pvoutput(weather_df, pvoutput_df, filepath):
                           'Peak Time', 'Condition', 'Min Temp (°C)', 'Max Temp (°C)',
                           'Peak Energy Import (Wh)', 'Off Peak Energy Import (Wh)',
                           'Shoulder Energy Import (Wh)', 'High Shoulder Energy Import (Wh)',
-                          'Insolation (Wh)', 'id', 'date'], inplace=True)
+                          'Insolation (Wh)', 'id', 'date'], inplace=True, errors="ignore")
+    if system_df is not None and "Elevation (m)" in system_df:
+        elevations = dict(zip(system_df["System ID"], system_df["Elevation (m)"]))
+        dataset["Elevation (m)"] = dataset["System ID"].map(elevations)
+    dataset = schema.validate(schema.enforce(dataset, "dataset"), "dataset")
 
-    final_path = utils.safe_to_csv(dataset, filepath, index=False)
-    print(f"Saved CSV to {final_path}")
+    partition_col, date_col = storage.PARTITIONS["dataset"]
+    final_path = utils.safe_save(dataset, filepath, file_format=file_format, overwrite=overwrite,
+                                 partition_col=partition_col, date_col=date_col, by_month=by_month, index=False)
+    print(f"Saved {file_format} to {final_path}")
     return dataset
+
+
+def output_header_row(filepath):
+    # PVOutput data appended to a system info CSV (see pvoutput.append_output_data_to_file) starts after a blank line.
+    with open(filepath, "r") as file:
+        return next((idx for idx, line in enumerate(file) if line.strip("\n,") == ""), 0)
+
+
+def split_by_system(source, id_col, date_col, columns=None, spill_dir=None, chunksize=200000):
+    """
+    Gives access to the rows of one system at a time, without loading the whole source.
+
+    Parquet datasets partitioned by system (see storage.PARTITIONS) are read one partition directory at a time.
+    CSV files are first split by system into pickles in spill_dir, chunksize rows at a time.
+
+    Returns:
+        tuple: (sorted list of system IDs, function that returns the DataFrame for a system ID)
+    """
+    if storage.is_parquet_path(source):
+        ids = [pd.to_numeric(value) for value in storage.partition_values(source, id_col)]
+        if ids:
+            return sorted(ids), lambda sid: storage.read_partition(source, id_col, sid, columns)
+        # Not partitioned by system, so filter the row groups instead.
+        ids = storage.read_parquet(source, columns=[id_col])[id_col].unique().tolist()
+        return sorted(ids), lambda sid: storage.read_parquet(source, columns=columns, filters=[(id_col, "=", sid)])
+
+    paths = {}
+    header = output_header_row(source) if id_col == "System ID" else 0
+    table = "pvoutput" if id_col == "System ID" else "weather"
+    chunks = schema.read_csv(source, table, usecols=columns, header=header, chunksize=chunksize)
+    for chunk_no, chunk in enumerate(chunks):
+        for sid, group in chunk.groupby(id_col, sort=False):
+            path = os.path.join(spill_dir, f"{sid}-{chunk_no}.pkl")
+            group.to_pickle(path)
+            paths.setdefault(sid, []).append(path)
+    return sorted(paths), lambda sid: pd.concat([pd.read_pickle(path) for path in paths[sid]], ignore_index=True)
+
+
+def join_system(pvoutput_df, weather_df):
+    # Joins the data of one system on date, using sorted date indexes on both sides.
+    # Re-fetched windows can appear more than once, so the newest copy of each day is kept.
+    pvoutput_df = pvoutput_df.drop_duplicates(subset="Date", keep="last").set_index("Date").sort_index()
+    weather_df = weather_df.drop_duplicates(subset="date", keep="last").drop(columns="id").set_index("date").sort_index()
+    joined = pvoutput_df.join(weather_df, how="inner")
+    joined.index.name = "Date"
+    joined = joined.reset_index()
+    return joined[["System ID", "Date"] + [col for col in joined.columns if col not in ("System ID", "Date")]]
+
+
+def combine_by_system(weather_source, pvoutput_source, filepath, overwrite=False, file_format="csv", by_month=False,
+                      system_df=None, chunksize=200000):
+    """
+    Out-of-core version of combine_weather_and_pvoutput, for data that does not fit in memory.
+
+    Joins one System ID at a time and streams the joined systems to the output, so only one system's
+    inputs and about chunksize joined rows are held at once. Prints the number of rows, rows per second
+    and the peak memory of the process.
+
+    Parameters:
+        weather_source (str): Path of the weather data, CSV or Parquet.
+        pvoutput_source (str): Path of the PVOutput data, CSV or Parquet.
+        filepath (str): Path to save the dataset to.
+        overwrite (bool): Whether to overwrite an existing file. Default is False.
+        file_format (str): "csv" or "parquet". Default is "csv".
+        by_month (bool): Parquet only. Whether to also partition by month. Default is False.
+        system_df (pd.DataFrame): If it has an "Elevation (m)" column, it is added for each System ID.
+        chunksize (int): Rows read at a time when splitting CSV sources by system, and rows written at a time.
+
+    Returns:
+        str: The path the dataset was saved to, or None if nothing was joined.
+    """
+    if file_format == "parquet":
+        filepath = os.path.splitext(filepath)[0] + ".parquet"
+    if os.path.exists(filepath) and not overwrite:
+        filepath = utils.unique_path(filepath)
+    elevations = {}
+    if system_df is not None and "Elevation (m)" in system_df:
+        elevations = dict(zip(system_df["System ID"], system_df["Elevation (m)"]))
+    partition_col, date_col = storage.PARTITIONS["dataset"]
+
+    start = time.time()
+    n_rows = 0
+    columns = None
+    pending = []
+
+    def write_pending():
+        # Joined systems are written in batches of about chunksize rows, which is much faster than one write each.
+        nonlocal columns, n_rows
+        batch = schema.validate(schema.enforce(pd.concat(pending, ignore_index=True), "dataset"), "dataset")
+        pending.clear()
+        first = columns is None
+        if first:
+            columns = list(batch.columns)
+        if file_format == "parquet":
+            storage.write_parquet(batch[columns], filepath, partition_col=partition_col, date_col=date_col,
+                                  by_month=by_month, mode="w" if first else "a")
+        else:
+            batch[columns].to_csv(filepath, mode="w" if first else "a", header=first, index=False)
+        n_rows += len(batch)
+
+    directory = os.path.dirname(filepath) or "."
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=directory) as spill_dir:
+        os.makedirs(os.path.join(spill_dir, "pvoutput"))
+        os.makedirs(os.path.join(spill_dir, "weather"))
+        pvoutput_ids, read_pvoutput = split_by_system(pvoutput_source, "System ID", "Date", PVOUTPUT_COLUMNS,
+                                                      os.path.join(spill_dir, "pvoutput"), chunksize)
+        weather_ids, read_weather = split_by_system(weather_source, "id", "date", None,
+                                                    os.path.join(spill_dir, "weather"), chunksize)
+        print(f"Splitting by system took {time.time() - start:.1f}s.")
+
+        for sid in sorted(set(pvoutput_ids) & set(weather_ids)):
+            joined = join_system(read_pvoutput(sid), read_weather(sid))
+            if joined.empty:
+                continue
+            if elevations:
+                joined["Elevation (m)"] = elevations.get(sid, np.nan)
+            pending.append(joined)
+            if sum(len(df) for df in pending) >= chunksize:
+                write_pending()
+        if pending:
+            write_pending()
+
+    elapsed = time.time() - start
+    if columns is None:
+        print("No systems have both weather and PVOutput data.")
+        return None
+    peak = utils.peak_memory_mib()
+    print(f"Saved {file_format} to {filepath}: {n_rows} rows in {elapsed:.1f}s ({n_rows / elapsed:.0f} rows/s), "
+          f"peak memory {'unknown' if peak is None else f'{peak:.0f} MiB'}.")
+    return filepath
@@ -1,12 +1,18 @@
-import pandas as pd
+from solar_common import features
+
+from . import schema, storage
 
 # These system ids are based on my own exploration of my dataset (see /notebooks/data_cleaning.ipynb)
 SIDS_TO_REMOVE = (3099, 8224, 4113, 32351, 46979, 3641, 6090)
 
 
 def clean_dataset(data):
-    if isinstance(data, str):
-        data = pd.read_csv("data/" + data, parse_dates=["Date"])
+    if isinstance(data, str) and storage.is_parquet_path("data/" + data):
+        data = storage.read_parquet("data/" + data)
+    elif isinstance(data, str):
+        data = schema.read_csv("data/" + data, "dataset")
+    # Cleaning makes several copies, so it runs on the compact dtypes (see schema.SCHEMAS).
+    data = schema.enforce(data, "dataset")
 
     # remove NAs
     data = data.dropna().copy()
@@ -27,36 +33,11 @@ def remove_systems(data, sids = SIDS_TO_REMOVE):
 
 
 def weather_code_to_category(data):
-    weather_map = {
-        0: 'clear',
-        1: 'partly_cloudy', 2: 'partly_cloudy',
-        3: 'overcast',
-        45: 'fog', 48: 'fog',
-        51: 'drizzle', 53: 'drizzle', 55: 'drizzle', 56: 'drizzle', 57: 'drizzle',
-        61: 'rain', 63: 'rain', 65: 'rain', 66: 'rain', 67: 'rain',
-        71: 'snow', 73: 'snow', 75: 'snow', 77: 'snow', 85: 'snow', 86: 'snow',
-        80: 'rain_showers', 81: 'rain_showers', 82: 'rain_showers',
-        95: 'thunderstorm', 96: 'thunderstorm', 99: 'thunderstorm'
-    }
-    data['weather_category'] = data['weather_code'].map(weather_map)
-
-    expected_weather_dummies = [
-        'weather_category_clear',
-        'weather_category_partly_cloudy',
-        'weather_category_overcast',
-        'weather_category_fog',
-        'weather_category_drizzle',
-        'weather_category_rain',
-        'weather_category_snow',
-        'weather_category_rain_showers',
-        'weather_category_thunderstorm'
-    ]
-
-    data = pd.get_dummies(data, columns=['weather_category'], drop_first=False)
-    # Add back missing columns
-    for col in expected_weather_dummies:
-        if col not in data.columns:
-            data[col] = False
-    data = data.drop(columns=['weather_code', 'weather_category_clear'])
+    # One boolean column per weather category except "clear", in place of "weather_code".
+    # Uses the same lookup table as features.build_matrix, so training and serving always agree.
+    one_hot = features.ONE_HOT[features.weather_code_rows(data['weather_code'])].astype(bool)
+    data = data.drop(columns=['weather_code'])
+    for col, i in features.DUMMY_INDEX.items():
+        data[col] = one_hot[:, i]
 
     return data
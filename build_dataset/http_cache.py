@@ -0,0 +1,215 @@
+import hashlib
+import json
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+import requests
+from requests.structures import CaseInsensitiveDict
+from solar_common.sqlite_store import SQLiteStore
+
+
+# Params that identify the caller rather than the data. They are left out of cache keys so that
+# cached responses can be shared, and so that they are never written to disk.
+CREDENTIAL_PARAMS = ("key", "sid", "apikey")
+# Data for days older than this is treated as final and cached forever.
+STALE_DAYS = 2
+RECENT_TTL = 3600
+INFO_TTL = 6 * 3600
+
+_default_cache = None
+
+
+class CacheMissError(RuntimeError):
+    pass
+
+
+class ResponseCache(SQLiteStore):
+    """
+    On-disk cache of HTTP responses.
+
+    Parameters:
+        filepath (str): Path to the SQLite file.
+        max_bytes (int): Size cap for the cached bodies. Least recently used entries are evicted beyond it.
+        replay_only (bool): Serve everything from the cache, ignoring TTLs, and raise CacheMissError instead of
+            going to the network, for tests and benchmarks.
+    """
+
+    def __init__(self, filepath="data/http_cache.sqlite", max_bytes=2 * 1024 ** 3, replay_only=False):
+        super().__init__(filepath, (
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, url TEXT, status INTEGER, headers TEXT, body BLOB, "
+            "size INTEGER, expires REAL, last_access REAL)",
+            "CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_access)"
+        ))
+        self.max_bytes = max_bytes
+        self.replay_only = replay_only
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(url, params):
+        params = {k: v for k, v in (params or {}).items() if k not in CREDENTIAL_PARAMS}
+        normalised = json.dumps([url, sorted((k, str(v)) for k, v in params.items())])
+        return hashlib.sha256(normalised.encode()).hexdigest()
+
+    def get(self, url, params):
+        key = self.make_key(url, params)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT status, headers, body, expires FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (not self.replay_only and row[3] is not None and row[3] < time.time()):
+                self.misses += 1
+                return None
+            self.connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.connection.commit()
+            self.hits += 1
+
+        status, headers, body, _ = row
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(json.loads(headers))
+        response._content = body
+        response._content_consumed = True  # So iter_content() and close() work without a connection.
+        response.url = url
+        response.encoding = "utf-8"
+        return response
+
+    def put(self, url, params, response, ttl=None, body=None):
+        # ttl is in seconds. None keeps the response forever. body is the response's body if it has already
+        # been read from a stream, otherwise response.content.
+        key = self.make_key(url, params)
+        if body is None:
+            body = response.content
+        expires = None if ttl is None else time.time() + ttl
+        with self.lock:
+            old = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self.total_bytes -= old[0]
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, url.split("?")[0], response.status_code, json.dumps(dict(response.headers)), body, len(body),
+                 expires, time.time())
+            )
+            self.total_bytes += len(body)
+            self._evict()
+            self.connection.commit()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            rows = self.connection.execute(
+                "SELECT key, size FROM responses ORDER BY last_access LIMIT 100"
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+
+def default_ttl(url, params):
+    """
+    How long to keep a response, in seconds. None means forever, 0 means do not cache.
+    Historical windows that end before the last few days never change, so they are kept forever.
+    """
+    params = params or {}
+    oldest_final_day = datetime.now().date() - timedelta(days=STALE_DAYS)
+    if "end_date" in params:  # Open-Meteo
+        end_date = pd.Timestamp(params["end_date"]).date()
+        return None if end_date < oldest_final_day else RECENT_TTL
+    if "dt" in params:  # PVOutput getoutput.jsp
+        end_date = pd.to_datetime(params["dt"], format="%Y%m%d").date()
+        return None if end_date < oldest_final_day else RECENT_TTL
+    if "pvoutput.org" in url:
+        return INFO_TTL
+    # Forecasts and anything else
+    return RECENT_TTL
+
+
+class CachedSession(requests.Session):
+    """
+    A requests.Session that answers GET requests from a ResponseCache when it can.
+
+    Parameters:
+        cache (ResponseCache): The cache to use. Default is the cache set with enable(), or no caching.
+        ttl (callable): Function of (url, params) giving the TTL of a response. Default is default_ttl.
+    """
+
+    def __init__(self, cache=None, ttl=default_ttl):
+        super().__init__()
+        self.cache = cache
+        self.ttl = ttl
+
+    def cached_response(self, url, params=None):
+        # Lets callers skip rate limiting for requests that will not reach the network.
+        cache = self.cache or _default_cache
+        if cache is None:
+            return None
+        return cache.get(url, dict(params or {}))
+
+    def request(self, method, url, params=None, **kwargs):
+        cache = self.cache or _default_cache
+        if cache is None or method.upper() != "GET":
+            return super().request(method, url, params=params, **kwargs)
+
+        params = dict(params or {})
+        response = cache.get(url, params)
+        if response is not None:
+            return response
+        if cache.replay_only:
+            raise CacheMissError(f"No cached response for {url} with params "
+                                 f"{ {k: v for k, v in params.items() if k not in CREDENTIAL_PARAMS} }")
+
+        response = super().request(method, url, params=params, **kwargs)
+        ttl = self.ttl(url, params)
+        if response.status_code != 200 or ttl == 0:
+            return response
+        if kwargs.get("stream"):
+            # Reading response.content here would download the whole body before a streaming parser
+            # sees any of it, so the body is cached once the caller has read it all.
+            response.iter_content = self._caching_iter_content(cache, url, params, response, ttl)
+        elif not response.content.startswith(b"Bad request"):
+            cache.put(url, params, response, ttl)
+        return response
+
+    @staticmethod
+    def _caching_iter_content(cache, url, params, response, ttl):
+        iter_content = response.iter_content
+
+        def caching_iter_content(chunk_size=1, decode_unicode=False):
+            if decode_unicode:
+                yield from iter_content(chunk_size, decode_unicode)
+                return
+            chunks = []
+            for chunk in iter_content(chunk_size):
+                chunks.append(chunk)
+                yield chunk
+            body = b"".join(chunks)
+            # Only cache successful responses. PVOutput reports errors with status 200 and a "Bad request" body.
+            if not body.startswith(b"Bad request"):
+                cache.put(url, params, response, ttl, body=body)
+
+        return caching_iter_content
+
+
+def enable(filepath="data/http_cache.sqlite", max_bytes=2 * 1024 ** 3, replay_only=False):
+    """
+    Turns on caching for every CachedSession that was not given its own cache.
+
+    Returns:
+        ResponseCache: The cache.
+    """
+    global _default_cache
+    _default_cache = ResponseCache(filepath, max_bytes=max_bytes, replay_only=replay_only)
+    return _default_cache
+
+
+def disable():
+    global _default_cache
+    if _default_cache is not None:
+        _default_cache.close()
+    _default_cache = None
@@ -0,0 +1,157 @@
+import os
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from . import combine_data, openmeteo, pvoutput, schema, storage, utils
+from .manifest import FetchManifest
+
+
+def append_to_store(df, filepath, table):
+    # Appends rows to a CSV (writing the header only if the file is new) or adds them to a Parquet dataset.
+    if storage.is_parquet_path(filepath):
+        partition_col, date_col = storage.PARTITIONS[table]
+        storage.write_parquet(df, filepath, partition_col=partition_col, date_col=date_col, mode="a")
+    elif os.path.isfile(filepath):
+        # Match the columns of the existing file, e.g. one written before PVOutput columns were projected.
+        header = pd.read_csv(filepath, nrows=0).columns
+        utils.safe_to_csv(df.reindex(columns=header), filepath, mode="a", header=False, index=False)
+    else:
+        utils.safe_to_csv(df, filepath, mode="a", header=True, index=False)
+
+
+def read_store(filepath, table):
+    # Windows that were re-fetched (stale or interrupted) appear more than once, so keep the newest copy.
+    if not os.path.exists(filepath):
+        return None
+    id_col, date_col = storage.PARTITIONS[table]
+    if storage.is_parquet_path(filepath):
+        df = schema.enforce(storage.read_parquet(filepath), table)
+    else:
+        df = schema.read_csv(filepath, table)
+    return df.drop_duplicates(subset=[id_col, date_col], keep="last").reset_index(drop=True)
+
+
+def missing_work(manifest, system, yesterday=None):
+    """
+    Finds what is missing for one system, from the dates in its system info and the manifest.
+
+    Parameters:
+        manifest (FetchManifest): What has been fetched already.
+        system (dict or pd.Series): Row of the system table, with "System ID", "Earliest Output Date" and
+            "Latest Output Date".
+        yesterday (pd.Timestamp): The last complete day. Default is yesterday.
+
+    Returns:
+        tuple: (PVOutput jobs as (System ID, date_from, date_to), weather ranges as (start, end))
+    """
+    if yesterday is None:
+        yesterday = pd.Timestamp(datetime.now().date() - timedelta(days=1))
+    sid = system["System ID"]
+    start_date = max(system["Earliest Output Date"], openmeteo.OPEN_METEO_START_DATE)
+    end_date = min(system["Latest Output Date"], yesterday)
+    pv_jobs = []
+    for missing_start, missing_end in manifest.missing_ranges("pvoutput", sid, start_date, end_date):
+        pv_jobs += [(sid, date_from, date_to)
+                    for date_from, date_to in pvoutput.get_output_windows(sid, missing_start, missing_end)]
+    return pv_jobs, manifest.missing_ranges("openmeteo", sid, start_date, end_date)
+
+
+def combine_stores(data_dir="data", file_format="csv", system_df=None, out_of_core=False):
+    # Joins everything in the per-source stores of data_dir into dataset.csv (or dataset.parquet).
+    pvoutput_path = os.path.join(data_dir, f"pvoutput.{file_format}")
+    weather_path = os.path.join(data_dir, f"weather.{file_format}")
+    dataset_path = os.path.join(data_dir, f"dataset.{file_format}")
+    if out_of_core:
+        if not (os.path.exists(pvoutput_path) and os.path.exists(weather_path)):
+            print("No PVOutput or weather data.")
+            return
+        return combine_data.combine_by_system(weather_path, pvoutput_path, dataset_path, overwrite=True,
+                                              file_format=file_format, system_df=system_df)
+
+    pvoutput_df = read_store(pvoutput_path, "pvoutput")
+    weather_df = read_store(weather_path, "weather")
+    if pvoutput_df is None:
+        print("No PVOutput data.")
+        return
+    return combine_data.combine_weather_and_pvoutput(weather_df, pvoutput_df, dataset_path, overwrite=True,
+                                                     file_format=file_format, system_df=system_df)
+
+
+def update_dataset(system_ids, data_dir="data", max_workers=4, stale_days=2, file_format="csv", out_of_core=False):
+    """
+    Builds or updates the dataset, only fetching the date ranges that are not already in data_dir.
+
+    Each window is appended to its source's CSV and recorded in the manifest as soon as it arrives,
+    so a build that is interrupted picks up where it stopped when it is run again.
+
+    Parameters:
+        system_ids (list): PVOutput system IDs to include.
+        data_dir (str): Folder for the manifest, the per-source data and the final dataset.
+        max_workers (int): Number of concurrent requests to each API.
+        stale_days (int): Number of most recent days to re-fetch, since they may still change upstream.
+        file_format (str): "csv" or "parquet", for the per-source data and the final dataset.
+        out_of_core (bool): Combine the data one system at a time (see combine_data.combine_by_system), for
+            data that does not fit in memory. Default is False.
+
+    Returns:
+        pd.DataFrame: The combined dataset, also saved as dataset.csv (or dataset.parquet) in data_dir.
+            With out_of_core, the path it was saved to instead.
+    """
+    manifest = FetchManifest(os.path.join(data_dir, "manifest.sqlite"), stale_days=stale_days)
+    systems_path = os.path.join(data_dir, "systems.csv")
+    pvoutput_path = os.path.join(data_dir, f"pvoutput.{file_format}")
+    weather_path = os.path.join(data_dir, f"weather.{file_format}")
+
+    # System info is always refreshed (two calls per system) to find each system's latest output date.
+    session = pvoutput.make_session(max_workers)
+    pacer = pvoutput.QuotaPacer()
+    system_df = pd.DataFrame([pvoutput.get_system_info_from_id(sid, session, pacer) for sid in system_ids])
+    system_df["Elevation (m)"] = pvoutput.get_elevation(system_df["Latitude"], system_df["Longitude"])
+    utils.safe_to_csv(system_df, systems_path, overwrite=True, index=False)
+    print(f"Saved CSV to {systems_path}")
+
+    pv_jobs = []
+    weather_rows = []
+    for _, system in system_df.iterrows():
+        system_jobs, weather_ranges = missing_work(manifest, system)
+        pv_jobs += system_jobs
+        for missing_start, missing_end in weather_ranges:
+            weather_rows.append({
+                "System ID": system["System ID"],
+                "Latitude": system["Latitude"],
+                "Longitude": system["Longitude"],
+                "Earliest Output Date": missing_start,
+                "Latest Output Date": missing_end
+            })
+
+    failed = []
+
+    def save_pv_window(job, df):
+        sid, date_from, date_to = job
+        if isinstance(df, Exception):
+            # Not recorded, so it is fetched again on the next run.
+            print(f"Could not get the output of System ID {sid} {date_from:%Y%m%d}-{date_to:%Y%m%d}: {df}")
+            failed.append(sid)
+            return
+        if df is not None:
+            append_to_store(df, pvoutput_path, "pvoutput")
+        # A window without outputs (df is None) is still recorded, so it is not asked for again.
+        manifest.record("pvoutput", sid, date_from, date_to)
+
+    def save_weather_window(location, df):
+        append_to_store(df, weather_path, "weather")
+        manifest.record("openmeteo", location["id"], location["start_date"], location["end_date"])
+
+    print(f"Fetching {len(pv_jobs)} missing PVOutput windows and {len(weather_rows)} missing weather ranges.")
+    if pv_jobs:
+        pvoutput.fetch_output_windows(pv_jobs, session, pacer, max_workers, callback=save_pv_window,
+                                      return_exceptions=True)
+    if failed:
+        print(f"Some PVOutput windows of System IDs {sorted(set(failed))} could not be fetched. "
+              f"Run again to retry them.")
+    if weather_rows:
+        openmeteo.get_weather_for_locations(pd.DataFrame(weather_rows), save_csv=False, max_workers=max_workers,
+                                            callback=save_weather_window)
+    manifest.close()
+    return combine_stores(data_dir, file_format, system_df, out_of_core)
@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+from solar_common.sqlite_store import SQLiteStore
+
+
+class FetchManifest(SQLiteStore):
+    """
+    Records which (System ID, date range) windows have been fetched from each source, and each system's elevation.
+
+    Parameters:
+        filepath (str): Path to the SQLite file.
+        stale_days (int): The last stale_days days before a fetch may still change upstream, so they are fetched
+            again on the next build.
+    """
+
+    def __init__(self, filepath="data/manifest.sqlite", stale_days=2):
+        super().__init__(filepath, (
+            "CREATE TABLE IF NOT EXISTS fetched ("
+            "source TEXT NOT NULL, system_id INTEGER NOT NULL, "
+            "start_date TEXT NOT NULL, end_date TEXT NOT NULL, fetched_at TEXT NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS fetched_idx ON fetched (source, system_id)",
+            "CREATE TABLE IF NOT EXISTS systems (system_id INTEGER PRIMARY KEY, elevation REAL)"
+        ))
+        self.stale_days = stale_days
+
+    def record(self, source, system_id, start_date, end_date):
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO fetched VALUES (?, ?, ?, ?, ?)",
+                (source, int(system_id), start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"),
+                 datetime.now().strftime("%Y-%m-%d"))
+            )
+            self.connection.commit()
+
+    def fetched_ranges(self, source, system_id):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT start_date, end_date, fetched_at FROM fetched WHERE source = ? AND system_id = ?",
+                (source, int(system_id))
+            ).fetchall()
+        ranges = []
+        for start_date, end_date, fetched_at in rows:
+            # Only trust the part of the window that was old enough not to change any more.
+            end_date = min(pd.Timestamp(end_date), pd.Timestamp(fetched_at) - timedelta(days=self.stale_days))
+            if pd.Timestamp(start_date) <= end_date:
+                ranges.append((pd.Timestamp(start_date), end_date))
+        return sorted(ranges)
+
+    def missing_ranges(self, source, system_id, start_date, end_date):
+        # The parts of [start_date, end_date] (inclusive) that have not been fetched, as (start, end) tuples.
+        missing = []
+        current = pd.Timestamp(start_date)
+        end_date = pd.Timestamp(end_date)
+        for fetched_start, fetched_end in self.fetched_ranges(source, system_id):
+            if current > end_date:
+                break
+            if fetched_end < current:
+                continue
+            if fetched_start > current:
+                missing.append((current, min(fetched_start - timedelta(days=1), end_date)))
+            current = max(current, fetched_end + timedelta(days=1))
+        if current <= end_date:
+            missing.append((current, end_date))
+        return missing
+
+    def record_system(self, system_id, elevation):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO systems VALUES (?, ?)", (int(system_id), float(elevation)))
+            self.connection.commit()
+
+    def collected_systems(self):
+        # {System ID: elevation} of every system with fetched data. The elevation is None if it was never recorded.
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT DISTINCT fetched.system_id, systems.elevation FROM fetched "
+                "LEFT JOIN systems ON systems.system_id = fetched.system_id"
+            ).fetchall()
+        return dict(rows)
+
+    def forget_system(self, system_id):
+        # The system is no longer collected, so it is left out of later builds until it is asked for again.
+        with self.lock:
+            self.connection.execute("DELETE FROM fetched WHERE system_id = ?", (int(system_id),))
+            self.connection.execute("DELETE FROM systems WHERE system_id = ?", (int(system_id),))
+            self.connection.commit()
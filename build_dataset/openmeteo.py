@@ -1,12 +1,14 @@
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import numpy as np
 import pandas as pd
 import openmeteo_requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-import requests
 
-from . import utils
+from . import http_cache, schema, spatial, storage, utils
+from .rate_limit import RateLimiter, TokenBucket, backoff_delay
 
 
 OPEN_METEO_START_DATE = pd.Timestamp("2022-03-01")
@@ -19,83 +21,248 @@ DAILY_VARS = (
     "shortwave_radiation_sum"
 )
 OPEN_METEO_URL = "https://historical-forecast-api.open-meteo.com/v1/forecast"
+# Free tier limits: https://open-meteo.com/en/terms
+REQUESTS_PER_MINUTE = 600
+WEIGHT_PER_MINUTE = 600
+WEIGHT_PER_DAY = 10000
 
 
-def api_cost_calc(table_of_pv_systems, date_format="%Y-%m-%d"):
+def location_cost(start_date, end_date, n_vars=len(DAILY_VARS)):
+    return (end_date - start_date).days * n_vars / 140
+
+
+def api_cost_calc(table_of_pv_systems, date_format="%Y-%m-%d", grid_resolution=spatial.GRID_RESOLUTION):
+    # Systems in the same weather grid cell are fetched once (see group_locations_by_cell), so each system
+    # is charged an equal share of its cell's cost. Set grid_resolution=None for the cost without deduplication.
     table_of_pv_systems = utils.standardize_input(table_of_pv_systems, date_format=date_format)
 
-    result = table_of_pv_systems["Latest Output Date"] - table_of_pv_systems["Earliest Output Date"]
-    result = result.apply(lambda x: x.days * len(DAILY_VARS) / 140)
+    start_dates = table_of_pv_systems["Earliest Output Date"].tolist()
+    end_dates = table_of_pv_systems["Latest Output Date"].tolist()
+    result = pd.Series([location_cost(start_date, end_date) for start_date, end_date in zip(start_dates, end_dates)],
+                       index=table_of_pv_systems.index)
+    if grid_resolution is not None:
+        print(f"API cost without deduplication: {result.sum()}")
+        groups = spatial.group_by_cell(table_of_pv_systems["Latitude"], table_of_pv_systems["Longitude"], grid_resolution)
+        for positions in groups.values():
+            cell_cost = location_cost(min(start_dates[p] for p in positions), max(end_dates[p] for p in positions))
+            result.iloc[positions] = cell_cost / len(positions)
+        print(f"{len(table_of_pv_systems)} systems in {len(groups)} grid cells.")
     print(f"Total API cost: {result.sum()}")
     print(f"Min: {result.min()}, Mean: {result.mean()}, Max: {result.max()}")
     return result
 
 
-def get_weather_for_locations(query, daily_vars=DAILY_VARS, date_format="%Y-%m-%d", filepath="weather.csv", save_csv=True):
-    query = utils.standardize_input(query, date_format=date_format)
+def make_rate_limiter(requests_per_minute=REQUESTS_PER_MINUTE, weight_per_minute=WEIGHT_PER_MINUTE,
+                      weight_per_day=WEIGHT_PER_DAY):
+    return RateLimiter({
+        "requests_per_minute": (TokenBucket(requests_per_minute, 60), "requests"),
+        "weight_per_minute": (TokenBucket(weight_per_minute, 60), "weight"),
+        "weight_per_day": (TokenBucket(weight_per_day, 86400), "weight")
+    })
 
-    query.loc[query["Earliest Output Date"] < OPEN_METEO_START_DATE, "Earliest Output Date"] = OPEN_METEO_START_DATE
 
+def make_client(max_workers=4):
+    # An openmeteo_requests.Client on a retrying session with a connection for each worker thread.
     retry_strategy = Retry(
         total=3,
         backoff_factor=1,
         status_forcelist=[502, 503, 504],
         allowed_methods=["GET"]
     )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    session = requests.Session()
+    adapter = HTTPAdapter(max_retries=retry_strategy, pool_maxsize=max_workers)
+    # Responses are cached on disk when build_dataset.http_cache.enable() has been called.
+    session = http_cache.CachedSession()
     session.mount("http://", adapter)
     session.mount("https://", adapter)
-    open_meteo = openmeteo_requests.Client(session=session)
+    return openmeteo_requests.Client(session=session)
 
-    location_dfs = []
-    if "System ID" in query:
-        location_ids = (i for i in query["System ID"])
-    else:
-        location_ids = (i for i in range(len(query)))
-    first_idx = query.index[0]
-    for idx, location in query.iterrows():
-        location_id = next(location_ids)
-        if idx != first_idx:
-            print("Waiting 10s before next API call...")
-            time.sleep(10)
-
-        params = {
-            "latitude": location["Latitude"],
-            "longitude": location["Longitude"],
-            "start_date": location["Earliest Output Date"].strftime("%Y-%m-%d"),
-            "end_date": location["Latest Output Date"].strftime("%Y-%m-%d"),
-            "daily": list(daily_vars)
-        }
-        print(f"{time.strftime("%H:%M:%S", time.localtime())} - Making request for id {location_id}...")
+
+def group_locations_by_cell(locations, resolution=spatial.GRID_RESOLUTION, n_vars=len(DAILY_VARS)):
+    # Merges locations in the same weather grid cell into one location, covering the union of their date ranges.
+    # It is fetched at the real coordinates of the member nearest the others, so a location alone in its cell
+    # gets exactly the weather it would without grouping. The original locations are kept under "members" so
+    # the data can be fanned back out.
+    if resolution is None:
+        return [{**location, "members": [location]} for location in locations]
+
+    cells = []
+    groups = spatial.group_by_cell([location["latitude"] for location in locations],
+                                   [location["longitude"] for location in locations], resolution)
+    for order, positions in enumerate(groups.values()):
+        members = [locations[position] for position in positions]
+        latitudes = np.array([member["latitude"] for member in members], dtype=float)
+        longitudes = np.array([member["longitude"] for member in members], dtype=float)
+        nearest = members[int(np.argmin((latitudes - latitudes.mean()) ** 2 + (longitudes - longitudes.mean()) ** 2))]
+        start_date = min(member["start_date"] for member in members)
+        end_date = max(member["end_date"] for member in members)
+        cells.append({
+            "order": order,
+            "id": nearest["id"],
+            "latitude": nearest["latitude"],
+            "longitude": nearest["longitude"],
+            "start_date": start_date,
+            "end_date": end_date,
+            "weight": location_cost(start_date, end_date, n_vars),
+            "members": members
+        })
+    return cells
+
+
+def fan_out(cell, cell_df):
+    # Gives each member of a grid cell its own copy of the cell's rows, limited to its own date range.
+    member_dfs = {}
+    for member in cell["members"]:
+        in_range = (cell_df["date"] >= member["start_date"]) & (cell_df["date"] <= member["end_date"])
+        member_df = cell_df[in_range].copy()
+        member_df["id"] = member["id"]
+        member_dfs[member["order"]] = member_df
+    return member_dfs
+
+
+def make_batches(locations, batch_size, max_weight):
+    # Open-Meteo accepts several coordinates in one call, but they share the start and end dates,
+    # so only locations with the same date range are packed together.
+    batches = []
+    groups = {}
+    for location in locations:
+        groups.setdefault((location["start_date"], location["end_date"]), []).append(location)
+    for group in groups.values():
+        batch, weight = [], 0
+        for location in group:
+            if batch and (len(batch) >= batch_size or weight + location["weight"] > max_weight):
+                batches.append(batch)
+                batch, weight = [], 0
+            batch.append(location)
+            weight += location["weight"]
+        if batch:
+            batches.append(batch)
+    return batches
+
+
+def fetch_batch(open_meteo, batch, daily_vars, limiter, max_retries=3):
+    params = {
+        "latitude": [location["latitude"] for location in batch],
+        "longitude": [location["longitude"] for location in batch],
+        "start_date": batch[0]["start_date"].strftime("%Y-%m-%d"),
+        "end_date": batch[0]["end_date"].strftime("%Y-%m-%d"),
+        "daily": list(daily_vars)
+    }
+    batch_ids = [location["id"] for location in batch]
+    weight = sum(location["weight"] for location in batch)
+
+    for attempt in range(max_retries + 1):
+        limiter.acquire(requests=1, weight=weight)
+        print(f"{time.strftime("%H:%M:%S", time.localtime())} - Making request for ids {batch_ids}...")
         try:
             responses = open_meteo.weather_api(OPEN_METEO_URL, params=params)
+            break
         except Exception as e:
-            print(f"{time.strftime("%H:%M:%S", time.localtime())} - Request for id {location_id} failed.")
+            print(f"{time.strftime("%H:%M:%S", time.localtime())} - Request for ids {batch_ids} failed.")
             print(f"An error occurred: {e}")
-            continue
-        print(f"{time.strftime("%H:%M:%S", time.localtime())} - Request {location_id} successful.")
+            if attempt == max_retries:
+                raise
+            delay = backoff_delay(attempt)
+            print(f"Retrying in {delay}s ({attempt + 1}/{max_retries})...")
+            time.sleep(delay)
+    print(f"{time.strftime("%H:%M:%S", time.localtime())} - Request for ids {batch_ids} successful.")
 
-        response = responses[0]
+    location_dfs = {}
+    for location, response in zip(batch, responses):
         daily = response.Daily()
-        daily_data = {
-            "id": location_id,
-            "date": pd.date_range(
-                start=pd.to_datetime(daily.Time(), unit="s"),
-                end=pd.to_datetime(daily.TimeEnd(), unit="s"),
-                freq=pd.Timedelta(seconds=daily.Interval()),
-                inclusive="left"
-            )
-        }
+        dates = pd.date_range(
+            start=pd.to_datetime(daily.Time(), unit="s"),
+            end=pd.to_datetime(daily.TimeEnd(), unit="s"),
+            freq=pd.Timedelta(seconds=daily.Interval()),
+            inclusive="left"
+        ).as_unit("ns")
+        # Built with the dtypes of schema.SCHEMAS["weather"], so enforce() has nothing to copy.
+        daily_data = {"id": np.full(len(dates), location["id"], dtype=np.int32), "date": dates}
         for var_no, var_name in enumerate(daily_vars):
             daily_data[var_name] = daily.Variables(var_no).ValuesAsNumpy()
+        location_dfs[location["order"]] = schema.enforce(pd.DataFrame(data=daily_data), "weather")
+    return location_dfs
+
+
+def get_weather_for_locations(query, daily_vars=DAILY_VARS, date_format="%Y-%m-%d", filepath="weather.csv", save_csv=True,
+                              max_workers=4, batch_size=10, max_retries=3, limiter=None, callback=None, file_format="csv",
+                              grid_resolution=spatial.GRID_RESOLUTION, open_meteo=None):
+    # If given, callback(location, df) is called from this thread as soon as each location's data arrives,
+    # where location is a dict with keys "id", "start_date" and "end_date" among others.
+    # Locations in the same grid cell of grid_resolution degrees are fetched once. Set it to None to fetch each one.
+    # open_meteo is the client to fetch with (anything with a weather_api method, like the stub in benchmarks).
+    # Default is an openmeteo_requests.Client on a retrying, cached session.
+    query = utils.standardize_input(query, date_format=date_format)
+
+    query.loc[query["Earliest Output Date"] < OPEN_METEO_START_DATE, "Earliest Output Date"] = OPEN_METEO_START_DATE
+
+    if open_meteo is None:
+        open_meteo = make_client(max_workers)
+    if limiter is None:
+        limiter = make_rate_limiter()
+
+    if "System ID" in query:
+        location_ids = query["System ID"].tolist()
+    else:
+        location_ids = list(range(len(query)))
+    locations = [
+        {
+            "order": order,
+            "id": location_id,
+            "latitude": float(latitude),
+            "longitude": float(longitude),
+            "start_date": start_date,
+            "end_date": end_date,
+            "weight": location_cost(start_date, end_date, len(daily_vars))
+        }
+        for order, (location_id, latitude, longitude, start_date, end_date) in enumerate(zip(
+            location_ids, query["Latitude"], query["Longitude"],
+            query["Earliest Output Date"], query["Latest Output Date"]
+        ))
+    ]
+    cells = group_locations_by_cell(locations, grid_resolution, len(daily_vars))
+    if len(cells) < len(locations):
+        print(f"Fetching weather for {len(locations)} locations in {len(cells)} grid cells.")
+    batches = make_batches(cells, batch_size, WEIGHT_PER_MINUTE)
+
+    location_dfs = {}
+    failed_ids = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {
+            executor.submit(fetch_batch, open_meteo, batch, daily_vars, limiter, max_retries): batch
+            for batch in batches
+        }
+        while pending:
+            future = next(as_completed(pending))
+            batch = pending.pop(future)
+            try:
+                batch_dfs = future.result()
+            except Exception:
+                if len(batch) > 1:
+                    # One bad location should not lose the whole batch, so try them one at a time.
+                    print(f"Splitting failed batch of {len(batch)} locations into single requests.")
+                    for location in batch:
+                        pending[executor.submit(
+                            fetch_batch, open_meteo, [location], daily_vars, limiter, max_retries
+                        )] = [location]
+                else:
+                    failed_ids += [member["id"] for member in batch[0]["members"]]
+                continue
+            for cell in batch:
+                member_dfs = fan_out(cell, batch_dfs[cell["order"]])
+                location_dfs.update(member_dfs)
+                if callback is not None:
+                    for member in cell["members"]:
+                        callback(member, member_dfs[member["order"]])
 
-        location_dfs.append(pd.DataFrame(data=daily_data))
+    if failed_ids:
+        print(f"WARNING: No weather data for {len(failed_ids)} location(s) after {max_retries} retries: {failed_ids}")
 
     if location_dfs:
-        open_meteo_df = pd.concat(location_dfs, ignore_index=True)
+        open_meteo_df = pd.concat([location_dfs[order] for order in sorted(location_dfs)], ignore_index=True)
         if save_csv:
-            final_path = utils.safe_to_csv(open_meteo_df, filepath, index=False)
-            print(f"Saved CSV to {final_path}")
+            partition_col, date_col = storage.PARTITIONS["weather"]
+            final_path = utils.safe_save(open_meteo_df, filepath, file_format=file_format, partition_col=partition_col,
+                                         date_col=date_col, index=False)
+            print(f"Saved {file_format} to {final_path}")
         return open_meteo_df
     return
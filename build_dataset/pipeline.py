@@ -0,0 +1,476 @@
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import pandas as pd
+
+from . import combine_data, openmeteo, pvoutput, schema, storage
+from .incremental import append_to_store, missing_work
+from .manifest import FetchManifest
+
+
+# Stages in the order data flows through them.
+STAGES = ("systems", "pvoutput", "weather", "join", "writer")
+DONE = None  # Put on a queue once per worker to stop the stage.
+
+
+class StageCounter:
+    # Throughput of one stage, summed over its workers. starved is time spent waiting for input, and blocked
+    # time spent waiting for room in the next queue.
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.rows = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, items=0, rows=0, busy=0.0, starved=0.0, blocked=0.0):
+        with self.lock:
+            self.items += items
+            self.rows += rows
+            self.busy += busy
+            self.starved += starved
+            self.blocked += blocked
+
+    def summary(self, elapsed):
+        utilisation = self.busy / (elapsed * self.workers) if elapsed else 0
+        return (f"{self.name:<9} {self.workers:>3} workers {self.items:>7} items {self.rows:>10} rows "
+                f"{self.items / elapsed if elapsed else 0:>8.1f} items/s {utilisation:>5.0%} busy "
+                f"{self.starved:>7.1f}s starved {self.blocked:>7.1f}s blocked")
+
+
+class BuildPipeline:
+    """
+    Builds or updates the dataset like incremental.update_dataset, with each of STAGES running as a pool of
+    threads reading from a bounded queue, so fetching, joining and writing overlap.
+
+    Systems collected by earlier builds are kept, joined from the stores without fetching, unless they are removed.
+
+    Parameters:
+        data_dir (str): Folder for the manifest, the per-source data and the dataset.
+        workers (dict): Threads of the "systems", "pvoutput", "weather" and "join" stages. Defaults are 1, 4, 4
+            and 2.
+        queue_size (int): Maximum items waiting in each queue.
+        max_in_flight (int): Maximum systems between the first stage and the writer.
+        stale_days (int): Number of most recent days to re-fetch.
+        file_format (str): "csv" or "parquet".
+        chunksize (int): Joined rows written to the dataset at a time.
+        session: Session for PVOutput requests. Default is pvoutput.make_session().
+        open_meteo: Open-Meteo client. Default is openmeteo.make_client().
+        limiter (RateLimiter): Open-Meteo rate limiter. Default is openmeteo.make_rate_limiter().
+        batch_size (int): Maximum locations per Open-Meteo request.
+        progress_interval (float): Seconds between progress lines. None for none.
+    """
+
+    def __init__(self, data_dir="data", workers=None, queue_size=64, max_in_flight=32, stale_days=2,
+                 file_format="csv", chunksize=200000, session=None, open_meteo=None, limiter=None, batch_size=10,
+                 progress_interval=10):
+        self.data_dir = data_dir
+        self.workers = {"systems": 1, "pvoutput": 4, "weather": 4, "join": 2, "writer": 1, **(workers or {})}
+        # The stores and the dataset are single files, so only one thread writes them.
+        self.workers["writer"] = 1
+        self.file_format = file_format
+        self.chunksize = chunksize
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self.manifest = FetchManifest(os.path.join(data_dir, "manifest.sqlite"), stale_days=stale_days)
+        self.pvoutput_path = os.path.join(data_dir, f"pvoutput.{file_format}")
+        self.weather_path = os.path.join(data_dir, f"weather.{file_format}")
+        self.dataset_path = os.path.join(data_dir, f"dataset.{file_format}")
+        self.session = session if session is not None else pvoutput.make_session(
+            self.workers["systems"] + self.workers["pvoutput"])
+        self.pacer = pvoutput.QuotaPacer()
+        self.open_meteo = open_meteo
+        self.limiter = limiter if limiter is not None else openmeteo.make_rate_limiter()
+
+        self.queues = {stage: queue.Queue(maxsize=queue_size) for stage in STAGES}
+        self.in_flight = threading.Semaphore(max_in_flight)
+        self.counters = {stage: StageCounter(stage, self.workers[stage]) for stage in STAGES}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.csv_readers = {}
+        self.systems = {}
+        self.collected = {}
+        self.pending = []
+        self.columns = None
+        self.n_dataset_rows = 0
+        self.failed = []
+        self.kept = []  # Systems joined from the stores without fetching.
+        self.errors = []
+
+    def put(self, stage, item, counter):
+        start = time.perf_counter()
+        self.queues[stage].put(item)
+        blocked = time.perf_counter() - start
+        counter.add(blocked=blocked)
+        self.local.blocked = getattr(self.local, "blocked", 0.0) + blocked
+
+    def run_stage(self, stage, handle):
+        # Calls handle(item) for each item of the stage's queue until DONE.
+        counter = self.counters[stage]
+        inbox = self.queues[stage]
+        while True:
+            start = time.perf_counter()
+            item = inbox.get()
+            counter.add(starved=time.perf_counter() - start)
+            if item is DONE:
+                return
+            start = time.perf_counter()
+            self.local.blocked = 0.0
+            try:
+                handle(item)
+            except Exception as e:
+                # Reported at the end. The worker carries on so the stages before it are not left blocked.
+                print(f"Error in the {stage} stage: {e}")
+                self.errors.append(e)
+            # Time spent blocked on the next queue is not work, so it is taken off.
+            counter.add(busy=time.perf_counter() - start - self.local.blocked)
+
+    def start_stage(self, stage, handle):
+        return [threading.Thread(target=self.run_stage, args=(stage, handle), name=f"{stage}-{i}", daemon=True)
+                for i in range(self.workers[stage])]
+
+    def handle_system(self, sid):
+        # The writer returns the system's in_flight permit once it is written, so every early exit returns it here.
+        counter = self.counters["systems"]
+        try:
+            system = pvoutput.get_system_info_from_id(sid, self.session, self.pacer)
+            system["Elevation (m)"] = pvoutput.get_elevation([system["Latitude"]], [system["Longitude"]])[0]
+            self.manifest.record_system(sid, system["Elevation (m)"])
+        except Exception as e:
+            print(f"Could not get the info of System ID {sid}: {e}")
+            self.failed.append(sid)
+            if self.collected.get(sid) is None:
+                self.in_flight.release()
+            else:
+                self.keep(sid, self.collected[sid], counter)
+            return
+        counter.add(items=1)
+
+        try:
+            pv_jobs, weather_ranges = missing_work(self.manifest, system)
+            locations = [
+                {
+                    "id": sid,
+                    "latitude": float(system["Latitude"]),
+                    "longitude": float(system["Longitude"]),
+                    "start_date": missing_start,
+                    "end_date": missing_end,
+                    "weight": openmeteo.location_cost(missing_start, missing_end)
+                }
+                for missing_start, missing_end in weather_ranges
+            ]
+            # The join stage needs to know how many parts to wait for before the first of them can arrive.
+            self.track(sid, system, len(pv_jobs) + len(locations))
+        except Exception:
+            self.failed.append(sid)
+            self.in_flight.release()
+            raise
+        parts = [("pvoutput", job) for job in pv_jobs] + [("weather", location) for location in locations]
+        queued = 0
+        try:
+            for stage, part in parts:
+                self.put(stage, part, counter)
+                queued += 1
+        except Exception as e:
+            # The join stage is waiting for these parts, so they are sent to it as failed.
+            for stage, part in parts[queued:] + [("system", None)]:
+                self.queues["join"].put((stage, sid, part, e))
+            raise
+        self.put("join", ("system", sid, None, None), counter)
+
+    def track(self, sid, info, n_parts):
+        # Called before any part of the system is queued. The "system" item is the last part.
+        with self.lock:
+            self.systems[sid] = {"info": info, "left": n_parts + 1, "parts": []}
+
+    def keep(self, sid, elevation, counter):
+        # Joins the stored rows of a system without fetching anything, e.g. one that was not asked for this time.
+        self.kept.append(sid)
+        self.track(sid, {"Elevation (m)": elevation}, 0)
+        self.put("join", ("system", sid, None, None), counter)
+
+    def handle_pv_window(self, job):
+        counter = self.counters["pvoutput"]
+        try:
+            df = pvoutput.get_output_window(*job, self.session, self.pacer)
+        except Exception as e:
+            print(f"Could not get the output of System ID {job[0]} {job[1]:%Y%m%d}-{job[2]:%Y%m%d}: {e}")
+            df = e
+        counter.add(items=1, rows=0 if df is None or isinstance(df, Exception) else len(df))
+        self.put("join", ("pvoutput", job[0], job, df), counter)
+
+    def handle_location(self, location):
+        # Locations already waiting in the queue are fetched in the same requests.
+        counter = self.counters["weather"]
+        locations = [location]
+        stop = False
+        while len(locations) < self.batch_size:
+            try:
+                item = self.queues["weather"].get_nowait()
+            except queue.Empty:
+                break
+            if item is DONE:
+                stop = True
+                break
+            locations.append(item)
+        for order, item in enumerate(locations):
+            item["order"] = order
+
+        cells = openmeteo.group_locations_by_cell(locations)
+        for batch in openmeteo.make_batches(cells, self.batch_size, openmeteo.WEIGHT_PER_MINUTE):
+            try:
+                batch_dfs = openmeteo.fetch_batch(self.weather_client(), batch, openmeteo.DAILY_VARS, self.limiter)
+                results = {}
+                for cell in batch:
+                    results.update(openmeteo.fan_out(cell, batch_dfs[cell["order"]]))
+            except Exception as e:
+                print(f"Could not get the weather for System IDs {[cell['id'] for cell in batch]}: {e}")
+                results = {member["order"]: e for cell in batch for member in cell["members"]}
+            for cell in batch:
+                for member in cell["members"]:
+                    df = results[member["order"]]
+                    counter.add(items=1, rows=0 if isinstance(df, Exception) else len(df))
+                    self.put("join", ("weather", member["id"], member, df), counter)
+        if stop:
+            # The DONE taken from the queue belonged to another worker, so put it back.
+            self.queues["weather"].put(DONE)
+
+    def weather_client(self):
+        if self.open_meteo is None:
+            # Made on first use, so that a pipeline without weather to fetch never needs openmeteo_requests.
+            self.open_meteo = openmeteo.make_client(self.workers["weather"])
+        return self.open_meteo
+
+    def handle_result(self, item):
+        kind, sid, part, df = item
+        with self.lock:
+            state = self.systems[sid]
+            state["left"] -= 1
+            if kind != "system":
+                state["parts"].append((kind, part, df))
+            done = state["left"] == 0
+            if done:
+                del self.systems[sid]
+        self.counters["join"].add(items=1)
+        if not done:
+            return
+        try:
+            joined = self.join_system(sid, state)
+        except Exception as e:
+            joined = e
+        # The parts are saved by the writer, after join_system has read the rows of earlier builds.
+        self.put("writer", (sid, state["parts"], joined), self.counters["join"])
+
+    def read_previous(self, table, sid):
+        # The rows of a system from earlier builds, or None.
+        if table in self.csv_readers:
+            ids, read = self.csv_readers[table]
+            return read(sid) if sid in ids else None
+        path = self.pvoutput_path if table == "pvoutput" else self.weather_path
+        id_col = storage.PARTITIONS[table][0]
+        if storage.is_parquet_path(path) and os.path.isdir(os.path.join(path, f"{id_col}={sid}")):
+            columns = combine_data.PVOUTPUT_COLUMNS if table == "pvoutput" else None
+            return storage.read_partition(path, id_col, sid, columns)
+        return None
+
+    def join_system(self, sid, state):
+        # Re-fetched days come after the rows of earlier builds, so they win.
+        halves = []
+        for table in ("pvoutput", "weather"):
+            dfs = [self.read_previous(table, sid)] + [df for kind, part, df in state["parts"] if kind == table]
+            dfs = [df for df in dfs if isinstance(df, pd.DataFrame)]
+            if not dfs:
+                return None
+            halves.append(pd.concat(dfs, ignore_index=True))
+        pv_df, weather_df = halves
+        joined = combine_data.join_system(pv_df[combine_data.PVOUTPUT_COLUMNS], weather_df)
+        if joined.empty:
+            return None
+        joined["Elevation (m)"] = state["info"]["Elevation (m)"]
+        self.counters["join"].add(rows=len(joined))
+        return joined
+
+    def write_system(self, item):
+        sid, parts, joined = item
+        counter = self.counters["writer"]
+        try:
+            for kind, part, df in parts:
+                if isinstance(df, Exception):
+                    self.failed.append(sid)
+                elif df is not None:
+                    try:
+                        self.save_part(kind, sid, part, df)
+                    except Exception as e:
+                        print(f"Could not save {kind} data of System ID {sid}: {e}")
+                        self.failed.append(sid)
+                elif kind == "pvoutput":
+                    # get_output_window only returns None for "No outputs", so the window is really empty.
+                    self.manifest.record("pvoutput", sid, part[1], part[2])
+            if isinstance(joined, Exception):
+                raise joined
+            if joined is not None:
+                self.pending.append(joined)
+                counter.add(rows=len(joined))
+                if sum(len(df) for df in self.pending) >= self.chunksize:
+                    self.write_pending()
+        finally:
+            counter.add(items=1)
+            self.in_flight.release()
+
+    def save_part(self, kind, sid, part, df):
+        # The rows are stored before they are recorded, so an interrupted build never skips a window.
+        if kind == "pvoutput":
+            append_to_store(df, self.pvoutput_path, "pvoutput")
+            self.manifest.record("pvoutput", sid, part[1], part[2])
+        else:
+            append_to_store(df, self.weather_path, "weather")
+            self.manifest.record("openmeteo", sid, part["start_date"], part["end_date"])
+
+    def write_pending(self):
+        batch = schema.validate(schema.enforce(pd.concat(self.pending, ignore_index=True), "dataset"), "dataset")
+        self.pending.clear()
+        first = self.columns is None
+        if first:
+            self.columns = list(batch.columns)
+        partition_col, date_col = storage.PARTITIONS["dataset"]
+        if self.file_format == "parquet":
+            storage.write_parquet(batch[self.columns], self.building_path, partition_col=partition_col,
+                                  date_col=date_col, mode="w" if first else "a")
+        else:
+            batch[self.columns].to_csv(self.building_path, mode="w" if first else "a", header=first, index=False)
+        self.n_dataset_rows += len(batch)
+
+    def report(self, elapsed):
+        sizes = " ".join(f"{stage}={self.queues[stage].qsize()}" for stage in STAGES)
+        print(f"{time.strftime('%H:%M:%S', time.localtime())} - {elapsed:.0f}s, queues {sizes}, "
+              f"{self.n_dataset_rows + sum(len(df) for df in self.pending)} dataset rows")
+        for stage in STAGES:
+            print("    " + self.counters[stage].summary(elapsed))
+
+    def run(self, system_ids, remove=()):
+        """
+        Fetches what is missing for each system, and writes the dataset.
+
+        Parameters:
+            system_ids (list): Systems to update.
+            remove (list): Systems to leave out of the dataset, and forget in the manifest.
+
+        Returns:
+            str: The path the dataset was saved to, or None if nothing was joined.
+        """
+        start = time.time()
+        stage_threads = {
+            "systems": self.start_stage("systems", self.handle_system),
+            "pvoutput": self.start_stage("pvoutput", self.handle_pv_window),
+            "weather": self.start_stage("weather", self.handle_location),
+            "join": self.start_stage("join", self.handle_result),
+            "writer": self.start_stage("writer", self.write_system)
+        }
+        remove = set(remove)
+        for sid in remove:
+            self.manifest.forget_system(sid)
+        system_ids = [sid for sid in system_ids if sid not in remove]
+        self.collected = self.manifest.collected_systems()
+        # Systems collected before without a recorded elevation are updated, so that it is recorded.
+        updated = set(system_ids)
+        others = {sid: elevation for sid, elevation in self.collected.items() if sid not in updated}
+        system_ids += [sid for sid, elevation in others.items() if elevation is None]
+        os.makedirs(self.data_dir, exist_ok=True)
+        # The dataset is built next to the old one, which is only replaced once the build has finished.
+        self.building_path = os.path.join(self.data_dir, f"dataset.building.{self.file_format}")
+        with tempfile.TemporaryDirectory(dir=self.data_dir) as spill_dir:
+            self.spill_dir = spill_dir
+            if self.file_format == "csv":
+                self.split_existing_stores()
+            for threads in stage_threads.values():
+                for thread in threads:
+                    thread.start()
+
+            stop_progress = threading.Event()
+            if self.progress_interval:
+                threading.Thread(target=self.show_progress, args=(start, stop_progress), daemon=True).start()
+            feeder = self.counters["systems"]
+            kept = [(sid, elevation) for sid, elevation in others.items() if elevation is not None]
+            for sid, elevation in [(sid, None) for sid in system_ids] + kept:
+                # Waits while max_in_flight systems have not been written yet.
+                blocked = time.perf_counter()
+                self.in_flight.acquire()
+                feeder.add(blocked=time.perf_counter() - blocked)
+                if elevation is None:
+                    self.queues["systems"].put(sid)
+                else:
+                    self.keep(sid, elevation, feeder)
+            # Each stage is stopped once the stage before it has finished, so nothing is left in its queue.
+            for stage in STAGES:
+                for _ in stage_threads[stage]:
+                    self.queues[stage].put(DONE)
+                for thread in stage_threads[stage]:
+                    thread.join()
+            stop_progress.set()
+            if self.pending:
+                self.write_pending()
+        self.manifest.close()
+        if self.errors:
+            raise self.errors[0]
+
+        elapsed = time.time() - start
+        self.report(elapsed)
+        if self.kept:
+            print(f"Kept the stored rows of System IDs {sorted(set(self.kept))} without fetching.")
+        if self.failed:
+            print(f"Some data of System IDs {sorted(set(self.failed))} could not be fetched. "
+                  f"Run again to retry them.")
+        if self.columns is None:
+            print("No systems have both weather and PVOutput data.")
+            return None
+        if os.path.isdir(self.dataset_path):
+            shutil.rmtree(self.dataset_path)
+        os.replace(self.building_path, self.dataset_path)
+        print(f"Saved {self.file_format} to {self.dataset_path}: {self.n_dataset_rows} rows in {elapsed:.1f}s.")
+        return self.dataset_path
+
+    def split_existing_stores(self):
+        # CSV stores are split by system once, before this build appends to them, so read_previous can read them.
+        for table, path in (("pvoutput", self.pvoutput_path), ("weather", self.weather_path)):
+            if os.path.exists(path):
+                id_col, date_col = storage.PARTITIONS[table]
+                columns = combine_data.PVOUTPUT_COLUMNS if table == "pvoutput" else None
+                spill_dir = os.path.join(self.spill_dir, table)
+                os.makedirs(spill_dir)
+                ids, read = combine_data.split_by_system(path, id_col, date_col, columns, spill_dir, self.chunksize)
+                self.csv_readers[table] = (set(ids), read)
+
+    def show_progress(self, start, stop):
+        while not stop.wait(self.progress_interval):
+            self.report(time.time() - start)
+
+
+def build(system_ids, data_dir="data", workers=None, remove=(), **kwargs):
+    # Shortcut for BuildPipeline(data_dir, workers, **kwargs).run(system_ids, remove).
+    return BuildPipeline(data_dir, workers, **kwargs).run(system_ids, remove)
+
+
+if __name__ == "__main__":
+    # Usage: python -m build_dataset.pipeline [data_dir] [systems,pvoutput,weather,join workers] [system IDs...]
+    # e.g. python -m build_dataset.pipeline data 2,4,4,2 66991 11542 -5242
+    # A system ID starting with "-" is removed from the dataset. Without system IDs to update, the systems in
+    # data_dir/systems.csv are updated.
+    from . import http_cache
+
+    data_dir = sys.argv[1] if len(sys.argv) > 1 else "data"
+    counts = [int(count) for count in sys.argv[2].split(",")] if len(sys.argv) > 2 else [1, 4, 4, 2]
+    system_ids = [int(sid) for sid in sys.argv[3:] if not sid.startswith("-")]
+    remove = [int(sid[1:]) for sid in sys.argv[3:] if sid.startswith("-")]
+    if not system_ids:
+        system_ids = pd.read_csv(os.path.join(data_dir, "systems.csv"))["System ID"].tolist()
+    http_cache.enable(os.path.join(data_dir, "http_cache.sqlite"))
+    build(system_ids, data_dir, dict(zip(("systems", "pvoutput", "weather", "join"), counts)), remove)
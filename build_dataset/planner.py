@@ -0,0 +1,339 @@
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from solar_common.sqlite_store import SQLiteStore
+
+from . import incremental, openmeteo, pvoutput, utils
+from .manifest import FetchManifest
+
+
+SOURCES = ("pvoutput", "openmeteo")
+
+
+class JobQueue(SQLiteStore):
+    # API calls planned by plan(), in the order run() makes them. Done jobs are kept, so an interrupted run can
+    # carry on and the quota already used is known.
+
+    def __init__(self, filepath="data/fetch_queue.sqlite"):
+        super().__init__(filepath, (
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "position INTEGER PRIMARY KEY, source TEXT NOT NULL, system_id INTEGER NOT NULL, "
+            "start_date TEXT NOT NULL, end_date TEXT NOT NULL, latitude REAL, longitude REAL, cost REAL NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, finished_at REAL)",
+            "CREATE INDEX IF NOT EXISTS jobs_idx ON jobs (source, status, position)",
+            "CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        ))
+        self.connection.row_factory = sqlite3.Row
+
+    def replace(self, jobs, settings):
+        # Replaces every job that is not done with jobs, a list of dicts with the columns of the jobs table.
+        with self.lock:
+            self.connection.execute("DELETE FROM jobs WHERE status != 'done'")
+            self.connection.executemany(
+                "INSERT INTO jobs (source, system_id, start_date, end_date, latitude, longitude, cost) "
+                "VALUES (:source, :system_id, :start_date, :end_date, :latitude, :longitude, :cost)", jobs
+            )
+            self.connection.executemany("INSERT OR REPLACE INTO settings VALUES (?, ?)",
+                                        [(key, str(value)) for key, value in settings.items()])
+            self.connection.commit()
+
+    def settings(self):
+        with self.lock:
+            return dict(self.connection.execute("SELECT key, value FROM settings").fetchall())
+
+    def pending(self, source, after=0, limit=1, max_attempts=3):
+        # The next jobs of source after position, in order, as dicts with dates as pd.Timestamp.
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT * FROM jobs WHERE source = ? AND status = 'pending' AND position > ? AND attempts < ? "
+                "ORDER BY position LIMIT ?", (source, after, max_attempts, limit)
+            ).fetchall()
+        jobs = [dict(row) for row in rows]
+        for job in jobs:
+            job["start_date"] = pd.Timestamp(job["start_date"])
+            job["end_date"] = pd.Timestamp(job["end_date"])
+        return jobs
+
+    def finish(self, position):
+        with self.lock:
+            self.connection.execute("UPDATE jobs SET status = 'done', finished_at = ? WHERE position = ?",
+                                    (time.time(), position))
+            self.connection.commit()
+
+    def fail(self, position, max_attempts=3):
+        # Jobs that have failed max_attempts times are left for the next plan().
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET attempts = attempts + 1, "
+                "status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE status END WHERE position = ?",
+                (max_attempts, position)
+            )
+            self.connection.commit()
+
+    def used_since(self, source, since):
+        # Cost of the jobs of source finished since the given Unix time.
+        with self.lock:
+            used = self.connection.execute(
+                "SELECT SUM(cost) FROM jobs WHERE source = ? AND status = 'done' AND finished_at >= ?", (source, since)
+            ).fetchone()[0]
+        return used or 0.0
+
+    def jobs(self):
+        with self.lock:
+            return pd.read_sql_query("SELECT * FROM jobs ORDER BY position", self.connection)
+
+
+def queue_path(data_dir):
+    return os.path.join(data_dir, "fetch_queue.sqlite")
+
+
+def plan(system_table, data_dir="data", pv_calls_per_hour=pvoutput.CALLS_PER_HOUR,
+         weight_per_day=openmeteo.WEIGHT_PER_DAY, file_format="csv", date_format="%Y-%m-%d", stale_days=2):
+    """
+    Plans the API calls missing from the manifest as a job queue in data_dir, to be made by run(). Systems
+    needing the smallest share of a quota window go first. Planning again replaces the jobs that are not done.
+
+    Parameters:
+        system_table (pd.DataFrame or str): Systems, like data/systems.csv.
+        data_dir (str): Folder for the manifest, the job queue and the data.
+        pv_calls_per_hour (int): PVOutput calls allowed per hour.
+        weight_per_day (float): Open-Meteo weight allowed per day.
+        file_format (str): "csv" or "parquet", for the data fetched by run().
+        date_format (str): Format of the dates if system_table is a CSV path.
+        stale_days (int): Number of most recent days to re-fetch.
+
+    Returns:
+        pd.DataFrame: The jobs, also saved in data_dir/fetch_queue.sqlite.
+    """
+    system_df = utils.standardize_input(system_table, date_format=date_format)
+    if "Elevation (m)" not in system_df:
+        system_df["Elevation (m)"] = pvoutput.get_elevation(system_df["Latitude"], system_df["Longitude"])
+    systems_path = os.path.join(data_dir, "systems.csv")
+    os.makedirs(data_dir, exist_ok=True)
+    utils.safe_to_csv(system_df, systems_path, overwrite=True, index=False)
+
+    manifest = FetchManifest(os.path.join(data_dir, "manifest.sqlite"), stale_days=stale_days)
+    systems = []
+    for _, system in system_df.iterrows():
+        pv_jobs, weather_ranges = incremental.missing_work(manifest, system)
+        if not pv_jobs and not weather_ranges:
+            continue
+        weight = sum(openmeteo.location_cost(start_date, end_date) for start_date, end_date in weather_ranges)
+        share = max(len(pv_jobs) / pv_calls_per_hour, weight / weight_per_day)
+        systems.append((share, system["System ID"], system, pv_jobs, weather_ranges))
+    manifest.close()
+    systems.sort(key=lambda item: item[:2])
+
+    jobs = []
+    for _, sid, system, pv_jobs, weather_ranges in systems:
+        common = {"system_id": int(sid), "latitude": float(system["Latitude"]), "longitude": float(system["Longitude"])}
+        jobs += [{**common, "source": "pvoutput", "start_date": f"{date_from:%Y-%m-%d}",
+                  "end_date": f"{date_to:%Y-%m-%d}", "cost": 1} for _, date_from, date_to in pv_jobs]
+        jobs += [{**common, "source": "openmeteo", "start_date": f"{start_date:%Y-%m-%d}",
+                  "end_date": f"{end_date:%Y-%m-%d}", "cost": openmeteo.location_cost(start_date, end_date)}
+                 for start_date, end_date in weather_ranges]
+
+    queue = JobQueue(queue_path(data_dir))
+    queue.replace(jobs, {"pv_calls_per_hour": pv_calls_per_hour, "weight_per_day": weight_per_day,
+                         "file_format": file_format})
+    queue.close()
+    print(f"Planned {len(jobs)} API calls for {len(systems)} of {len(system_df)} systems.")
+    return report(data_dir)
+
+
+def finish_times(costs, source, pv_calls_per_hour, weight_per_day, used=0.0):
+    # Seconds from now until each of a run of jobs of source is expected to be done, from their cumulative cost.
+    cumulative = np.cumsum(costs)
+    if source == "pvoutput":
+        return cumulative * 3600 / pv_calls_per_hour
+    per_minute = cumulative / openmeteo.WEIGHT_PER_MINUTE * 60
+    per_day = (cumulative + used - weight_per_day) / weight_per_day * 86400
+    return np.maximum(per_minute, per_day)
+
+
+def report(data_dir="data", now=None):
+    """
+    Prints the progress of the job queue, and when the remaining systems are expected to be complete.
+
+    Returns:
+        pd.DataFrame: The jobs, with the expected Unix time each pending job is done in "eta".
+    """
+    now = time.time() if now is None else now
+    queue = JobQueue(queue_path(data_dir))
+    jobs = queue.jobs()
+    settings = queue.settings()
+    used = queue.used_since("openmeteo", now - 86400)
+    queue.close()
+    if jobs.empty:
+        print("The job queue is empty.")
+        return jobs
+    pv_calls_per_hour = float(settings["pv_calls_per_hour"])
+    weight_per_day = float(settings["weight_per_day"])
+
+    jobs["eta"] = np.nan
+    for source in SOURCES:
+        mask = (jobs["source"] == source).to_numpy()
+        pending = mask & (jobs["status"] == "pending").to_numpy()
+        jobs.loc[pending, "eta"] = now + finish_times(jobs.loc[pending, "cost"].to_numpy(), source,
+                                                      pv_calls_per_hour, weight_per_day, used)
+        counts = jobs.loc[mask, "status"].value_counts()
+        costs = jobs.loc[mask].groupby("status")["cost"].sum()
+        unit = "calls" if source == "pvoutput" else "weight"
+        print(f"{source}: " + ", ".join(f"{status} {counts.get(status, 0)} ({costs.get(status, 0):.0f} {unit})"
+                                        for status in ("done", "pending", "failed")))
+
+    systems = jobs.groupby("system_id").agg(eta=("eta", "max"), failed=("status", lambda s: (s == "failed").any()))
+    complete = int((systems["eta"].isna() & ~systems["failed"]).sum())
+    n_failed = int(systems["failed"].sum())
+    print(f"{complete} of {len(systems)} systems complete" + (f", {n_failed} with failed calls (plan again to retry "
+                                                              f"them)." if n_failed else "."))
+    remaining = systems["eta"].dropna().sort_values()
+    if len(remaining):
+        # The number of systems complete by the end of each hour, or each day for builds of more than a day.
+        window = 3600 if remaining.iloc[-1] - now <= 86400 else 86400
+        fmt = "%H:%M" if window == 3600 else "%d/%m %H:%M"
+        for end in np.arange(now + window, remaining.iloc[-1], window):
+            done = complete + int((remaining <= end).sum())
+            print(f"    by {time.strftime(fmt, time.localtime(end))}: {done} of {len(systems)} systems")
+        print(f"Expected to finish at {time.strftime('%d/%m %H:%M', time.localtime(remaining.iloc[-1]))}, "
+              f"in {(remaining.iloc[-1] - now) / 3600:.1f} hours.")
+    return jobs
+
+
+def drain(queue, source, handle, batch_size, max_attempts):
+    # Hands the pending jobs of source to handle in order, batch_size at a time, then goes round again for
+    # the ones that failed until they have no attempts left.
+    after = 0
+    while True:
+        jobs = queue.pending(source, after, batch_size, max_attempts)
+        if not jobs:
+            if after == 0:
+                return
+            after = 0
+            continue
+        after = jobs[-1]["position"]
+        handle(jobs)
+
+
+def run(data_dir="data", batch_size=10, max_attempts=3, session=None, open_meteo=None, limiter=None,
+        progress_interval=600, combine=True):
+    """
+    Makes the calls planned by plan() within the quotas, then combines the data into the dataset. A run that
+    is stopped can be started again.
+
+    Parameters:
+        data_dir (str): Folder with the job queue from plan().
+        batch_size (int): Maximum locations per Open-Meteo request.
+        max_attempts (int): Failures before a job is left for the next plan().
+        session: Session for PVOutput requests. Default is pvoutput.make_session().
+        open_meteo: Open-Meteo client. Default is openmeteo.make_client().
+        limiter (RateLimiter): Open-Meteo rate limiter. Default is openmeteo.make_rate_limiter().
+        progress_interval (float): Seconds between progress reports.
+        combine (bool): Whether to combine the data when every job is done. Default is True.
+
+    Returns:
+        pd.DataFrame: The dataset, if it was combined.
+    """
+    queue = JobQueue(queue_path(data_dir))
+    settings = queue.settings()
+    if not settings:
+        print(f"Nothing has been planned in {data_dir}. Run plan() first.")
+        return
+    file_format = settings["file_format"]
+    pv_calls_per_hour = float(settings["pv_calls_per_hour"])
+    weight_per_day = float(settings["weight_per_day"])
+    manifest = FetchManifest(os.path.join(data_dir, "manifest.sqlite"))
+    pvoutput_path = os.path.join(data_dir, f"pvoutput.{file_format}")
+    weather_path = os.path.join(data_dir, f"weather.{file_format}")
+
+    if session is None:
+        session = pvoutput.make_session(1)
+    pacer = pvoutput.QuotaPacer(min_interval=3600 / pv_calls_per_hour)
+    if open_meteo is None:
+        open_meteo = openmeteo.make_client(1)
+    if limiter is None:
+        limiter = openmeteo.make_rate_limiter(weight_per_day=weight_per_day)
+        # The daily weight used before a restart still counts.
+        limiter.reserve("weight_per_day", queue.used_since("openmeteo", time.time() - 86400))
+
+    def fetch_pvoutput(jobs):
+        for job in jobs:
+            try:
+                df = pvoutput.get_output_window(job["system_id"], job["start_date"], job["end_date"], session, pacer)
+                if df is not None:
+                    incremental.append_to_store(df, pvoutput_path, "pvoutput")
+            except Exception as e:
+                print(f"Could not get the output of System ID {job['system_id']}: {e}")
+                queue.fail(job["position"], max_attempts)
+                continue
+            manifest.record("pvoutput", job["system_id"], job["start_date"], job["end_date"])
+            queue.finish(job["position"])
+
+    def fetch_weather(jobs):
+        locations = [{"order": order, "id": job["system_id"], "weight": job["cost"], **job}
+                     for order, job in enumerate(jobs)]
+        cells = openmeteo.group_locations_by_cell(locations)
+        for batch in openmeteo.make_batches(cells, batch_size, openmeteo.WEIGHT_PER_MINUTE):
+            try:
+                batch_dfs = openmeteo.fetch_batch(open_meteo, batch, openmeteo.DAILY_VARS, limiter)
+            except Exception as e:
+                print(f"Could not get the weather for System IDs {[cell['id'] for cell in batch]}: {e}")
+                for cell in batch:
+                    for member in cell["members"]:
+                        queue.fail(member["position"], max_attempts)
+                continue
+            for cell in batch:
+                member_dfs = openmeteo.fan_out(cell, batch_dfs[cell["order"]])
+                for member in cell["members"]:
+                    incremental.append_to_store(member_dfs[member["order"]], weather_path, "weather")
+                    manifest.record("openmeteo", member["id"], member["start_date"], member["end_date"])
+                    queue.finish(member["position"])
+
+    threads = [
+        threading.Thread(target=drain, args=(queue, "pvoutput", fetch_pvoutput, 1, max_attempts), daemon=True),
+        threading.Thread(target=drain, args=(queue, "openmeteo", fetch_weather, batch_size, max_attempts),
+                         daemon=True)
+    ]
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        next(thread for thread in threads if thread.is_alive()).join(progress_interval)
+        if any(thread.is_alive() for thread in threads):
+            report(data_dir)
+    manifest.close()
+
+    jobs = report(data_dir)
+    queue.close()
+    if not combine:
+        return
+    if (jobs["status"] != "done").any():
+        print("Some calls failed, so the dataset was not combined. Plan again to retry them.")
+        return
+    system_df = pd.read_csv(os.path.join(data_dir, "systems.csv"),
+                            parse_dates=["Earliest Output Date", "Latest Output Date"])
+    return incremental.combine_stores(data_dir, file_format, system_df)
+
+
+if __name__ == "__main__":
+    # Usage: python -m build_dataset.planner plan data/systems.csv [data_dir] [PVOutput calls per hour]
+    #        python -m build_dataset.planner run [data_dir]
+    #        python -m build_dataset.planner report [data_dir]
+    # Plan once, then run (and run again after an interruption) until every system is complete.
+    from . import http_cache
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "report"
+    if command == "plan":
+        data_dir = sys.argv[3] if len(sys.argv) > 3 else "data"
+        calls_per_hour = int(sys.argv[4]) if len(sys.argv) > 4 else pvoutput.CALLS_PER_HOUR
+        plan(sys.argv[2], data_dir, calls_per_hour)
+    elif command == "run":
+        data_dir = sys.argv[2] if len(sys.argv) > 2 else "data"
+        http_cache.enable(os.path.join(data_dir, "http_cache.sqlite"))
+        run(data_dir)
+    else:
+        report(sys.argv[2] if len(sys.argv) > 2 else "data")
@@ -1,11 +1,20 @@
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone
+import itertools
+import time
 
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
 import os
 from dotenv import load_dotenv
 
-from . import utils
+from solar_common import elevation_grid
+
+from . import http_cache, schema, storage, utils
+from .rate_limit import QuotaPacer, backoff_delay
 
 
 load_dotenv()
@@ -14,45 +23,159 @@ CREDENTIALS = {
     "key": os.getenv("PV_API_key")
 }
 PVOUTPUT_BASE_URL = "https://pvoutput.org/service/r2/"
+# Calls per hour for donors, as assumed by the windows in get_output_window. Other accounts get 60:
+# https://pvoutput.org/help/api_specification.html#rate-limits
+CALLS_PER_HOUR = 300
 # The Historical Forecast API on open-meteo.com starts at
 # 2022-03-01 for the UK Met Office.
 OPEN_METEO_START_DATE = pd.Timestamp("2022-03-01")
-
-
-def get_elevation(lat_series, lon_series):
-    coord_string = "|".join(lat_series.astype(str) + "," + lon_series.astype(str))
-
-    elevation_url = f"https://api.open-elevation.com/api/v1/lookup?locations={coord_string}"
-    response = requests.get(elevation_url)
-    data = response.json()
-
-    elevations = [item["elevation"] for item in data["results"]]
-    return pd.Series(elevations)
-
-
-def save_outputs_to_csv(system_ids, mode="info_only", filepath=None):
+ELEVATION_GRID_PATH = "data/uk_elevation.npy"
+PVOUTPUT_DF_COLUMNS = [
+    "System ID",
+    "Date",
+    "Energy Generated (Wh)",
+    "Efficiency (kWh/kW)",
+    "Energy Exported (Wh)",
+    "Energy Used (Wh)",
+    "Peak Power (W)",
+    "Peak Time",
+    "Condition",
+    "Min Temp (°C)",
+    "Max Temp (°C)",
+    "Peak Energy Import (Wh)",
+    "Off Peak Energy Import (Wh)",
+    "Shoulder Energy Import (Wh)",
+    "High Shoulder Energy Import (Wh)",
+    "Insolation (Wh)"
+]
+# Columns of getoutput.jsp responses kept by default ("System ID" is always added). The rest are
+# dropped by combine_data anyway.
+OUTPUT_COLUMNS = ["Date", "Efficiency (kWh/kW)"]
+# getoutput.jsp fields that are text. Date is parsed to datetime64 and everything else to float64.
+TEXT_COLUMNS = ("Peak Time", "Condition")
+
+
+def make_session(pool_size=4):
+    # One keep-alive session shared by all worker threads, with enough pooled connections for each of them.
+    # Responses are cached on disk when build_dataset.http_cache.enable() has been called.
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session = http_cache.CachedSession()
+    session.mount("https://", adapter)
+    return session
+
+
+def parse_rate_limit_headers(headers):
+    remaining = headers.get("X-Rate-Limit-Remaining")
+    reset = headers.get("X-Rate-Limit-Reset")
+    if remaining is None or reset is None:
+        return None, None
+    return int(remaining), int(reset)
+
+
+def pvoutput_get(service, params, session=None, pacer=None, max_retries=3, stream=False):
+    """
+    Makes a GET request to the PVOutput API, pacing it with the X-Rate-Limit headers.
+
+    Parameters:
+        service (str): The API service, e.g. "getoutput.jsp".
+        params (dict): Query parameters, not including credentials.
+        session (requests.Session): Session to make the request with. Default is a new session from make_session().
+        pacer (QuotaPacer): Shared pacer updated from the response headers. Default is no pacing.
+        max_retries (int): How many times to retry after a connection error or server error.
+        stream (bool): Leave the body to be read with response.iter_content(). Default is False.
+
+    Returns:
+        requests.Response: The response. Calls that go over the hourly limit wait for the reset and are retried.
+    """
+    if session is None:
+        session = make_session(1)
+    params = {**CREDENTIALS, **params}
+    if isinstance(session, http_cache.CachedSession):
+        response = session.cached_response(PVOUTPUT_BASE_URL + service, params)
+        if response is not None:
+            return response
+
+    attempt = 0
+    while True:
+        if pacer is not None:
+            pacer.wait()
+        try:
+            response = session.get(
+                PVOUTPUT_BASE_URL + service,
+                params=params,
+                headers={"X-Rate-Limit": "1"},
+                timeout=60,
+                stream=stream
+            )
+        except requests.RequestException as e:
+            if attempt == max_retries:
+                raise
+            print(f"Request to {service} failed: {e}. Retrying in {backoff_delay(attempt)}s...")
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+            continue
+
+        remaining, reset = parse_rate_limit_headers(response.headers)
+        if response.status_code == 403 and "Exceeded" in response.text:
+            # Over the hourly limit: wait for the reset and try again without using up a retry.
+            if pacer is None:
+                pacer = QuotaPacer()
+            pacer.exhausted(reset)
+            continue
+        if pacer is not None and remaining is not None:
+            pacer.update(remaining, reset)
+        if response.status_code >= 500 and attempt < max_retries:
+            print(f"Server error {response.status_code} from {service}. Retrying in {backoff_delay(attempt)}s...")
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+            continue
+        return response
+
+
+def get_elevation(lat_series, lon_series, grid_path=ELEVATION_GRID_PATH):
+    # Elevations come from the offline grid (see elevation_grid.build_grid). Points it does not cover are an error.
+    lat_series = pd.Series(lat_series).astype(float).reset_index(drop=True)
+    lon_series = pd.Series(lon_series).astype(float).reset_index(drop=True)
+    grid = elevation_grid.load_grid(grid_path)
+    if grid is None:
+        raise FileNotFoundError(f"There is no elevation grid at {grid_path}. Build it with "
+                                f"python -m solar_common.elevation_grid {grid_path}.")
+    elevations = pd.Series(grid.lookup(lat_series, lon_series))
+    missing = elevations.isna()
+    if missing.any():
+        points = list(zip(lat_series[missing], lon_series[missing]))
+        raise ValueError(f"The elevation grid at {grid_path} has no data for {len(points)} point(s), "
+                         f"e.g. {points[:5]}.")
+    return elevations
+
+
+def save_outputs_to_csv(system_ids, mode="info_only", filepath=None, max_workers=4, file_format="csv"):
     if mode not in ("info_only", "full"):
         print(f"Invalid mode: {mode}.")
         return
 
-    system_list = [get_system_info_from_id(sid) for sid in system_ids]
+    session = make_session(max_workers)
+    pacer = QuotaPacer()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        system_list = list(executor.map(lambda sid: get_system_info_from_id(sid, session, pacer), system_ids))
     system_df = pd.DataFrame(system_list)
     prepare_query_for_open_meteo(system_df)
 
     if filepath is None:
         filepath = f"PV_output_for_{len(system_ids)}_systems_{datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}.csv"
-    final_path = utils.safe_to_csv(system_df, filepath, index=False)
-    print(f"Saved CSV to {final_path}")
+    final_path = utils.safe_save(system_df, filepath, file_format=file_format, index=False)
+    print(f"Saved {file_format} to {final_path}")
 
     if mode == "info_only":
         print("Info only mode: saved system info without output data.")
         return system_df
 
-    pvoutput_df = append_output_data_to_file(final_path, system_df)
+    pvoutput_df = append_output_data_to_file(final_path, system_df, max_workers=max_workers, session=session, pacer=pacer,
+                                             file_format=file_format)
     return system_df, pvoutput_df
 
 
-def get_system_info_from_id(sid):
+def get_system_info_from_id(sid, session=None, pacer=None):
     columns = [
         "System ID",
         "System Name", "System Size", "Postcode/Zipcode",
@@ -63,12 +186,12 @@ def get_system_info_from_id(sid):
         "Status Interval",
         "Earliest Output Date", "Latest Output Date"
     ]
-    params = {**CREDENTIALS, "sid1": sid}
-    response = requests.get(PVOUTPUT_BASE_URL + "getsystem.jsp", params=params)
+    params = {"sid1": sid}
+    response = pvoutput_get("getsystem.jsp", params, session, pacer)
     #The text response is a list of values divided into sections by ";", of which only the
     #first section is needed, and then into individual values by ",".
     system_info = response.text.split(";")[0].split(",")[:16]
-    response = requests.get(PVOUTPUT_BASE_URL + "getstatistic.jsp", params=params)
+    response = pvoutput_get("getstatistic.jsp", params, session, pacer)
     start_date, end_date = [pd.to_datetime(date, format="%Y%m%d") for date in response.text.split(",")[7:9]]
 
     #Check the number of decimal places of latitude to differentiate between exact co-ordinates
@@ -83,12 +206,152 @@ def get_system_info_from_id(sid):
     return dict(zip(columns, system_info))
 
 
-def get_output_from_id(sid, start_date=0, end_date=0):
+def get_output_windows(sid, start_date, end_date):
+    # Set end_date to yesterday if it's today to prevent a partial day.
+    if end_date.date() == datetime.now().date():
+        print(f"End date for System ID {sid} is today. Subtracting one day to avoid partial output data.")
+        end_date = end_date - timedelta(days=1)
+
+    windows = []
+    current_date = start_date
+    while current_date <= end_date:
+        date_to = current_date + timedelta(days=149)
+        if date_to > end_date:
+            date_to = end_date
+        windows.append((current_date, date_to))
+        current_date += timedelta(days=150)
+    return windows
+
+
+def yyyymmdd_to_datetime64(values):
+    # Vectorised conversion of integer dates like 20240131, without going through strings.
+    values = np.asarray(values, dtype=np.int64)
+    years = (values // 10000 - 1970).astype("M8[Y]")
+    months = (values // 100 % 100 - 1).astype("m8[M]")
+    days = (values % 100 - 1).astype("m8[D]")
+    return (years + months + days).astype("M8[ns]")
+
+
+def parse_output_stream(chunks, sid, columns=OUTPUT_COLUMNS):
+    """
+    Parses a getoutput.jsp response body as it arrives, keeping only the requested columns.
+
+    Outputs are separated by ";" and their fields by ",". As soon as an output is complete, the fields
+    that are kept are converted and appended to typed arrays, so the body is never held as lists of strings.
+
+    Parameters:
+        chunks (iterable): The body as bytes, e.g. response.iter_content(8192).
+        sid (int): System ID, added as the first column.
+        columns (list): Columns of PVOUTPUT_DF_COLUMNS to keep. Default is OUTPUT_COLUMNS.
+
+    Returns:
+        pd.DataFrame: One row per output, newest first, or None if there are none.
+    """
+    columns = [column for column in columns if column != "System ID"]
+    # Field positions in the response, which does not include the System ID.
+    fields = [PVOUTPUT_DF_COLUMNS.index(column) - 1 for column in columns]
+    n_splits = max(fields) + 1
+    values = [array("l") if column == "Date" else [] if column in TEXT_COLUMNS else array("f") for column in columns]
+    converters = [int if column == "Date" else bytes.decode if column in TEXT_COLUMNS else float
+                  for column in columns]
+
+    def add(record):
+        parts = record.split(b",", n_splits)
+        if len(parts) < n_splits:
+            return
+        for field, convert, column_values in zip(fields, converters, values):
+            part = parts[field]
+            if convert is float and not part:
+                part = b"nan"
+            column_values.append(convert(part))
+
+    buffer = b""
+    for chunk in chunks:
+        buffer += chunk
+        *records, buffer = buffer.split(b";")
+        for record in records:
+            add(record)
+    if buffer.strip():
+        add(buffer.strip())
+
+    n_rows = len(values[0]) if values else 0
+    if n_rows == 0:
+        return None
+    data = {"System ID": np.full(n_rows, sid, dtype=np.int32)}
+    for column, column_values in zip(columns, values):
+        if column == "Date":
+            data[column] = yyyymmdd_to_datetime64(column_values)
+        elif column in TEXT_COLUMNS:
+            data[column] = pd.Categorical(column_values)
+        else:
+            data[column] = np.frombuffer(column_values, dtype=np.float32)
+    return schema.enforce(pd.DataFrame(data, copy=False), "pvoutput")
+
+
+def get_output_window(sid, date_from, date_to, session=None, pacer=None, columns=OUTPUT_COLUMNS, max_retries=3):
+    params = {
+        "sid1": sid,
+        "limit": "150",  # The maximum for donors: https://pvoutput.org/help/api_specification.html#id37
+        "df": date_from.strftime("%Y%m%d"),
+        "dt": date_to.strftime("%Y%m%d"),
+        "insolation": "1"
+    }
+
+    for attempt in range(max_retries + 1):
+        response = pvoutput_get("getoutput.jsp", params, session, pacer, stream=True)
+        try:
+            with response:
+                chunks = response.iter_content(chunk_size=8192)
+                first = next(chunks, b"")
+                if first.startswith(b"Bad request"):
+                    text = (first + b"".join(chunks)).decode()
+                    # Only "No outputs" means the window is empty. Anything else (a bad key or date, or a
+                    # limit) is raised, so the window is not recorded as fetched and is asked for again.
+                    if "No outputs" in text:
+                        return None
+                    raise ValueError(text)
+                return parse_output_stream(itertools.chain([first], chunks), sid, columns)
+        except requests.RequestException as e:
+            # The connection dropped while the body was being read.
+            if attempt == max_retries:
+                raise
+            print(f"Reading output for System ID {sid} failed: {e}. Retrying in {backoff_delay(attempt)}s...")
+            time.sleep(backoff_delay(attempt))
+
+
+def iter_output_windows(jobs, session=None, pacer=None, max_workers=4, columns=OUTPUT_COLUMNS,
+                        return_exceptions=False):
+    # jobs is a list of (sid, date_from, date_to). Yields (position in jobs, DataFrame or None) as each
+    # window arrives, so callers can handle windows one at a time instead of collecting them all.
+    # With return_exceptions, a window that failed yields its exception instead of raising it.
+    if session is None:
+        session = make_session(max_workers)
+    if pacer is None:
+        pacer = QuotaPacer()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(get_output_window, *job, session, pacer, columns): idx for idx, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            if return_exceptions and future.exception() is not None:
+                yield futures[future], future.exception()
+            else:
+                yield futures[future], future.result()
+
+
+def fetch_output_windows(jobs, session=None, pacer=None, max_workers=4, callback=None, columns=OUTPUT_COLUMNS,
+                         return_exceptions=False):
+    # Returns the DataFrames (or None) in the same order as jobs.
+    # If given, callback(job, df) is called from this thread as soon as each window arrives.
+    results = [None] * len(jobs)
+    for idx, df in iter_output_windows(jobs, session, pacer, max_workers, columns, return_exceptions):
+        results[idx] = df
+        if callback is not None:
+            callback(jobs[idx], df)
+    return results
+
+
+def get_output_from_id(sid, start_date=0, end_date=0, session=None, pacer=None, max_workers=4, columns=OUTPUT_COLUMNS):
     if not start_date or not end_date:
-        response = requests.get(
-            PVOUTPUT_BASE_URL + "getstatistic.jsp",
-            params={**CREDENTIALS, "sid1": sid}
-        )
+        response = pvoutput_get("getstatistic.jsp", {"sid1": sid}, session, pacer)
         if not start_date:
             if not end_date:
                 start_date, end_date = response.text.split(",")[7:9]
@@ -99,56 +362,10 @@ def get_output_from_id(sid, start_date=0, end_date=0):
         else:
             end_date = pd.to_datetime(response.text.split(",")[8], format="%Y%m%d")
 
-    pvoutput_df_columns = [
-        "System ID",
-        "Date",
-        "Energy Generated (Wh)",
-        "Efficiency (kWh/kW)",
-        "Energy Exported (Wh)",
-        "Energy Used (Wh)",
-        "Peak Power (W)",
-        "Peak Time",
-        "Condition",
-        "Min Temp (°C)",
-        "Max Temp (°C)",
-        "Peak Energy Import (Wh)",
-        "Off Peak Energy Import (Wh)",
-        "Shoulder Energy Import (Wh)",
-        "High Shoulder Energy Import (Wh)",
-        "Insolation (Wh)"
-    ]
-    pvoutput_dfs = []
-
-    # Set end_date to yesterday if it's today to prevent a partial day.
-    if end_date.date() == datetime.now().date():
-        print(f"End date for System ID {sid} is today. Subtracting one day to avoid partial output data.")
-        end_date = end_date - timedelta(days=1)
-    current_date = start_date
-    while current_date <= end_date:
-
-        date_from = current_date.strftime("%Y%m%d")
-        date_to = current_date + timedelta(days=149)
-        if date_to > end_date:
-            date_to = end_date
-        date_to = date_to.strftime("%Y%m%d")
-
-        params = {
-            **CREDENTIALS,
-            "sid1": sid,
-            "limit": "150",  # The maximum for donors: https://pvoutput.org/help/api_specification.html#id37
-            "df": date_from,
-            "dt": date_to,
-            "insolation": "1"
-        }
-
-        response = requests.get(PVOUTPUT_BASE_URL + "getoutput.jsp", params=params)
-        if "Bad request" != response.text[:11]:
-            response_df = pd.DataFrame([[sid] + row.split(",") for row in response.text.split(";")],
-                                       columns=pvoutput_df_columns
-                                       )
-            response_df["Date"] = pd.to_datetime(response_df["Date"])
-            pvoutput_dfs = [response_df] + pvoutput_dfs
-        current_date += timedelta(days=150)
+    jobs = [(sid, date_from, date_to) for date_from, date_to in get_output_windows(sid, start_date, end_date)]
+    # Each window is newest-first, so reverse the windows to keep the whole history newest-first.
+    pvoutput_dfs = [df for df in reversed(fetch_output_windows(jobs, session, pacer, max_workers, columns=columns))
+                    if df is not None]
 
     if pvoutput_dfs:
         return pd.concat(pvoutput_dfs, ignore_index=True)
@@ -172,25 +389,32 @@ def prepare_query_for_open_meteo(table_of_pv_systems, timezone_str="UTC", date_f
     return query
 
 
-def append_output_data_to_file(filepath, system_df=None, date_format="%d/%m/%Y"):
+def append_output_data_to_file(filepath, system_df=None, date_format="%d/%m/%Y", max_workers=4, session=None, pacer=None,
+                               file_format="csv", columns=OUTPUT_COLUMNS):
+    # With file_format="parquet", the output data is saved as its own dataset next to the system info
+    # (see output_data_path) instead of being appended to the same file.
     if system_df is None:
-        system_df = pd.read_csv(filepath, parse_dates=["Earliest Output Date", "Latest Output Date"], date_format=date_format)
+        system_df = utils.standardize_input(filepath, date_format=date_format)
 
-    system_ids = system_df["System ID"].tolist()
-
-    master_list = []
-    for sid in system_ids:
-        start_date = system_df.loc[system_df["System ID"] == sid, "Earliest Output Date"].iloc[0]
+    # Fan out the windows of every system over one worker pool, rather than one system at a time.
+    jobs = []
+    for sid, start_date, end_date in zip(system_df["System ID"], system_df["Earliest Output Date"], system_df["Latest Output Date"]):
         if start_date < OPEN_METEO_START_DATE:
             start_date = OPEN_METEO_START_DATE
-        end_date = system_df.loc[system_df["System ID"] == sid, "Latest Output Date"].iloc[0]
-        pvoutput_df = get_output_from_id(sid, start_date, end_date)
-        if pvoutput_df is not None:
-            master_list += [pvoutput_df]
+        jobs += [(sid, date_from, date_to) for date_from, date_to in reversed(get_output_windows(sid, start_date, end_date))]
+
+    master_list = [df for df in fetch_output_windows(jobs, session, pacer, max_workers, columns=columns) if df is not None]
 
     if master_list:
         master_df = pd.concat(master_list, ignore_index=True)
 
+        if file_format == "parquet":
+            partition_col, date_col = storage.PARTITIONS["pvoutput"]
+            final_path = utils.safe_save(master_df, output_data_path(filepath), file_format=file_format, overwrite=True,
+                                         partition_col=partition_col, date_col=date_col)
+            print(f"Saved output data to {final_path}")
+            return master_df
+
         with open(filepath, "a") as f:
             f.write("\n")
         final_path = utils.safe_to_csv(master_df, filepath, mode="a", index=False)
@@ -199,12 +423,13 @@ def append_output_data_to_file(filepath, system_df=None, date_format="%d/%m/%Y")
     print(f"No output data found. No changes made to {filepath}.")
 
 
+def output_data_path(filepath):
+    # Where the output data of a system info file is kept when it is not appended to the same file.
+    return os.path.splitext(filepath)[0] + "_output.parquet"
+
+
 def check_api_limit():
-    response = requests.get(
-        PVOUTPUT_BASE_URL + "getstatistic.jsp",
-        params=CREDENTIALS,
-        headers={"X-Rate-Limit": "1"}
-    )
+    response = pvoutput_get("getstatistic.jsp", {})
 
     for key, value in response.headers.items():
         if key.startswith("X-Rate-Limit"):
@@ -0,0 +1,144 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket.
+
+    Parameters:
+        capacity (float): Maximum number of tokens the bucket can hold.
+        period (float): Seconds it takes to refill an empty bucket to capacity.
+    """
+
+    def __init__(self, capacity, period):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost=1):
+        # A cost larger than the bucket can never be paid in one go, so only wait for a full bucket
+        # and let the tokens go negative. The debt is then paid off before the next acquire.
+        needed = min(cost, self.capacity)
+        with self.lock:
+            self._refill()
+            if self.tokens >= needed:
+                return 0.0
+            return (needed - self.tokens) / self.rate
+
+    def take(self, cost=1):
+        with self.lock:
+            self._refill()
+            self.tokens -= cost
+
+    def available(self):
+        # Tokens in the bucket now. Negative while a debt is being paid off.
+        with self.lock:
+            self._refill()
+            return self.tokens
+
+    def pause(self, seconds):
+        # Empty the bucket so nothing is let through for the given number of seconds.
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class RateLimiter:
+    """
+    Combines several token buckets, e.g. one counting requests and one counting API weight.
+    A call to acquire() blocks until every bucket can pay for the call.
+
+    Parameters:
+        buckets (dict): Maps a name to a (TokenBucket, cost_name) pair, where cost_name is the
+            keyword passed to acquire() that gives the cost for that bucket.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+
+    def acquire(self, **costs):
+        # Only one thread may wait for tokens at a time, so calls are let through in order.
+        with self.lock:
+            while True:
+                wait = max(
+                    bucket.wait_time(costs.get(cost_name, 1))
+                    for bucket, cost_name in self.buckets.values()
+                )
+                if wait <= 0:
+                    break
+                time.sleep(wait)
+            for bucket, cost_name in self.buckets.values():
+                bucket.take(costs.get(cost_name, 1))
+
+    def available(self, name):
+        return self.buckets[name][0].available()
+
+    def reserve(self, name, cost):
+        # Takes cost from one bucket without waiting, e.g. for calls made before a restart.
+        self.buckets[name][0].take(cost)
+
+    def pause(self, seconds):
+        for bucket, _ in self.buckets.values():
+            bucket.pause(seconds)
+
+
+def backoff_delay(attempt, base=1, cap=60):
+    return min(cap, base * 2 ** attempt)
+
+
+class QuotaPacer:
+    """
+    Spreads calls evenly over what is left of a quota window, using the remaining call count and
+    reset time reported by the API. When the quota runs out, calls wait until the reset time.
+
+    Parameters:
+        min_interval (float): Minimum number of seconds between calls.
+    """
+
+    def __init__(self, min_interval=0.0):
+        self.min_interval = min_interval
+        self.remaining = None
+        self.reset = None
+        self.last_call = 0.0
+        self.lock = threading.Lock()
+
+    def update(self, remaining, reset):
+        with self.lock:
+            self.remaining = remaining
+            self.reset = reset
+
+    def exhausted(self, reset=None):
+        with self.lock:
+            self.remaining = 0
+            if reset is not None:
+                self.reset = reset
+            elif self.reset is None or self.reset < time.time():
+                # Without a reset time, assume the quota is hourly.
+                self.reset = time.time() + 3600
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            interval = self.min_interval
+            if self.remaining is not None and self.reset is not None and self.reset > now:
+                if self.remaining <= 0:
+                    print(f"API limit reached. Waiting until {time.strftime('%H:%M:%S', time.localtime(self.reset))} for it to reset...")
+                    time.sleep(self.reset - now + 1)
+                    self.remaining = None
+                    self.reset = None
+                else:
+                    interval = max(interval, (self.reset - now) / self.remaining)
+                    self.remaining -= 1
+            delay = self.last_call + interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.last_call = time.time()
@@ -0,0 +1,156 @@
+import sys
+
+import numpy as np
+import pandas as pd
+
+from solar_common import features
+
+
+# Declared dtypes of the PVOutput, weather and merged tables. Every loader and builder in build_dataset
+# casts to these with enforce(). Columns not listed get the table's default if they are numeric, which
+# covers the Open-Meteo variables and the PVOutput energy columns.
+SCHEMAS = {
+    "pvoutput": {
+        "System ID": "int32",
+        "Date": "datetime64[ns]",
+        "Efficiency (kWh/kW)": "float32",
+        "Peak Time": "category",
+        "Condition": "category"
+    },
+    "weather": {
+        "id": "int32",
+        "date": "datetime64[ns]"
+    },
+    "dataset": {
+        # The merged table is not joined on again, so the System ID can be a categorical.
+        "System ID": "category",
+        "Date": "datetime64[ns]",
+        "Efficiency (kWh/kW)": "float32",
+        "Elevation (m)": "float32",
+        **{col: "bool" for col in features.WEATHER_DUMMIES}
+    }
+}
+DEFAULT_DTYPE = "float32"
+# Columns that must be there, and must have no missing values.
+KEYS = {
+    "pvoutput": ("System ID", "Date"),
+    "weather": ("id", "date"),
+    "dataset": ("System ID", "Date")
+}
+
+
+def column_dtype(table, column, current=None):
+    # The declared dtype of a column, or None to leave it as it is (e.g. a text column that is not declared).
+    declared = SCHEMAS[table].get(column)
+    if declared is not None:
+        return declared
+    if current is None or pd.api.types.is_numeric_dtype(current) and not pd.api.types.is_bool_dtype(current):
+        return DEFAULT_DTYPE
+    return None
+
+
+def matches(dtype, declared):
+    if declared == "category":
+        return isinstance(dtype, pd.CategoricalDtype)
+    return str(dtype) == declared
+
+
+def enforce(df, table):
+    """
+    Casts the columns of df to the schema of table. Columns that already match are not copied.
+
+    Parameters:
+        df (pd.DataFrame): The data.
+        table (str): "pvoutput", "weather" or "dataset".
+
+    Returns:
+        pd.DataFrame: The data with the declared dtypes.
+    """
+    casts = {}
+    for col, dtype in df.dtypes.items():
+        declared = column_dtype(table, col, dtype)
+        if declared is not None and not matches(dtype, declared):
+            casts[col] = declared
+    return df.astype(casts) if casts else df
+
+
+def read_csv(filepath, table, **kwargs):
+    # Reads a CSV straight into the schema's dtypes, without going through float64 and object columns first.
+    header = kwargs.get("header", "infer")
+    columns = pd.read_csv(filepath, nrows=0, header=header, usecols=kwargs.get("usecols")).columns
+    dtypes = {}
+    dates = []
+    for col in columns:
+        declared = column_dtype(table, col)
+        if declared.startswith("datetime64"):
+            dates.append(col)
+        elif declared != "category":
+            # read_csv would make categories of strings, so categoricals are made by enforce() instead.
+            dtypes[col] = declared
+    df = pd.read_csv(filepath, dtype=dtypes, parse_dates=dates, **kwargs)
+    if isinstance(df, pd.DataFrame):
+        return enforce(df, table)
+    return (enforce(chunk, table) for chunk in df)  # with chunksize
+
+
+def validate(df, table):
+    """
+    Checks that df follows the schema of table: the key columns are there and have no missing values,
+    and every column has its declared dtype.
+
+    Raises:
+        ValueError: Listing every problem found.
+
+    Returns:
+        pd.DataFrame: df, unchanged.
+    """
+    problems = []
+    for col in KEYS[table]:
+        if col not in df:
+            problems.append(f"missing column {col!r}")
+        elif df[col].isna().any():
+            problems.append(f"{df[col].isna().sum()} missing values in {col!r}")
+    for col, dtype in df.dtypes.items():
+        declared = column_dtype(table, col, dtype)
+        if declared is not None and not matches(dtype, declared):
+            problems.append(f"{col!r} is {dtype}, not {declared}")
+    if problems:
+        raise ValueError(f"The {table} table does not match its schema: " + "; ".join(problems) + ".")
+    return df
+
+
+def memory_report(df, name="DataFrame", by_column=False):
+    """
+    Prints the memory used by df, in total and per row, and optionally per column from largest to smallest.
+
+    Returns:
+        int: Bytes used, including the contents of object and string columns.
+    """
+    usage = df.memory_usage(deep=True, index=True)
+    total = int(usage.sum())
+    print(f"{name}: {len(df)} rows x {df.shape[1]} columns, {total / 2 ** 20:.1f} MiB "
+          f"({total / max(len(df), 1):.0f} bytes/row)")
+    if by_column:
+        for col, size in usage.drop("Index").sort_values(ascending=False).items():
+            print(f"    {col:<40} {str(df[col].dtype):<16} {size / 2 ** 20:8.2f} MiB")
+    return total
+
+
+if __name__ == "__main__":
+    # Usage: python -m build_dataset.schema data/The_Dataset_v1-2.csv [dataset|pvoutput|weather]
+    # Compares the memory of a CSV loaded with pandas' default dtypes and with the schema, and validates it.
+    from . import data_cleaning
+
+    path = sys.argv[1] if len(sys.argv) > 1 else "data/The_Dataset_v1-2.csv"
+    table = sys.argv[2] if len(sys.argv) > 2 else "dataset"
+    date_col = KEYS[table][1]
+    default = pd.read_csv(path, parse_dates=[date_col])
+    compact = validate(read_csv(path, table), table)
+    before = memory_report(default, "Default dtypes", by_column=True)
+    after = memory_report(compact, "Schema dtypes", by_column=True)
+    print(f"{before / after:.1f}x smaller.")
+    if table == "dataset":
+        memory_report(data_cleaning.weather_code_to_category(data_cleaning.clean_dataset(compact)),
+                      "Cleaned for training")
+    np.testing.assert_allclose(compact.select_dtypes("number").to_numpy(np.float64),
+                               default[compact.select_dtypes("number").columns].to_numpy(np.float64), rtol=1e-6)
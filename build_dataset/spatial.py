@@ -0,0 +1,36 @@
+import numpy as np
+
+
+# Roughly the spacing of the UK Met Office 2 km model that Open-Meteo uses for the UK, in degrees.
+# Systems in the same cell of this size share one weather fetch (see openmeteo.group_locations_by_cell).
+GRID_RESOLUTION = 0.02
+
+
+def grid_cell_keys(latitudes, longitudes, resolution=GRID_RESOLUTION):
+    """
+    Snaps coordinates to a regular lat/lon grid.
+
+    Parameters:
+        latitudes (array-like): Latitudes in degrees.
+        longitudes (array-like): Longitudes in degrees.
+        resolution (float): Size of a grid cell in degrees.
+
+    Returns:
+        list: One (row, column) tuple of ints per coordinate, identifying its grid cell.
+    """
+    rows = np.floor(np.asarray(latitudes, dtype=float) / resolution).astype(int)
+    cols = np.floor(np.asarray(longitudes, dtype=float) / resolution).astype(int)
+    return list(zip(rows.tolist(), cols.tolist()))
+
+
+def group_by_cell(latitudes, longitudes, resolution=GRID_RESOLUTION):
+    """
+    Groups coordinates by grid cell.
+
+    Returns:
+        dict: Maps each (row, column) cell to the positions of the coordinates inside it, in input order.
+    """
+    groups = {}
+    for position, key in enumerate(grid_cell_keys(latitudes, longitudes, resolution)):
+        groups.setdefault(key, []).append(position)
+    return groups
@@ -0,0 +1,111 @@
+import os
+import shutil
+import uuid
+
+import pandas as pd
+
+
+FILE_FORMATS = ("csv", "parquet")
+# Default partitioning of each table. The date column is used for the optional month partition.
+PARTITIONS = {
+    "systems": (None, None),
+    "pvoutput": ("System ID", "Date"),
+    "weather": ("id", "date"),
+    "dataset": ("System ID", "Date")
+}
+MAX_PARTITIONS = 1_000_000
+
+
+def is_parquet_path(path):
+    return path.endswith(".parquet") or os.path.isdir(path)
+
+
+def write_parquet(df: pd.DataFrame, path: str, partition_col=None, date_col=None, by_month=False, mode="w"):
+    """
+    Writes a DataFrame as a Parquet dataset, optionally partitioned by an ID column and by month.
+
+    Parameters:
+        df (pd.DataFrame): The DataFrame to save.
+        path (str): Directory of the dataset.
+        partition_col (str): Column to partition by, e.g. "System ID". Default is no partitioning.
+        date_col (str): Date column used to derive the "month" partition when by_month is True.
+        by_month (bool): Whether to also partition by month. Default is False.
+        mode (str): "w" replaces the whole dataset, "a" adds files to it.
+
+    Returns:
+        str: The path the dataset was saved to.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    partition_cols = []
+    if partition_col is not None:
+        partition_cols.append(partition_col)
+    if by_month and date_col is not None:
+        df = df.assign(month=df[date_col].dt.strftime("%Y-%m"))
+        partition_cols.append("month")
+
+    if mode == "w" and os.path.exists(path):
+        shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_to_dataset(
+        table,
+        path,
+        partition_cols=partition_cols or None,
+        # A unique name per write lets appends add files next to the existing ones.
+        basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        # pyarrow refuses to write more than 1024 partitions at once by default, i.e. more than 1024 systems.
+        max_partitions=MAX_PARTITIONS
+    )
+    return path
+
+
+def read_parquet(path: str, columns=None, filters=None):
+    """
+    Reads a Parquet dataset, only loading the requested columns and partitions/row groups.
+
+    Parameters:
+        path (str): Directory or file of the dataset.
+        columns (list): Columns to load. Default is all columns.
+        filters (list): pyarrow filters pushed down to the reader, e.g. [("System ID", "in", [5242, 11542])].
+
+    Returns:
+        pd.DataFrame: The data.
+    """
+    df = pd.read_parquet(path, engine="pyarrow", columns=columns, filters=filters)
+    # Partition columns come back as categoricals, so restore their original type.
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(df[col].cat.categories.dtype)
+    return df.drop(columns=["month"], errors="ignore")
+
+
+def partition_values(path, partition_col):
+    # Values of partition_col in a dataset written by write_parquet, from its directory names, without opening any files.
+    if not os.path.isdir(path):
+        return []
+    prefix = f"{partition_col}="
+    return [name[len(prefix):] for name in os.listdir(path) if name.startswith(prefix)]
+
+
+def read_partition(path, partition_col, value, columns=None):
+    """
+    Reads one partition of a dataset written by write_parquet, opening its files directly.
+    For small partitions this is several times faster than read_parquet, which has to discover the dataset.
+    Files are read in the order they were written, so appended rows come last.
+
+    Returns:
+        pd.DataFrame: The data, with partition_col set to value.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    directory = os.path.join(path, f"{partition_col}={value}")
+    files = [os.path.join(root, name) for root, _, names in os.walk(directory) for name in names
+             if name.endswith(".parquet")]
+    file_columns = None if columns is None else [col for col in columns if col != partition_col]
+    tables = [pq.ParquetFile(file).read(columns=file_columns) for file in sorted(files, key=os.path.getmtime)]
+    df = pa.concat_tables(tables).to_pandas()
+    df.insert(0, partition_col, value)
+    return df if columns is None else df[columns]
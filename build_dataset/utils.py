@@ -1,11 +1,16 @@
 import os
+import sys
 
 import pandas as pd
 
+from . import storage
+
 
 def standardize_input(input_df_or_path, date_format):
     if isinstance(input_df_or_path, pd.DataFrame):
         df = input_df_or_path
+    elif isinstance(input_df_or_path, str) and storage.is_parquet_path(input_df_or_path):
+        df = storage.read_parquet(input_df_or_path)
     elif isinstance(input_df_or_path, str):
         print(f"Assuming that {input_df_or_path} is the name of a file...")
         with open(input_df_or_path, "r") as file:
@@ -45,15 +50,61 @@ def safe_to_csv(df: pd.DataFrame, filepath: str, overwrite=False, **kwargs):
 
     # Create a unique filename if necessary
     if os.path.isfile(filepath) and not overwrite and kwargs.get("mode", "w") != "a":
-        base, ext = os.path.splitext(filepath)
-        counter = 1
-        new_filepath = f"{base}({counter}){ext}"
-        while os.path.isfile(new_filepath):
-            counter += 1
-            new_filepath = f"{base}({counter}){ext}"
-        filepath = new_filepath
+        filepath = unique_path(filepath)
 
     # Save to CSV
     df.to_csv(filepath, **kwargs)
 
     return filepath
+
+
+def unique_path(filepath):
+    base, ext = os.path.splitext(filepath)
+    counter = 1
+    new_filepath = f"{base}({counter}){ext}"
+    while os.path.exists(new_filepath):
+        counter += 1
+        new_filepath = f"{base}({counter}){ext}"
+    return new_filepath
+
+
+def safe_save(df: pd.DataFrame, filepath: str, file_format="csv", overwrite=False, partition_col=None, date_col=None,
+              by_month=False, **kwargs):
+    """
+    Saves a DataFrame safely as CSV or as a Parquet dataset.
+
+    Parameters:
+        df (pd.DataFrame): The DataFrame to save.
+        filepath (str): Path to save to. For Parquet, the extension is replaced with ".parquet".
+        file_format (str): "csv" or "parquet". Default is "csv".
+        overwrite (bool): Whether to overwrite an existing file. Default is False.
+        partition_col (str): Parquet only. Column to partition the dataset by, e.g. "System ID".
+        date_col (str): Parquet only. Date column used for the month partition.
+        by_month (bool): Parquet only. Whether to also partition by month. Default is False.
+        **kwargs: Keyword arguments passed to pandas.DataFrame.to_csv(). Only "mode" is used for Parquet.
+
+    Returns:
+        str: The final path the file was saved to.
+    """
+    if file_format == "csv":
+        return safe_to_csv(df, filepath, overwrite=overwrite, **kwargs)
+    if file_format != "parquet":
+        raise ValueError(f"file_format must be one of {storage.FILE_FORMATS}, not {file_format}.")
+
+    filepath = os.path.splitext(filepath)[0] + ".parquet"
+    mode = kwargs.get("mode", "w")
+    if os.path.exists(filepath) and not overwrite and mode != "a":
+        filepath = unique_path(filepath)
+    return storage.write_parquet(df, filepath, partition_col=partition_col, date_col=date_col, by_month=by_month,
+                                 mode=mode)
+
+
+def peak_memory_mib():
+    # Peak resident memory of this process so far, or None where the resource module is not available (Windows).
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere.
+    return peak / 1048576 if sys.platform == "darwin" else peak / 1024
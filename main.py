@@ -1,4 +1,4 @@
-from build_dataset import pvoutput, openmeteo, combine_data
+from build_dataset import http_cache, pipeline
 
 
 SYSTEM_IDS = [  # Example system IDs to demonstrate making a dataset
@@ -7,10 +7,12 @@ SYSTEM_IDS = [  # Example system IDs to demonstrate making a dataset
 
 
 def main():
-    # This will fetch data from pvoutput.org, then open-meteo.com, combine them and save it as "dataset.csv" to folder "data"
-    system_df, pvoutput_df = pvoutput.save_outputs_to_csv(SYSTEM_IDS, mode="full", filepath="data/pvoutput.csv")
-    weather_df = openmeteo.get_weather_for_locations(system_df, filepath="data/weather.csv")
-    combine_data.combine_weather_and_pvoutput(weather_df, pvoutput_df, "data/dataset.csv")
+    # This will fetch data from pvoutput.org and open-meteo.com, combine them and save it as "dataset.csv" to folder "data".
+    # Only the dates not already fetched by a previous run are downloaded (see data/manifest.sqlite).
+    # API responses are cached in data/http_cache.sqlite, so historical windows are never downloaded twice.
+    # PVOutput, Open-Meteo and the join run at the same time (see build_dataset.pipeline).
+    http_cache.enable("data/http_cache.sqlite")
+    pipeline.build(SYSTEM_IDS, data_dir="data")
 
 
 if __name__ == '__main__':
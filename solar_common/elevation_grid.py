@@ -0,0 +1,196 @@
+import json
+import math
+import os
+import sys
+
+import numpy as np
+
+
+# Covers the map bounds that webapp/static/script.js allows clicks in.
+UK_BOUNDS = (49.5, 61.0, -11.0, 2.0)  # min lat, max lat, min lon, max lon
+# About 1.1 km north-south and 0.6 km east-west in the UK.
+RESOLUTION = 0.01
+MISSING = np.iinfo(np.int16).min
+OPEN_ELEVATION_URL = "https://api.open-elevation.com/api/v1/lookup"
+
+
+def meta_path(filepath):
+    return os.path.splitext(filepath)[0] + ".json"
+
+
+def sea_path(filepath):
+    return os.path.splitext(filepath)[0] + ".sea.npy"
+
+
+def sea_mask(grid):
+    """
+    Works out which points of an elevation grid are sea. open-elevation.com reports 0 m over the sea, so the
+    sea is taken to be the 0 m points joined to the edge of the grid by other 0 m points. Land below sea level,
+    like the Fens, and land at 0 m that is surrounded by higher ground are not sea.
+
+    Returns:
+        np.ndarray: Boolean array of the shape of grid, True at sea.
+    """
+    from scipy import ndimage
+
+    labels, _ = ndimage.label(np.asarray(grid) == 0)
+    edge = np.unique(np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]]))
+    return np.isin(labels, edge[edge > 0])
+
+
+class ElevationGrid:
+    """
+    Elevation raster (int16 metres) on a regular lat/lon grid, memory-mapped read-only from a .npy file, with
+    a .json file of metadata and a .sea.npy land/sea mask next to it. Lookups use bilinear interpolation.
+
+    Parameters:
+        filepath (str): Path of the .npy file.
+    """
+
+    def __init__(self, filepath):
+        with open(meta_path(filepath)) as f:
+            meta = json.load(f)
+        self.min_lat, self.max_lat, self.min_lon, self.max_lon = meta["bounds"]
+        self.resolution = meta["resolution"]
+        self.grid = np.load(filepath, mmap_mode="r")
+        self.n_rows, self.n_cols = self.grid.shape
+        if os.path.isfile(sea_path(filepath)):
+            self.sea = np.load(sea_path(filepath), mmap_mode="r")
+        else:
+            print(f"{sea_path(filepath)} is missing, so the sea is worked out from {filepath}.")
+            self.sea = sea_mask(self.grid)
+
+    def lookup(self, lat, lon):
+        """
+        Vectorised lookup for arrays or pandas Series of coordinates.
+
+        Returns:
+            np.ndarray: Elevations in metres, NaN outside the grid or where the grid has no data.
+        """
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        y = (lat - self.min_lat) / self.resolution
+        x = (lon - self.min_lon) / self.resolution
+        inside = (y >= 0) & (y <= self.n_rows - 1) & (x >= 0) & (x <= self.n_cols - 1)
+
+        y = np.where(inside, y, 0)
+        x = np.where(inside, x, 0)
+        row = np.minimum(np.floor(y).astype(np.intp), self.n_rows - 2)
+        col = np.minimum(np.floor(x).astype(np.intp), self.n_cols - 2)
+        dy = y - row
+        dx = x - col
+
+        corners = [self.grid[row + i, col + j].astype(np.float64) for i in (0, 1) for j in (0, 1)]
+        missing = np.zeros(lat.shape, dtype=bool)
+        for corner in corners:
+            missing |= corner == MISSING
+        top = corners[0] * (1 - dx) + corners[1] * dx
+        bottom = corners[2] * (1 - dx) + corners[3] * dx
+        elevation = top * (1 - dy) + bottom * dy
+        return np.where(inside & ~missing, elevation, np.nan)
+
+    def lookup_one(self, lat, lon):
+        # Scalar version of lookup() without NumPy array overhead, for single requests in the webapp.
+        y = (lat - self.min_lat) / self.resolution
+        x = (lon - self.min_lon) / self.resolution
+        if not (0 <= y <= self.n_rows - 1 and 0 <= x <= self.n_cols - 1):
+            return math.nan
+        row = min(int(y), self.n_rows - 2)
+        col = min(int(x), self.n_cols - 2)
+        dy = y - row
+        dx = x - col
+        z00, z01 = int(self.grid[row, col]), int(self.grid[row, col + 1])
+        z10, z11 = int(self.grid[row + 1, col]), int(self.grid[row + 1, col + 1])
+        if MISSING in (z00, z01, z10, z11):
+            return math.nan
+        return (z00 * (1 - dx) + z01 * dx) * (1 - dy) + (z10 * (1 - dx) + z11 * dx) * dy
+
+    def is_sea(self, lat, lon):
+        """
+        Vectorised land/sea mask, from the grid point nearest to each coordinate.
+
+        Returns:
+            np.ndarray: True where the nearest grid point is sea. False outside the grid.
+        """
+        row = np.rint((np.asarray(lat, dtype=np.float64) - self.min_lat) / self.resolution)
+        col = np.rint((np.asarray(lon, dtype=np.float64) - self.min_lon) / self.resolution)
+        inside = (row >= 0) & (row < self.n_rows) & (col >= 0) & (col < self.n_cols)
+        row = np.where(inside, row, 0).astype(np.intp)
+        col = np.where(inside, col, 0).astype(np.intp)
+        return inside & self.sea[row, col]
+
+
+_grids = {}
+
+
+def load_grid(filepath):
+    # Returns the grid at filepath, or None if it has not been built. Grids are only opened once per process.
+    if filepath not in _grids:
+        _grids[filepath] = ElevationGrid(filepath) if os.path.isfile(filepath) else None
+    return _grids[filepath]
+
+
+def save_grid(filepath, grid, bounds, resolution):
+    # Saves a complete grid, e.g. one made from another elevation source, with its metadata and sea mask.
+    np.save(filepath, np.asarray(grid, dtype=np.int16))
+    with open(meta_path(filepath), "w") as f:
+        json.dump({"bounds": list(bounds), "resolution": resolution}, f)
+    np.save(sea_path(filepath), sea_mask(grid))
+    return filepath
+
+
+def build_grid(filepath, bounds=UK_BOUNDS, resolution=RESOLUTION, batch_size=1000):
+    """
+    Builds the elevation grid by sampling open-elevation.com once at every grid point. This takes
+    thousands of requests, so rows are written straight into the memory-mapped file, and rows that
+    are already filled are skipped when it is run again after an interruption. The sea mask is saved
+    once every row is filled.
+
+    Parameters:
+        filepath (str): Path of the .npy file to create.
+        bounds (tuple): (min lat, max lat, min lon, max lon) in degrees.
+        resolution (float): Grid spacing in degrees.
+        batch_size (int): Number of points per request.
+    """
+    import requests
+
+    min_lat, max_lat, min_lon, max_lon = bounds
+    n_rows = int(round((max_lat - min_lat) / resolution)) + 1
+    n_cols = int(round((max_lon - min_lon) / resolution)) + 1
+    lats = min_lat + np.arange(n_rows) * resolution
+    lons = min_lon + np.arange(n_cols) * resolution
+
+    directory = os.path.dirname(filepath)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    if os.path.isfile(filepath):
+        grid = np.load(filepath, mmap_mode="r+")
+    else:
+        grid = np.lib.format.open_memmap(filepath, mode="w+", dtype=np.int16, shape=(n_rows, n_cols))
+        grid[:] = MISSING
+    with open(meta_path(filepath), "w") as f:
+        json.dump({"bounds": [min_lat, max_lat, min_lon, max_lon], "resolution": resolution}, f)
+
+    session = requests.Session()
+    rows_per_batch = max(1, batch_size // n_cols)
+    for start in range(0, n_rows, rows_per_batch):
+        rows = [row for row in range(start, min(start + rows_per_batch, n_rows)) if (grid[row] == MISSING).any()]
+        if not rows:
+            continue
+        locations = [{"latitude": round(float(lats[row]), 5), "longitude": round(float(lon), 5)}
+                     for row in rows for lon in lons]
+        response = session.post(OPEN_ELEVATION_URL, json={"locations": locations}, timeout=120)
+        response.raise_for_status()
+        elevations = np.array([result["elevation"] for result in response.json()["results"]])
+        grid[rows] = np.clip(elevations, MISSING + 1, 32767).reshape(len(rows), n_cols)
+        grid.flush()
+        print(f"Filled rows {rows[0]}-{rows[-1]} of {n_rows}.")
+
+    np.save(sea_path(filepath), sea_mask(grid))
+    print(f"Saved {filepath} and its sea mask.")
+    return filepath
+
+
+if __name__ == "__main__":
+    # Usage: python -m solar_common.elevation_grid data/uk_elevation.npy
+    build_grid(sys.argv[1] if len(sys.argv) > 1 else "data/uk_elevation.npy")
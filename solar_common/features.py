@@ -0,0 +1,164 @@
+import sys
+import time
+
+import numpy as np
+
+
+# WMO weather codes, as used by Open-Meteo, grouped into the categories the model was trained on.
+WEATHER_CATEGORIES = {
+    0: 'clear',
+    1: 'partly_cloudy', 2: 'partly_cloudy',
+    3: 'overcast',
+    45: 'fog', 48: 'fog',
+    51: 'drizzle', 53: 'drizzle', 55: 'drizzle', 56: 'drizzle', 57: 'drizzle',
+    61: 'rain', 63: 'rain', 65: 'rain', 66: 'rain', 67: 'rain',
+    71: 'snow', 73: 'snow', 75: 'snow', 77: 'snow', 85: 'snow', 86: 'snow',
+    80: 'rain_showers', 81: 'rain_showers', 82: 'rain_showers',
+    95: 'thunderstorm', 96: 'thunderstorm', 99: 'thunderstorm'
+}
+# "clear" is the reference category, so it has no column of its own.
+WEATHER_DUMMIES = [
+    'weather_category_partly_cloudy',
+    'weather_category_overcast',
+    'weather_category_fog',
+    'weather_category_drizzle',
+    'weather_category_rain',
+    'weather_category_snow',
+    'weather_category_rain_showers',
+    'weather_category_thunderstorm'
+]
+MAX_WEATHER_CODE = 99
+# Range of each raw daily weather variable in the UK, for synthetic data: the warm-up batch that checks a model
+# before it is served, the benchmarks and the refresh comparison. weather_code is drawn from WEATHER_CATEGORIES.
+WEATHER_RANGES = {
+    "surface_pressure_mean": (980, 1040),
+    "sunshine_duration": (0, 50000),
+    "daylight_duration": (28000, 60000),
+    "precipitation_sum": (0, 20),
+    "precipitation_hours": (0, 24),
+    "wind_direction_10m_dominant": (0, 360),
+    "cloud_cover_mean": (0, 101),
+    "cloud_cover_min": (0, 100),
+    "temperature_2m_mean": (-5, 25),
+    "relative_humidity_2m_min": (30, 100),
+    "wind_speed_10m_mean": (0, 40),
+    "shortwave_radiation_sum": (0, 30)
+}
+
+
+def _one_hot_table():
+    # Row i is the one-hot encoding of weather code i. The extra last row (all zeros) is used for
+    # missing and unknown codes, which is what pd.get_dummies gave them.
+    table = np.zeros((MAX_WEATHER_CODE + 2, len(WEATHER_DUMMIES)), dtype=np.float32)
+    for code, category in WEATHER_CATEGORIES.items():
+        column = f"weather_category_{category}"
+        if column in WEATHER_DUMMIES:
+            table[code, WEATHER_DUMMIES.index(column)] = 1
+    return table
+
+
+ONE_HOT = _one_hot_table()
+DUMMY_INDEX = {column: i for i, column in enumerate(WEATHER_DUMMIES)}
+
+
+def weather_code_rows(codes):
+    # Row of ONE_HOT for each weather code.
+    codes = np.asarray(codes, dtype=np.float64)
+    valid = (codes >= 0) & (codes <= MAX_WEATHER_CODE)
+    return np.where(valid, codes, MAX_WEATHER_CODE + 1).astype(np.intp)
+
+
+def synthetic_weather(n_rows, rng, names=None):
+    # {variable: float64 array} drawn uniformly from WEATHER_RANGES. Default is weather_code and every variable.
+    if names is None:
+        names = ["weather_code"] + list(WEATHER_RANGES)
+    codes = np.array(list(WEATHER_CATEGORIES), dtype=np.float64)
+    return {name: rng.choice(codes, n_rows) if name == "weather_code"
+            else rng.uniform(*WEATHER_RANGES.get(name, (0, 100)), n_rows) for name in names}
+
+
+def build_matrix(data, feature_names, clean=True):
+    """
+    Builds the model inputs straight from raw weather columns, with the same cleaning and weather
+    categories as the training data: rows with missing values or cloud_cover_min of -1 are dropped,
+    and cloud_cover_mean is clipped to 100.
+
+    Parameters:
+        data (DataFrame or dict): Columns of raw data. Needs "weather_code" and every feature that is
+            not a weather category.
+        feature_names (list): Columns of the output, usually rf.feature_names_in_.
+        clean (bool): Drop and clip rows like data_cleaning.clean_dataset. Default is True.
+
+    Returns:
+        tuple: (float32 array of shape (rows kept, features), boolean mask of the rows kept)
+    """
+    codes = np.asarray(data["weather_code"], dtype=np.float32)
+    one_hot = ONE_HOT[weather_code_rows(codes)]
+    # Filled column by column, so a column-major array avoids strided writes.
+    X = np.empty((len(codes), len(feature_names)), dtype=np.float32, order="F")
+    raw = []
+    for i, name in enumerate(feature_names):
+        if name in DUMMY_INDEX:
+            X[:, i] = one_hot[:, DUMMY_INDEX[name]]
+        else:
+            X[:, i] = data[name]
+            raw.append(i)
+
+    keep = np.ones(len(codes), dtype=bool)
+    if clean:
+        keep = ~np.isnan(codes)
+        for i in raw:
+            keep &= ~np.isnan(X[:, i])
+        if "cloud_cover_min" in data:
+            keep &= np.asarray(data["cloud_cover_min"]) != -1
+        for i, name in enumerate(feature_names):
+            if name == "cloud_cover_mean":
+                np.minimum(X[:, i], 100, out=X[:, i])
+    X = X[keep] if not keep.all() else X
+    return np.ascontiguousarray(X), keep
+
+
+if __name__ == "__main__":
+    # Usage: python -m solar_common.features [data/The_Dataset_v1-2.csv]
+    # Compares build_matrix with the pandas path it replaced, on a full dataset and on one 7-day forecast.
+    import pandas as pd
+
+    def pandas_features(data, feature_names):
+        data = data.dropna().copy()
+        data['cloud_cover_mean'] = data['cloud_cover_mean'].clip(upper=100)
+        data = data[data['cloud_cover_min'] != -1]
+        data['weather_category'] = data['weather_code'].map(WEATHER_CATEGORIES)
+        data = pd.get_dummies(data, columns=['weather_category'], drop_first=False)
+        for col in WEATHER_DUMMIES:
+            if col not in data.columns:
+                data[col] = False
+        return data[feature_names].to_numpy(dtype=np.float32)
+
+    if len(sys.argv) > 1:
+        dataset = pd.read_csv(sys.argv[1])
+    else:
+        rng = np.random.default_rng(0)
+        n_rows = 1_000_000
+        dataset = pd.DataFrame({"Elevation (m)": rng.uniform(0, 400, n_rows), **synthetic_weather(n_rows, rng)})
+        # Cleaning drops rows with a cloud_cover_min of -1.
+        dataset["cloud_cover_min"] = rng.integers(-1, 100, n_rows).astype(np.float64)
+    feature_names = [column for column in dataset.columns
+                     if column not in ("weather_code", "Date", "System ID", "Efficiency (kWh/kW)")]
+    feature_names += WEATHER_DUMMIES
+
+    for name, data, repeats in (("Full dataset", dataset, 3), ("7-row forecast", dataset.head(7), 1000)):
+        expected = pandas_features(data, feature_names)
+        actual, _ = build_matrix(data, feature_names)
+        if not np.array_equal(actual, expected):
+            raise ValueError(f"{name}: build_matrix does not match the pandas features.")
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            pandas_features(data, feature_names)
+        pandas_time = (time.perf_counter() - start) / repeats
+        start = time.perf_counter()
+        for _ in range(repeats):
+            build_matrix(data, feature_names)
+        numpy_time = (time.perf_counter() - start) / repeats
+        print(f"{name} ({len(data)} rows): pandas {pandas_time * 1000:.2f} ms, "
+              f"build_matrix {numpy_time * 1000:.2f} ms ({pandas_time / numpy_time:.1f}x faster).")
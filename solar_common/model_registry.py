@@ -0,0 +1,127 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import joblib
+
+
+# A registry is a directory with one subdirectory per model version, and a file "current" naming the one served.
+MODEL_FILE = "model.pkl"
+META_FILE = "meta.json"
+POINTER = "current"
+
+
+def new_version():
+    # Versions sort in the order they were published.
+    return datetime.now().strftime("v%Y%m%d-%H%M%S")
+
+
+def model_path(registry, version):
+    return os.path.join(registry, version, MODEL_FILE)
+
+
+def current_version(registry):
+    # The version being served, or None if nothing has been published.
+    try:
+        with open(os.path.join(registry, POINTER)) as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return version or None
+
+
+def read_meta(registry, version):
+    with open(os.path.join(registry, version, META_FILE)) as f:
+        return json.load(f)
+
+
+def list_versions(registry):
+    if not os.path.isdir(registry):
+        return []
+    return sorted(name for name in os.listdir(registry)
+                  if os.path.isfile(os.path.join(registry, name, META_FILE)))
+
+
+def set_current(registry, version):
+    # Points the registry at a published version (e.g. to roll back), replacing the pointer atomically.
+    if not os.path.isfile(os.path.join(registry, version, META_FILE)):
+        raise ValueError(f"Version {version} is not in {registry}.")
+    pointer = os.path.join(registry, POINTER)
+    with open(pointer + ".tmp", "w") as f:
+        f.write(version)
+    os.replace(pointer + ".tmp", pointer)
+
+
+def publish(registry, model, version=None, meta=None, keep=5, make_current=True):
+    """
+    Saves a fitted model as a new version of the registry, and by default makes it the current one.
+
+    Parameters:
+        registry (str): The registry directory. Created if it does not exist.
+        model: A fitted model with feature_names_in_.
+        version (str): Name of the version. Default is the time of publishing.
+        meta (dict): Anything else to record with the model.
+        keep (int): Number of versions kept on disk. The current version is always kept.
+        make_current (bool): Whether to point the registry at the new version. Default is True.
+
+    Returns:
+        str: The version.
+    """
+    if not hasattr(model, "feature_names_in_"):
+        raise ValueError("The model must be fitted on a DataFrame, so that it has feature_names_in_.")
+    os.makedirs(registry, exist_ok=True)
+    version = version or new_version()
+    if os.path.exists(os.path.join(registry, version)):
+        raise ValueError(f"Version {version} is already in {registry}.")
+
+    info = {
+        "version": version,
+        "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "feature_names": [str(name) for name in model.feature_names_in_],
+        "n_estimators": len(getattr(model, "estimators_", []))
+    }
+    info.update(meta or {})
+    # Renamed into place once written, so a reader never sees a half-written version.
+    staging = tempfile.mkdtemp(prefix=f".{version}-", dir=registry)
+    try:
+        joblib.dump(model, os.path.join(staging, MODEL_FILE), compress=3)
+        with open(os.path.join(staging, META_FILE), "w") as f:
+            json.dump(info, f, indent=2)
+        os.rename(staging, os.path.join(registry, version))
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    if make_current:
+        set_current(registry, version)
+
+    # Removing a version a worker has memory-mapped is safe, since the pages stay until it unmaps them.
+    current = current_version(registry)
+    for old in [name for name in list_versions(registry)[:-keep] if name not in (version, current)]:
+        shutil.rmtree(os.path.join(registry, old), ignore_errors=True)
+    return version
+
+
+if __name__ == "__main__":
+    # Usage: python -m solar_common.model_registry models list
+    #        python -m solar_common.model_registry models publish rf_100_v1.pkl [version]
+    #        python -m solar_common.model_registry models use <version>
+    registry = sys.argv[1] if len(sys.argv) > 1 else "models"
+    command = sys.argv[2] if len(sys.argv) > 2 else "list"
+    if command == "publish":
+        start = time.time()
+        version = publish(registry, joblib.load(sys.argv[3]), version=sys.argv[4] if len(sys.argv) > 4 else None,
+                          meta={"source": os.path.basename(sys.argv[3])})
+        print(f"Published {sys.argv[3]} as {version} in {time.time() - start:.1f}s.")
+    elif command == "use":
+        set_current(registry, sys.argv[3])
+        print(f"{registry} now serves {sys.argv[3]}.")
+    else:
+        current = current_version(registry)
+        for name in list_versions(registry):
+            meta = read_meta(registry, name)
+            print(f"{'*' if name == current else ' '} {name}  {meta['created']}  {meta['n_estimators']} trees"
+                  + (f"  holdout RMSE {meta['rmse']:.4f}" if "rmse" in meta else ""))
@@ -0,0 +1,28 @@
+import os
+import sqlite3
+import threading
+
+
+class SQLiteStore:
+    """
+    A SQLite file used by several threads through one connection, which is only used with self.lock held.
+    The file and its directory are created if they do not exist.
+
+    Parameters:
+        filepath (str): Path to the SQLite file.
+        schema (tuple): "CREATE ... IF NOT EXISTS" statements, run when the file is opened.
+    """
+
+    def __init__(self, filepath, schema=()):
+        directory = os.path.dirname(filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filepath, check_same_thread=False)
+        for statement in schema:
+            self.connection.execute(statement)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,67 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from webapp import cache
+
+
+class FakeTime:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(cache, "time", clock)
+    return clock
+
+
+def test_entries_expire_at_their_expiry_time(clock):
+    lru = cache.LRUCache(max_entries=10)
+    lru.put("a", 1, expires=1060)
+    lru.put("b", 2)
+
+    clock.now = 1059
+    assert lru.get("a") == 1
+    clock.now = 1060
+    assert lru.get("a") is None
+    assert lru.get("b") == 2
+    assert lru.stats() == {"size": 1, "hits": 2, "misses": 1, "evictions": 0}
+
+
+def test_least_recently_used_entries_are_evicted(clock):
+    lru = cache.LRUCache(max_entries=2)
+    lru.put("a", 1)
+    lru.put("b", 2)
+    lru.get("a")
+    lru.put("c", 3)
+
+    assert lru.get("b") is None
+    assert (lru.get("a"), lru.get("c")) == (1, 3)
+    assert lru.stats()["evictions"] == 1
+
+
+def test_shared_file_serves_other_processes_entries(tmp_path, clock):
+    path = str(tmp_path / "shared.sqlite")
+    first = cache.LRUCache(max_entries=2, filepath=path)
+    second = cache.LRUCache(max_entries=2, filepath=path)
+    first.put("a", {"value": 1}, expires=1060)
+
+    assert second.get("a") == {"value": 1}
+    clock.now = 1060
+    second.clear()
+    assert second.get("a") is None
+
+
+def test_next_update_time_waits_for_the_next_published_run():
+    # Runs every 6 hours, published 30 minutes after they start.
+    assert cache.next_update_time(6, 30, now=0) == 1800
+    assert cache.next_update_time(6, 30, now=1800) == 6 * 3600 + 1800
+    assert cache.next_update_time(6, 30, now=6 * 3600 + 1799) == 6 * 3600 + 1800
@@ -0,0 +1,76 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from build_dataset import combine_data, storage
+
+
+@pytest.fixture
+def sources():
+    rng = np.random.default_rng(0)
+    dates = pd.date_range("2024-01-01", periods=30)
+    pvoutput_df = pd.DataFrame({
+        "System ID": np.repeat([3, 1, 2], 30),
+        "Date": np.tile(dates, 3),
+        "Efficiency (kWh/kW)": rng.uniform(0, 5, 90),
+        "Energy Generated (Wh)": rng.uniform(0, 5000, 90)
+    })
+    # System 2 has no weather, and system 4 no output, so neither is in the dataset.
+    weather_df = pd.DataFrame({
+        "id": np.repeat([1, 3, 4], 30),
+        "date": np.tile(dates, 3),
+        "weather_code": rng.choice([0, 3, 61], 90).astype(np.float64),
+        "temperature_2m_mean": rng.normal(10, 5, 90)
+    })
+    system_df = pd.DataFrame({"System ID": [1, 2, 3], "Elevation (m)": [10.0, 20.0, 30.0]})
+    return pvoutput_df, weather_df, system_df
+
+
+def write(df, path, table):
+    if storage.is_parquet_path(path):
+        partition_col, date_col = storage.PARTITIONS[table]
+        storage.write_parquet(df, path, partition_col=partition_col, date_col=date_col, mode="w")
+    else:
+        df.to_csv(path, index=False)
+    return path
+
+
+def read(path):
+    df = storage.read_parquet(path) if storage.is_parquet_path(path) else pd.read_csv(path, parse_dates=["Date"])
+    df["System ID"] = df["System ID"].astype("int64")
+    return df.sort_values(["System ID", "Date"]).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("file_format", ["csv", "parquet"])
+def test_combine_by_system_matches_the_in_memory_join(sources, tmp_path, file_format):
+    pvoutput_df, weather_df, system_df = sources
+    pvoutput_path = write(pvoutput_df, str(tmp_path / f"pvoutput.{file_format}"), "pvoutput")
+    weather_path = write(weather_df, str(tmp_path / f"weather.{file_format}"), "weather")
+
+    expected = combine_data.combine_weather_and_pvoutput(weather_df, pvoutput_df, str(tmp_path / "expected.csv"),
+                                                         system_df=system_df)
+    path = combine_data.combine_by_system(weather_path, pvoutput_path, str(tmp_path / f"dataset.{file_format}"),
+                                          file_format=file_format, system_df=system_df, chunksize=40)
+    actual = read(path)
+
+    expected = read(str(tmp_path / "expected.csv"))
+    assert sorted(actual["System ID"].unique()) == [1, 3]
+    pd.testing.assert_frame_equal(actual[expected.columns], expected, check_dtype=False)
+
+
+def test_combine_by_system_keeps_the_newest_copy_of_a_refetched_day(sources, tmp_path):
+    pvoutput_df, weather_df, system_df = sources
+    refetched = pvoutput_df[(pvoutput_df["System ID"] == 1)].head(1).assign(**{"Efficiency (kWh/kW)": 9.0})
+    pvoutput_path = write(pd.concat([pvoutput_df, refetched]), str(tmp_path / "pvoutput.csv"), "pvoutput")
+    weather_path = write(weather_df, str(tmp_path / "weather.csv"), "weather")
+
+    actual = read(combine_data.combine_by_system(weather_path, pvoutput_path, str(tmp_path / "dataset.csv"),
+                                                 system_df=system_df))
+
+    assert len(actual) == 60
+    assert actual.loc[0, "Efficiency (kWh/kW)"] == 9.0
+    assert (actual.groupby("System ID")["Elevation (m)"].first() == [10.0, 30.0]).all()
@@ -0,0 +1,68 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from solar_common import features
+
+
+FEATURE_NAMES = ["Elevation (m)", "cloud_cover_mean", "cloud_cover_min", "temperature_2m_mean"]
+FEATURE_NAMES += features.WEATHER_DUMMIES
+
+
+def pandas_features(data, feature_names):
+    # The pandas path build_matrix replaced.
+    data = data.dropna().copy()
+    data["cloud_cover_mean"] = data["cloud_cover_mean"].clip(upper=100)
+    data = data[data["cloud_cover_min"] != -1]
+    data["weather_category"] = data["weather_code"].map(features.WEATHER_CATEGORIES)
+    data = pd.get_dummies(data, columns=["weather_category"], drop_first=False)
+    for col in features.WEATHER_DUMMIES:
+        if col not in data.columns:
+            data[col] = False
+    return data[feature_names].to_numpy(dtype=np.float32)
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    n_rows = 2000
+    data = pd.DataFrame({
+        "Elevation (m)": rng.uniform(0, 400, n_rows),
+        # Includes codes that are not in WEATHER_CATEGORIES.
+        "weather_code": rng.choice(list(features.WEATHER_CATEGORIES) + [4, 100], n_rows).astype(np.float64),
+        "cloud_cover_mean": rng.uniform(0, 110, n_rows),
+        "cloud_cover_min": rng.integers(-1, 100, n_rows).astype(np.float64),
+        "temperature_2m_mean": rng.normal(10, 5, n_rows)
+    })
+    for col in ("weather_code", "temperature_2m_mean"):
+        data.loc[rng.choice(n_rows, 50, replace=False), col] = np.nan
+    return data
+
+
+def test_build_matrix_matches_the_pandas_features(data):
+    X, keep = features.build_matrix(data, FEATURE_NAMES)
+
+    np.testing.assert_array_equal(X, pandas_features(data, FEATURE_NAMES))
+    np.testing.assert_array_equal(np.flatnonzero(keep), np.flatnonzero(
+        data.notna().all(axis=1) & (data["cloud_cover_min"] != -1)))
+    assert X.dtype == np.float32 and X.flags["C_CONTIGUOUS"]
+
+
+def test_build_matrix_accepts_a_dict_of_columns(data):
+    data = data.dropna()
+    X, _ = features.build_matrix({col: data[col].to_numpy() for col in data}, FEATURE_NAMES)
+
+    np.testing.assert_array_equal(X, pandas_features(data, FEATURE_NAMES))
+
+
+def test_build_matrix_without_cleaning_keeps_every_row(data):
+    X, keep = features.build_matrix(data, FEATURE_NAMES, clean=False)
+
+    assert keep.all() and len(X) == len(data)
+    # Missing and unknown weather codes have no category.
+    unknown = data["weather_code"].isna() | ~data["weather_code"].isin(list(features.WEATHER_CATEGORIES))
+    assert not X[unknown.to_numpy(), len(FEATURE_NAMES) - len(features.WEATHER_DUMMIES):].any()
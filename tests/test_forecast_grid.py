@@ -0,0 +1,36 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from webapp import forecast_grid
+
+
+@pytest.fixture
+def grid(tmp_path):
+    rng = np.random.default_rng(0)
+    predictions = rng.uniform(0, 5, (5, 6, 3))
+    # A point with no data, e.g. at sea.
+    predictions[2, 3] = np.nan
+    codes = rng.choice([0, 3, 61], (5, 6, 3))
+    meta = {"bounds": [50, 51, -1, 0.25], "resolution": 0.25, "dates": ["2024-06-01", "2024-06-02", "2024-06-03"],
+            "expires": 0, "model_version": "v1"}
+    store = forecast_grid.GridStore(str(tmp_path))
+    store.publish(predictions, codes, meta)
+    return store.current()
+
+
+@pytest.mark.parametrize("interpolate", [True, False])
+def test_lookup_many_matches_lookup(grid, interpolate):
+    lats, lons = np.meshgrid(np.linspace(49.9, 51.1, 25), np.linspace(-1.1, 0.35, 30), indexing="ij")
+    for day in range(3):
+        values = grid.lookup_many(lats, lons, day, interpolate=interpolate)
+        for lat, lon, value in zip(lats.ravel(), lons.ravel(), values.ravel()):
+            found = grid.lookup(lat, lon, interpolate=interpolate)
+            if found is None:
+                assert np.isnan(value)
+            else:
+                assert np.isclose(value, found[0][day], atol=1e-5)
+    assert values.shape == lats.shape
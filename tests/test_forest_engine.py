@@ -0,0 +1,72 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.ensemble import RandomForestRegressor
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from webapp import forest_engine
+
+
+@pytest.fixture(scope="module")
+def forest():
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame(rng.normal(size=(500, 5)) * 100, columns=[f"x{i}" for i in range(5)])
+    y = X["x0"] - 2 * X["x1"] + rng.normal(size=500)
+    return RandomForestRegressor(n_estimators=20, max_depth=12, random_state=0).fit(X, y)
+
+
+@pytest.fixture
+def X(forest):
+    rows = np.random.default_rng(1).normal(size=(300, 5)) * 100
+    return pd.DataFrame(rows, columns=forest.feature_names_in_)
+
+
+def test_compact_forest_predicts_like_scikit_learn(forest, X):
+    compact = forest_engine.CompactForest(forest_engine.flatten_forest(forest))
+
+    np.testing.assert_allclose(compact.predict(X), forest.predict(X), rtol=1e-6, atol=1e-6)
+    np.testing.assert_allclose(compact.predict(X.to_numpy()[:1]), forest.predict(X[:1]), rtol=1e-6, atol=1e-6)
+    assert list(compact.feature_names_in_) == list(forest.feature_names_in_)
+
+
+def test_predictions_do_not_depend_on_the_chunk_size(forest, X):
+    arrays = forest_engine.flatten_forest(forest)
+
+    np.testing.assert_array_equal(forest_engine.CompactForest(arrays, rows_per_chunk=7).predict(X),
+                                  forest_engine.CompactForest(arrays).predict(X))
+
+
+def test_thresholds_are_rounded_down_without_changing_splits(forest):
+    arrays = forest_engine.flatten_forest(forest)
+    compact = forest_engine.CompactForest(arrays)
+    # Rows exactly on a threshold, and just either side of it, go the same way as in scikit-learn.
+    tree = forest.estimators_[0].tree_
+    split = np.flatnonzero(tree.children_left != -1)[0]
+    X = np.zeros((3, forest.n_features_in_), dtype=np.float32)
+    threshold = np.float32(tree.threshold[split])
+    X[:, tree.feature[split]] = [np.nextafter(threshold, np.float32(-np.inf)), threshold,
+                                 np.nextafter(threshold, np.float32(np.inf))]
+
+    assert arrays["threshold"].dtype == np.float32
+    X = pd.DataFrame(X, columns=forest.feature_names_in_)
+    np.testing.assert_allclose(compact.predict(X), forest.predict(X), rtol=1e-6, atol=1e-6)
+
+
+def test_exported_forest_loads_memory_mapped(forest, X, tmp_path):
+    directory = str(tmp_path / "model.forest")
+    forest_engine.export_forest(forest, directory)
+    loaded = forest_engine.load_forest(directory)
+
+    assert isinstance(loaded.left, np.memmap)
+    np.testing.assert_allclose(loaded.predict(X), forest.predict(X), rtol=1e-6, atol=1e-6)
+
+
+def test_multi_output_forests_are_rejected():
+    X = np.random.default_rng(0).normal(size=(50, 2))
+    forest = RandomForestRegressor(n_estimators=2, random_state=0).fit(X, np.c_[X[:, 0], X[:, 1]])
+
+    with pytest.raises(ValueError):
+        forest_engine.flatten_forest(forest)
@@ -0,0 +1,100 @@
+import os
+import sys
+
+import pytest
+import requests
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from build_dataset import http_cache
+
+
+class FakeTime:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        # Every call is a little later, so last_access orders the calls.
+        self.now += 0.001
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(http_cache, "time", clock)
+    return clock
+
+
+def make_response(body):
+    response = requests.Response()
+    response.status_code = 200
+    response.headers["Content-Type"] = "text/plain"
+    response._content = body
+    return response
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = http_cache.ResponseCache(str(tmp_path / "cache" / "http_cache.sqlite"), max_bytes=30)
+    yield cache
+    cache.close()
+
+
+def test_get_returns_the_stored_response(cache, clock):
+    cache.put("https://example.com/a", {"x": 1}, make_response(b"body"))
+    response = cache.get("https://example.com/a", {"x": 1})
+
+    assert response.status_code == 200
+    assert response.content == b"body"
+    assert response.headers["content-type"] == "text/plain"
+    assert cache.get("https://example.com/a", {"x": 2}) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_credentials_are_not_part_of_the_key(cache, clock):
+    cache.put("https://example.com/a", {"x": 1, "key": "secret", "sid": 5}, make_response(b"body"))
+
+    assert cache.get("https://example.com/a", {"x": 1, "key": "other"}).content == b"body"
+
+
+def test_entries_expire_after_their_ttl(cache, clock):
+    cache.put("https://example.com/a", None, make_response(b"recent"), ttl=60)
+    cache.put("https://example.com/b", None, make_response(b"final"))
+
+    clock.now += 59
+    assert cache.get("https://example.com/a", None).content == b"recent"
+    clock.now += 2
+    assert cache.get("https://example.com/a", None) is None
+    assert cache.get("https://example.com/b", None).content == b"final"
+
+
+def test_replay_only_ignores_ttls(tmp_path, clock):
+    path = str(tmp_path / "http_cache.sqlite")
+    cache = http_cache.ResponseCache(path)
+    cache.put("https://example.com/a", None, make_response(b"recent"), ttl=60)
+    cache.close()
+    clock.now += 3600
+
+    replay = http_cache.ResponseCache(path, replay_only=True)
+    assert replay.get("https://example.com/a", None).content == b"recent"
+    replay.close()
+
+
+def test_least_recently_used_entries_are_evicted_beyond_max_bytes(cache, clock):
+    for name in "abc":
+        cache.put(f"https://example.com/{name}", None, make_response(b"x" * 10))
+    cache.get("https://example.com/a", None)
+    cache.put("https://example.com/d", None, make_response(b"x" * 10))
+
+    assert cache.get("https://example.com/b", None) is None
+    for name in "acd":
+        assert cache.get(f"https://example.com/{name}", None) is not None
+    assert cache.total_bytes == 30
+
+
+def test_replacing_an_entry_does_not_count_it_twice(cache, clock):
+    for _ in range(5):
+        cache.put("https://example.com/a", None, make_response(b"x" * 10))
+
+    assert cache.total_bytes == 10
@@ -0,0 +1,72 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from build_dataset.manifest import FetchManifest
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    manifest = FetchManifest(str(tmp_path / "manifest.sqlite"), stale_days=2)
+    yield manifest
+    manifest.close()
+
+
+def record(manifest, start, end, fetched_at="2024-06-01", sid=1):
+    manifest.connection.execute("INSERT INTO fetched VALUES (?, ?, ?, ?, ?)", ("pvoutput", sid, start, end, fetched_at))
+    manifest.connection.commit()
+
+
+def days(*ranges):
+    return [(pd.Timestamp(start), pd.Timestamp(end)) for start, end in ranges]
+
+
+def test_missing_ranges_without_fetches_is_the_whole_range(manifest):
+    assert manifest.missing_ranges("pvoutput", 1, "2024-01-01", "2024-01-31") == days(("2024-01-01", "2024-01-31"))
+
+
+def test_missing_ranges_finds_the_gaps(manifest):
+    record(manifest, "2024-01-05", "2024-01-10")
+    record(manifest, "2024-01-20", "2024-01-25")
+
+    assert manifest.missing_ranges("pvoutput", 1, "2024-01-01", "2024-01-31") == days(
+        ("2024-01-01", "2024-01-04"), ("2024-01-11", "2024-01-19"), ("2024-01-26", "2024-01-31"))
+    # Other systems and sources are not affected.
+    assert manifest.missing_ranges("pvoutput", 2, "2024-01-01", "2024-01-02") == days(("2024-01-01", "2024-01-02"))
+    assert manifest.missing_ranges("openmeteo", 1, "2024-01-01", "2024-01-02") == days(("2024-01-01", "2024-01-02"))
+
+
+def test_missing_ranges_merges_overlapping_and_adjacent_fetches(manifest):
+    record(manifest, "2024-01-01", "2024-01-10")
+    record(manifest, "2024-01-05", "2024-01-15")
+    record(manifest, "2024-01-16", "2024-01-20")
+    record(manifest, "2024-01-03", "2024-01-04")
+
+    assert manifest.missing_ranges("pvoutput", 1, "2024-01-01", "2024-01-31") == days(("2024-01-21", "2024-01-31"))
+    assert manifest.missing_ranges("pvoutput", 1, "2024-01-02", "2024-01-18") == []
+
+
+def test_missing_ranges_refetches_days_that_were_recent_when_fetched(manifest):
+    record(manifest, "2024-01-01", "2024-01-31", fetched_at="2024-01-31")
+
+    assert manifest.missing_ranges("pvoutput", 1, "2024-01-01", "2024-01-31") == days(("2024-01-30", "2024-01-31"))
+
+
+def test_record_uses_today_as_the_fetch_date(manifest):
+    manifest.record("openmeteo", 1, pd.Timestamp("2020-01-01"), pd.Timestamp("2020-12-31"))
+
+    assert manifest.missing_ranges("openmeteo", 1, "2020-01-01", "2021-01-02") == days(("2021-01-01", "2021-01-02"))
+
+
+def test_forget_system_drops_it_from_the_collected_systems(manifest):
+    record(manifest, "2024-01-01", "2024-01-31", sid=1)
+    record(manifest, "2024-01-01", "2024-01-31", sid=2)
+    manifest.record_system(1, 12.5)
+    assert manifest.collected_systems() == {1: 12.5, 2: None}
+
+    manifest.forget_system(1)
+    assert manifest.collected_systems() == {2: None}
+    assert manifest.missing_ranges("pvoutput", 1, "2024-01-01", "2024-01-02") == days(("2024-01-01", "2024-01-02"))
@@ -0,0 +1,114 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from build_dataset import rate_limit
+
+
+class FakeTime:
+    # Stands in for the time module, so that sleeping moves the clock on without waiting.
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(rate_limit, "time", clock)
+    return clock
+
+
+def test_bucket_starts_full_and_refills_at_its_rate(clock):
+    bucket = rate_limit.TokenBucket(10, 60)
+    assert bucket.wait_time(10) == 0
+
+    bucket.take(10)
+    assert bucket.wait_time(1) == pytest.approx(6)
+    clock.now += 30
+    assert bucket.wait_time(5) == 0
+    assert bucket.wait_time(6) == pytest.approx(6)
+
+
+def test_bucket_never_refills_above_capacity(clock):
+    bucket = rate_limit.TokenBucket(10, 60)
+    bucket.take(4)
+    clock.now += 3600
+
+    bucket.take(10)
+    assert bucket.wait_time(1) == pytest.approx(6)
+
+
+def test_cost_above_capacity_waits_for_a_full_bucket_and_goes_into_debt(clock):
+    bucket = rate_limit.TokenBucket(10, 60)
+    bucket.take(5)
+    assert bucket.wait_time(25) == pytest.approx(30)
+
+    clock.now += 30
+    bucket.take(25)
+    # 15 tokens of debt and 1 more token take 96 seconds at 10 tokens a minute.
+    assert bucket.wait_time(1) == pytest.approx(96)
+
+
+def test_available_counts_refills_and_debt(clock):
+    bucket = rate_limit.TokenBucket(10, 60)
+    bucket.take(15)
+    assert bucket.available() == -5
+
+    clock.now += 30
+    assert bucket.available() == pytest.approx(0)
+
+
+def test_pause_empties_the_bucket_for_the_given_time(clock):
+    bucket = rate_limit.TokenBucket(10, 60)
+    bucket.pause(12)
+
+    assert bucket.wait_time(1) == pytest.approx(18)
+
+
+def test_acquire_waits_for_the_slowest_bucket(clock):
+    limiter = rate_limit.RateLimiter({
+        "calls": (rate_limit.TokenBucket(600, 60), "calls"),
+        "weight": (rate_limit.TokenBucket(100, 60), "weight")
+    })
+    limiter.acquire(weight=100)
+    assert clock.slept == 0
+
+    limiter.acquire(weight=50)
+    assert clock.slept == pytest.approx(30)
+
+
+def test_costs_that_are_not_given_count_as_one(clock):
+    limiter = rate_limit.RateLimiter({"calls": (rate_limit.TokenBucket(2, 60), "calls")})
+    limiter.acquire()
+    limiter.acquire(weight=5)
+    assert clock.slept == 0
+
+    limiter.acquire()
+    assert clock.slept == pytest.approx(30)
+
+
+def test_reserve_only_takes_from_the_named_bucket(clock):
+    limiter = rate_limit.RateLimiter({
+        "weight_per_minute": (rate_limit.TokenBucket(100, 60), "weight"),
+        "weight_per_day": (rate_limit.TokenBucket(1000, 86400), "weight")
+    })
+    limiter.reserve("weight_per_day", 990)
+
+    assert limiter.available("weight_per_minute") == 100
+    assert limiter.available("weight_per_day") == pytest.approx(10)
+    limiter.acquire(weight=20)
+    assert clock.slept == pytest.approx(10 * 86.4)
@@ -0,0 +1,83 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.ensemble import RandomForestRegressor
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from solar_common import model_registry
+from training import refresh
+
+
+TRAINED_UNTIL = pd.Timestamp("2023-03-31")
+
+
+@pytest.fixture
+def data():
+    return refresh.synthetic_dataset(n_systems=6, n_days=150, seed=1)
+
+
+@pytest.fixture
+def model(data):
+    first = data[data["Date"] <= TRAINED_UNTIL]
+    forest = RandomForestRegressor(n_estimators=10, max_depth=8, random_state=0)
+    return forest.fit(first.drop(columns=[refresh.TARGET, "Date"]), first[refresh.TARGET])
+
+
+def scramble_new_days(data, holdout_days=14):
+    # Shuffles the target of the days between TRAINED_UNTIL and the holdout, so trees fitted on them are worse.
+    cutoff = data["Date"].max() - pd.Timedelta(days=holdout_days)
+    new = (data["Date"] > TRAINED_UNTIL) & (data["Date"] <= cutoff)
+    data = data.copy()
+    data.loc[new, refresh.TARGET] = np.random.default_rng(0).permutation(data.loc[new, refresh.TARGET].to_numpy())
+    return data
+
+
+def test_extend_forest_adds_trees_and_drops_the_oldest(model, data):
+    old_trees = list(model.estimators_)
+    new = data[data["Date"] > TRAINED_UNTIL]
+    refresh.extend_forest(model, new.drop(columns=[refresh.TARGET, "Date"]), new[refresh.TARGET], 4, max_trees=10,
+                          random_state=1)
+
+    assert len(model.estimators_) == model.n_estimators == 10
+    assert model.estimators_[:6] == old_trees[4:]
+    assert not any(tree in old_trees for tree in model.estimators_[6:])
+    assert not model.warm_start
+
+
+def test_refresh_forest_rejects_a_worse_candidate(model, data):
+    old_trees = list(model.estimators_)
+    candidate, results = refresh.refresh_forest(model, scramble_new_days(data), TRAINED_UNTIL, n_new_trees=10,
+                                                replay_ratio=0)
+
+    assert candidate is None
+    assert results["rmse"] > results["baseline_rmse"]
+    assert model.estimators_ == old_trees
+
+
+def test_refresh_forest_accepts_a_better_candidate(model, data):
+    old_trees = list(model.estimators_)
+    candidate, results = refresh.refresh_forest(model, data, TRAINED_UNTIL, n_new_trees=5)
+
+    assert candidate is not None
+    assert results["rmse"] <= results["baseline_rmse"]
+    assert len(candidate.estimators_) == 10
+    assert candidate.estimators_[:5] == old_trees[5:]
+    assert model.estimators_ == old_trees
+
+
+def test_refresh_keeps_the_published_version_when_rejected(model, data, tmp_path, monkeypatch):
+    registry = str(tmp_path / "models")
+    model_registry.publish(registry, model, version="v1", meta={"trained_until": str(TRAINED_UNTIL.date())})
+
+    monkeypatch.setattr(refresh, "read_training_data", lambda path: scramble_new_days(data))
+    assert refresh.refresh(registry, "unused", n_new_trees=10, replay_ratio=0) is None
+    assert model_registry.current_version(registry) == "v1"
+    assert model_registry.list_versions(registry) == ["v1"]
+
+    monkeypatch.setattr(refresh, "read_training_data", lambda path: data)
+    version = refresh.refresh(registry, "unused", n_new_trees=5)
+    assert model_registry.current_version(registry) == version
+    assert model_registry.read_meta(registry, version)["parent"] == "v1"
@@ -0,0 +1,87 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from build_dataset import schema
+
+
+@pytest.fixture
+def dataset():
+    return pd.DataFrame({
+        "System ID": [1, 1, 2],
+        "Date": pd.to_datetime(["2024-01-01", "2024-01-02", "2024-01-01"]),
+        "Efficiency (kWh/kW)": [1.5, 2.0, np.nan],
+        "Elevation (m)": [10, 10, 20],
+        "temperature_2m_mean": [5.0, 6.0, 7.0],
+        "weather_category_rain": [True, False, False]
+    })
+
+
+def test_enforce_casts_to_the_declared_dtypes(dataset):
+    df = schema.enforce(dataset, "dataset")
+
+    assert isinstance(df["System ID"].dtype, pd.CategoricalDtype)
+    assert str(df["Date"].dtype) == "datetime64[ns]"
+    assert df["Elevation (m)"].dtype == np.float32
+    # Undeclared numeric columns get the default dtype, and bools are left as they are.
+    assert df["temperature_2m_mean"].dtype == np.float32
+    assert df["weather_category_rain"].dtype == bool
+    assert schema.validate(df, "dataset") is df
+
+
+def test_enforce_does_not_copy_data_that_already_matches(dataset):
+    df = schema.enforce(dataset, "dataset")
+
+    assert schema.enforce(df, "dataset") is df
+
+
+def test_enforce_leaves_undeclared_text_columns_alone():
+    df = pd.DataFrame({"id": [1], "date": pd.to_datetime(["2024-01-01"]), "note": ["x"]})
+
+    assert schema.enforce(df, "weather")["note"].dtype == df["note"].dtype
+
+
+def test_validate_lists_every_wrong_dtype(dataset):
+    with pytest.raises(ValueError) as error:
+        schema.validate(dataset, "dataset")
+
+    message = str(error.value)
+    assert "'System ID' is int64, not category" in message
+    assert "'Elevation (m)' is int64, not float32" in message
+    assert "'temperature_2m_mean' is float64, not float32" in message
+    assert "weather_category_rain" not in message
+
+
+def test_validate_reports_missing_key_columns(dataset):
+    df = schema.enforce(dataset.drop(columns=["Date"]), "dataset")
+
+    with pytest.raises(ValueError, match="missing column 'Date'"):
+        schema.validate(df, "dataset")
+
+
+def test_validate_rejects_missing_keys_but_not_missing_values(dataset):
+    df = schema.enforce(dataset, "dataset")
+    # Missing values in other columns are dropped by cleaning, not rejected.
+    assert schema.validate(df, "dataset") is df
+
+    df.loc[1, "Date"] = pd.NaT
+    with pytest.raises(ValueError, match="1 missing values in 'Date'"):
+        schema.validate(df, "dataset")
+
+
+def test_read_csv_reads_straight_into_the_schema(dataset, tmp_path):
+    path = str(tmp_path / "dataset.csv")
+    dataset.to_csv(path, index=False)
+
+    df = schema.validate(schema.read_csv(path, "dataset"), "dataset")
+    chunks = list(schema.read_csv(path, "dataset", chunksize=2))
+
+    assert np.isnan(df.loc[2, "Efficiency (kWh/kW)"])
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    for chunk in chunks:
+        schema.validate(chunk, "dataset")
+    pd.testing.assert_frame_equal(df, schema.enforce(dataset, "dataset"), check_categorical=False)
@@ -0,0 +1,243 @@
+import copy
+import os
+import sys
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.metrics import root_mean_squared_error
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from build_dataset import data_cleaning, schema, storage
+from solar_common import features, model_registry
+
+
+TARGET = "Efficiency (kWh/kW)"
+
+
+def read_training_data(path):
+    """
+    Reads a dataset and prepares it the same way as notebooks/model_training.ipynb, keeping the dates.
+
+    Parameters:
+        path (str): A CSV file or a Parquet dataset, as written by build_dataset.
+
+    Returns:
+        pd.DataFrame: The features, the target and "Date".
+    """
+    if storage.is_parquet_path(path):
+        df = storage.read_parquet(path)
+    else:
+        df = schema.read_csv(path, "dataset")
+    df = data_cleaning.remove_systems(data_cleaning.clean_dataset(df))
+    return data_cleaning.weather_code_to_category(df).drop(columns=["System ID"])
+
+
+def extend_forest(model, X, y, n_new_trees, max_trees=None, random_state=None):
+    """
+    Adds trees fitted on X and y to a fitted RandomForestRegressor with warm_start, then drops the oldest
+    trees so that it has at most max_trees. The other trees are left as they are, so the cost is that of
+    fitting n_new_trees trees on len(X) rows, however much data the forest was first fitted on.
+
+    Parameters:
+        model (RandomForestRegressor): The fitted forest. Changed in place.
+        X (pd.DataFrame): Features, with the forest's feature_names_in_.
+        y (pd.Series): Target.
+        n_new_trees (int): Number of trees to add.
+        max_trees (int): Maximum number of trees kept. Default is no limit.
+        random_state (int): Seed for the new trees. Set a new one for each refresh, otherwise a forest
+            cut back to max_trees would draw the same seeds every time.
+
+    Returns:
+        RandomForestRegressor: model.
+    """
+    if random_state is not None:
+        model.set_params(random_state=random_state)
+    model.set_params(warm_start=True, n_estimators=len(model.estimators_) + n_new_trees)
+    model.fit(X[model.feature_names_in_], y)
+    model.set_params(warm_start=False)
+    if max_trees is not None and len(model.estimators_) > max_trees:
+        # Trees are appended, so the oldest are at the start.
+        model.estimators_ = model.estimators_[-max_trees:]
+        model.set_params(n_estimators=max_trees)
+    return model
+
+
+def rmse(model, df):
+    return float(root_mean_squared_error(df[TARGET], model.predict(df[model.feature_names_in_])))
+
+
+def refresh_forest(model, df, trained_until, holdout_days=14, n_new_trees=None, max_trees=None, replay_ratio=1.0,
+                   tolerance=0.0, random_state=None):
+    """
+    Refreshes a forest with the days added to the dataset since it was trained, and checks that it has
+    not got worse.
+
+    The last holdout_days days are held out, and both forests are scored on them. The new trees are fitted
+    on the days after trained_until (up to the holdout), plus replay_ratio times as many rows sampled from
+    the older days, so they do not forget the seasons that are not in the new data. The time to fit therefore
+    grows with the new data rather than the full history.
+
+    Parameters:
+        model (RandomForestRegressor): The current forest. Not changed.
+        df (pd.DataFrame): Output of read_training_data().
+        trained_until (str or pd.Timestamp): Last date the current forest was trained on.
+        holdout_days (int): Days at the end of df used to score the forests.
+        n_new_trees (int): Trees to add. Default is a tenth of max_trees.
+        max_trees (int): Size the forest is kept to. Default is the current size.
+        replay_ratio (float): Older rows sampled per new row.
+        tolerance (float): Relative increase of the holdout RMSE that is still accepted.
+        random_state (int): Seed for the replayed rows and the new trees. Default depends on the holdout.
+
+    Returns:
+        tuple: (the refreshed forest, or None if there is no new data or it is less accurate, dict of results)
+    """
+    trained_until = pd.Timestamp(trained_until)
+    cutoff = df["Date"].max() - pd.Timedelta(days=holdout_days)
+    max_trees = max_trees or len(model.estimators_)
+    n_new_trees = n_new_trees or max(1, max_trees // 10)
+    if random_state is None:
+        random_state = int(cutoff.strftime("%Y%m%d"))
+    holdout = df[df["Date"] > cutoff]
+    new = df[(df["Date"] > trained_until) & (df["Date"] <= cutoff)]
+    results = {"trained_until": cutoff.strftime("%Y-%m-%d"), "holdout_from": (cutoff + pd.Timedelta(days=1))
+               .strftime("%Y-%m-%d"), "holdout_rows": len(holdout), "new_rows": len(new)}
+    if new.empty or holdout.empty:
+        print(f"No new days to train on after {trained_until.date()} (holdout from {results['holdout_from']}).")
+        return None, results
+
+    older = df[df["Date"] <= trained_until]
+    replay = older.sample(min(len(older), int(len(new) * replay_ratio)), random_state=random_state)
+    train = pd.concat([new, replay])
+    results["baseline_rmse"] = rmse(model, holdout)
+
+    start = time.time()
+    # A shallow copy with its own list of trees, so the current forest is left as it is. The trees it keeps
+    # are shared rather than copied.
+    candidate = copy.copy(model)
+    candidate.estimators_ = list(model.estimators_)
+    extend_forest(candidate, train.drop(columns=[TARGET, "Date"]), train[TARGET], n_new_trees, max_trees,
+                  random_state)
+    results["fit_seconds"] = time.time() - start
+    results["rmse"] = rmse(candidate, holdout)
+    results["n_estimators"] = len(candidate.estimators_)
+    print(f"Fitted {n_new_trees} trees on {len(new)} new and {len(replay)} older rows in "
+          f"{results['fit_seconds']:.1f}s. Holdout RMSE {results['baseline_rmse']:.4f} -> {results['rmse']:.4f} "
+          f"({len(holdout)} rows from {results['holdout_from']}).")
+    if results["rmse"] > results["baseline_rmse"] * (1 + tolerance):
+        return None, results
+    return candidate, results
+
+
+def refresh(registry, data_path, trained_until=None, **kwargs):
+    """
+    Refreshes the current model of a registry (see solar_common/model_registry.py) with the new days of a
+    dataset, and publishes it as a new version if it is at least as accurate on the holdout. The webapp
+    picks it up without a restart.
+
+    Parameters:
+        registry (str): The registry directory.
+        data_path (str): The dataset, as for read_training_data().
+        trained_until (str): Last date the current model was trained on. Default is the one recorded when
+            it was published, which is needed for a model that was not published by refresh().
+        **kwargs: Passed to refresh_forest().
+
+    Returns:
+        str: The new version, or None if nothing was published.
+    """
+    version = model_registry.current_version(registry)
+    if version is None:
+        raise ValueError(f"{registry} has no model. Publish one first with "
+                         f"python -m solar_common.model_registry {registry} publish <model.pkl>.")
+    meta = model_registry.read_meta(registry, version)
+    trained_until = trained_until or meta.get("trained_until")
+    if trained_until is None:
+        raise ValueError(f"Model {version} does not record the last date it was trained on, so pass trained_until.")
+    model = joblib.load(model_registry.model_path(registry, version))
+    df = read_training_data(data_path)
+    candidate, results = refresh_forest(model, df, trained_until, **kwargs)
+    if candidate is None:
+        if "rmse" in results:
+            print(f"Not published: the holdout RMSE would go from {results['baseline_rmse']:.4f} to "
+                  f"{results['rmse']:.4f}. Still serving {version}.")
+        return None
+    new_version = model_registry.publish(registry, candidate, meta={**results, "parent": version})
+    print(f"Published {new_version} ({results['n_estimators']} trees, trained until {results['trained_until']}).")
+    return new_version
+
+
+def synthetic_dataset(n_systems=40, n_days=730, seed=0):
+    # Daily rows in the layout of the merged dataset, with a seasonal pattern, for comparing refresh strategies.
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("2023-01-01", periods=n_days, freq="D")
+    n_rows = n_systems * n_days
+    day_of_year = np.tile(dates.dayofyear.to_numpy(), n_systems)
+    season = np.cos((day_of_year - 172) / 365.25 * 2 * np.pi)
+    daylight = 44000 + 15000 * season + rng.normal(0, 500, n_rows)
+    cloud = rng.uniform(0, 100, n_rows)
+    radiation = np.clip((12 + 10 * season) * (1 - cloud / 130) + rng.normal(0, 1, n_rows), 0.5, None)
+    df = pd.DataFrame({
+        "System ID": np.repeat(np.arange(n_systems), n_days),
+        "Date": np.tile(dates, n_systems),
+        "Elevation (m)": np.repeat(rng.uniform(0, 300, n_systems), n_days),
+        **features.synthetic_weather(n_rows, rng)
+    })
+    # The variables the efficiency depends on follow the seasons.
+    df["sunshine_duration"] = daylight * (1 - cloud / 100) * rng.uniform(0.5, 1, n_rows)
+    df["daylight_duration"] = daylight
+    df["cloud_cover_mean"] = cloud
+    df["cloud_cover_min"] = np.clip(cloud - rng.uniform(0, 40, n_rows), 0, None)
+    df["temperature_2m_mean"] = 10 + 7 * season + rng.normal(0, 3, n_rows)
+    df["shortwave_radiation_sum"] = radiation
+    df["Efficiency (kWh/kW)"] = np.clip(radiation * 0.25 + rng.normal(0, 0.4, n_rows), 0.01, None)
+    df = data_cleaning.clean_dataset(df)
+    return data_cleaning.weather_code_to_category(df).drop(columns=["System ID"])
+
+
+if __name__ == "__main__":
+    # Usage: python -m training.refresh models data/The_Dataset_v1-2.csv [trained_until]
+    #        python -m training.refresh compare [data/The_Dataset_v1-2.csv or -] [days per refresh] [refreshes]
+    # compare trains a forest with the notebook's hyperparameters on all but the last refreshes x days of the
+    # dataset, then adds the days back a refresh at a time, comparing refresh_forest with a full refit on
+    # the time taken and the holdout RMSE.
+    from sklearn.ensemble import RandomForestRegressor
+
+    if len(sys.argv) < 2 or sys.argv[1] != "compare":
+        refresh(sys.argv[1] if len(sys.argv) > 1 else "models",
+                sys.argv[2] if len(sys.argv) > 2 else "data/The_Dataset_v1-2.csv",
+                sys.argv[3] if len(sys.argv) > 3 else None)
+        sys.exit()
+
+    if len(sys.argv) > 2 and sys.argv[2] != "-":
+        data = read_training_data(sys.argv[2])
+    else:
+        data = synthetic_dataset()
+    days = int(sys.argv[3]) if len(sys.argv) > 3 else 14
+    n_refreshes = int(sys.argv[4]) if len(sys.argv) > 4 else 4
+    holdout_days = 14
+    params = {"n_estimators": 100, "max_depth": 20, "min_samples_leaf": 2, "max_features": None, "n_jobs": -1}
+    first_until = data["Date"].max() - pd.Timedelta(days=days * n_refreshes + holdout_days)
+    trained_until = first_until
+
+    first = data[data["Date"] <= trained_until]
+    start = time.time()
+    model = RandomForestRegressor(**params, random_state=42).fit(first.drop(columns=[TARGET, "Date"]), first[TARGET])
+    print(f"Initial forest on {len(first)} rows up to {trained_until.date()}: {time.time() - start:.1f}s")
+
+    for i in range(1, n_refreshes + 1):
+        # A rejected refresh leaves trained_until where it was, so the next one has more new days.
+        seen = data[data["Date"] <= first_until + pd.Timedelta(days=days * i + holdout_days)]
+        candidate, results = refresh_forest(model, seen, trained_until, holdout_days=holdout_days)
+        train = seen[seen["Date"] <= pd.Timestamp(results["trained_until"])]
+        holdout = seen[seen["Date"] > pd.Timestamp(results["trained_until"])]
+        start = time.time()
+        full = RandomForestRegressor(**params, random_state=42).fit(train.drop(columns=[TARGET, "Date"]), train[TARGET])
+        full_seconds = time.time() - start
+        print(f"Refresh {i}: incremental {results['fit_seconds']:.1f}s on {results['new_rows']} new rows, RMSE "
+              f"{results['rmse']:.4f} ({'published' if candidate is not None else 'rejected'}); full refit "
+              f"{full_seconds:.1f}s on {len(train)} rows, RMSE {rmse(full, holdout):.4f} "
+              f"({full_seconds / results['fit_seconds']:.1f}x slower)")
+        if candidate is not None:
+            model = candidate
+            trained_until = pd.Timestamp(results["trained_until"])
@@ -0,0 +1,305 @@
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.model_selection import KFold, ParameterSampler
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from solar_common.sqlite_store import SQLiteStore
+
+
+class ResultsStore(SQLiteStore):
+    # Every fold score computed by a search, keyed by the dataset (see dataset_key), the hyperparameters, the fold
+    # and the number of samples and trees, so a search that is run again only computes what is missing.
+
+    def __init__(self, filepath="data/search_results.sqlite"):
+        super().__init__(filepath, (
+            "CREATE TABLE IF NOT EXISTS scores ("
+            "data_key TEXT NOT NULL, params TEXT NOT NULL, fold INTEGER NOT NULL, n_samples INTEGER NOT NULL, "
+            "n_estimators INTEGER NOT NULL, rmse REAL NOT NULL, fit_seconds REAL, created_at TEXT, "
+            "PRIMARY KEY (data_key, params, fold, n_samples, n_estimators))",
+        ))
+
+    def scores(self, data_key, params, fold, n_samples):
+        # Returns {n_estimators: rmse} for one candidate and fold.
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT n_estimators, rmse FROM scores WHERE data_key = ? AND params = ? AND fold = ? AND n_samples = ?",
+                (data_key, params, fold, n_samples)
+            ).fetchall()
+        return dict(rows)
+
+    def record(self, data_key, params, fold, n_samples, scores):
+        # scores is a list of (n_estimators, rmse, fit_seconds).
+        created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(data_key, params, fold, n_samples, n_estimators, rmse, fit_seconds, created_at)
+                 for n_estimators, rmse, fit_seconds in scores]
+            )
+            self.connection.commit()
+
+    def results(self, data_key=None):
+        query = "SELECT * FROM scores" + (" WHERE data_key = ?" if data_key else "")
+        with self.lock:
+            return pd.read_sql_query(query, self.connection, params=(data_key,) if data_key else None)
+
+
+def dataset_key(X, y, n_splits, random_state):
+    # Identifies the data and folds that scores were computed on.
+    digest = hashlib.sha256()
+    digest.update(json.dumps([list(map(str, getattr(X, "columns", []))), n_splits, random_state]).encode())
+    digest.update(np.ascontiguousarray(X, dtype=np.float32).tobytes())
+    digest.update(np.ascontiguousarray(y, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def params_key(params):
+    # JSON with sorted keys and plain Python values (ParameterSampler gives NumPy ints).
+    return json.dumps({k: v.item() if isinstance(v, np.generic) else v for k, v in params.items()}, sort_keys=True)
+
+
+def tree_checkpoints(min_estimators, max_estimators, eta):
+    checkpoints = [min_estimators]
+    while checkpoints[-1] < max_estimators:
+        checkpoints.append(min(checkpoints[-1] * eta, max_estimators))
+    return checkpoints
+
+
+# Set in each worker process by _init_worker, so the data is loaded once per process rather than per task.
+_X = None
+_y = None
+_folds = None
+
+
+def _init_worker(X_path, y_path, n_splits, random_state):
+    global _X, _y, _folds
+    _X = np.load(X_path, mmap_mode="r")
+    _y = np.load(y_path, mmap_mode="r")
+    _folds = list(KFold(n_splits=n_splits, shuffle=True, random_state=random_state).split(_X))
+
+
+def _evaluate(params, fold, n_samples, checkpoints, tol, random_state):
+    """
+    Fits one candidate on one fold, growing the forest with warm_start through the tree counts in
+    checkpoints and scoring it on the fold's validation set at each one. Stops early once adding
+    trees improves the RMSE by less than tol (relative).
+
+    Returns:
+        list: (n_estimators, rmse, fit_seconds) for each checkpoint reached.
+    """
+    train, validation = _folds[fold]
+    # Nested subsamples: the first n_samples of a fixed shuffle, so each rung's data contains the last rung's.
+    train = np.sort(np.random.default_rng(random_state + fold).permutation(train)[:n_samples])
+    X_train = np.asarray(_X[train])
+    y_train = np.asarray(_y[train])
+    X_val = np.asarray(_X[validation])
+    y_val = np.asarray(_y[validation])
+
+    rf = RandomForestRegressor(**json.loads(params), warm_start=True, n_jobs=1, random_state=random_state)
+    prediction_sum = np.zeros(len(y_val))
+    scores = []
+    start = time.time()
+    for n_estimators in checkpoints:
+        n_before = len(getattr(rf, "estimators_", []))
+        rf.set_params(n_estimators=n_estimators)
+        rf.fit(X_train, y_train)
+        # Only the new trees need to predict. The forest's prediction is the mean over all trees.
+        for tree in rf.estimators_[n_before:]:
+            prediction_sum += tree.predict(X_val)
+        rmse = float(np.sqrt(np.mean((prediction_sum / n_estimators - y_val) ** 2)))
+        scores.append((n_estimators, rmse, time.time() - start))
+        if len(scores) > 1 and scores[-2][1] - rmse < tol * scores[-2][1]:
+            break
+    return scores
+
+
+def successive_halving_search(X, y, param_dist, n_candidates=20, n_splits=5, eta=3, min_samples=None,
+                              min_estimators=25, max_estimators=500, tol=0.002, max_workers=None,
+                              store=None, random_state=42):
+    """
+    Random search for RandomForestRegressor hyperparameters with successive halving.
+
+    Candidates are first compared on growing nested subsamples of each training fold (min_samples, then
+    eta times more, up to the full fold) with min_estimators trees, keeping the best 1/eta at each step.
+    The survivors are then fitted on the full folds, growing their forests with warm_start from
+    min_estimators trees up to max_estimators (multiplying by eta) until the RMSE stops improving by tol.
+    n_estimators is chosen by this second step, so it is ignored if it is in param_dist.
+
+    Folds are fitted in parallel in a process pool, and each fold score is saved in a ResultsStore.
+
+    Parameters:
+        X (pd.DataFrame or np.ndarray): Training features.
+        y (pd.Series or np.ndarray): Training target.
+        param_dist (dict): Hyperparameter distributions or lists, as for RandomizedSearchCV.
+        n_candidates (int): Number of hyperparameter combinations to sample.
+        n_splits (int): Number of cross-validation folds.
+        eta (int): Factor by which the candidates are reduced, and the samples and trees increased, at each step.
+        min_samples (int): Training samples per fold in the first step. Default is the fold size / eta^steps.
+        min_estimators (int): Trees per forest while halving.
+        max_estimators (int): Maximum trees per forest.
+        tol (float): Relative RMSE improvement below which a forest stops growing.
+        max_workers (int): Number of worker processes. Default is the number of CPUs.
+        store (ResultsStore): Where to save and look up scores. Default is data/search_results.sqlite.
+        random_state (int): Seed for the candidates, folds and forests.
+
+    Returns:
+        tuple: (best hyperparameters including n_estimators, pd.DataFrame of mean CV RMSE per candidate and step)
+    """
+    if store is None:
+        store = ResultsStore()
+    param_dist = {k: v for k, v in param_dist.items() if k != "n_estimators"}
+    candidates = [params_key(params) for params in ParameterSampler(param_dist, n_candidates, random_state=random_state)]
+    candidates = list(dict.fromkeys(candidates))  # Lists of values can give duplicate candidates.
+    data_key = dataset_key(X, y, n_splits, random_state)
+    n_train = len(y) - len(y) // n_splits
+    # Enough halving steps on subsamples that about one candidate is left for the full folds.
+    n_rungs = int(np.ceil(np.log(len(candidates)) / np.log(eta) - 1e-9))
+    if min_samples is None:
+        min_samples = max(500, n_train // eta ** n_rungs)
+    rungs = sorted({n for n in (min_samples * eta ** k for k in range(n_rungs)) if n < n_train})
+    final_samples = n_train
+    checkpoints = tree_checkpoints(min_estimators, max_estimators, eta)
+
+    rows = []
+    start = time.time()
+    with tempfile.TemporaryDirectory() as tmp:
+        # Workers memory-map the data instead of each receiving a pickled copy.
+        X_path, y_path = os.path.join(tmp, "X.npy"), os.path.join(tmp, "y.npy")
+        np.save(X_path, np.ascontiguousarray(X, dtype=np.float32))
+        np.save(y_path, np.ascontiguousarray(y, dtype=np.float64))
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(X_path, y_path, n_splits, random_state)) as executor:
+
+            def run_step(step_candidates, n_samples, step_checkpoints, step_tol):
+                # Returns {candidate: [{n_estimators: rmse} for each fold]}, using stored scores where possible.
+                scores = {params: [None] * n_splits for params in step_candidates}
+                futures = {}
+                for params in step_candidates:
+                    for fold in range(n_splits):
+                        stored = store.scores(data_key, params, fold, n_samples)
+                        if _is_complete(stored, step_checkpoints, step_tol):
+                            scores[params][fold] = stored
+                        else:
+                            futures[executor.submit(_evaluate, params, fold, n_samples, step_checkpoints, step_tol,
+                                                    random_state)] = (params, fold)
+                for future in as_completed(futures):
+                    params, fold = futures[future]
+                    result = future.result()
+                    store.record(data_key, params, fold, n_samples, result)
+                    scores[params][fold] = {n_estimators: rmse for n_estimators, rmse, _ in result}
+                print(f"{len(step_candidates)} candidates on {n_samples} samples: {len(futures)} folds fitted, "
+                      f"{len(step_candidates) * n_splits - len(futures)} from the results store "
+                      f"({time.time() - start:.0f}s so far).")
+                return scores
+
+            survivors = candidates
+            for n_samples in rungs:
+                scores = run_step(survivors, n_samples, [min_estimators], tol)
+                means = {params: np.mean([fold[min_estimators] for fold in folds]) for params, folds in scores.items()}
+                rows += [{"params": params, "n_samples": n_samples, "n_estimators": min_estimators, "rmse": rmse}
+                         for params, rmse in means.items()]
+                survivors = sorted(survivors, key=means.get)[:max(1, len(survivors) // eta)]
+
+            scores = run_step(survivors, final_samples, checkpoints, tol)
+
+    for params, folds in scores.items():
+        for n_estimators in checkpoints:
+            rows.append({"params": params, "n_samples": final_samples, "n_estimators": n_estimators,
+                         "rmse": np.mean([_score_at(fold, n_estimators) for fold in folds])})
+    results = pd.DataFrame(rows)
+    final = results[results["n_samples"] == final_samples]
+    best_rmse = final["rmse"].min()
+    # The smallest forest within tol of the best score, since bigger forests are slower and larger to deploy.
+    best = final[final["rmse"] <= best_rmse * (1 + tol)].sort_values(["n_estimators", "rmse"]).iloc[0]
+    print(f"Search finished in {time.time() - start:.0f}s. Best CV RMSE {best['rmse']:.4f} with "
+          f"{best['n_estimators']} trees and {best['params']}.")
+    return {**json.loads(best["params"]), "n_estimators": int(best["n_estimators"])}, results
+
+
+def _score_at(fold_scores, n_estimators):
+    # Forests that stopped growing early keep their last score for the larger tree counts.
+    reached = [n for n in fold_scores if n <= n_estimators]
+    return fold_scores[max(reached)]
+
+
+def _is_complete(stored, checkpoints, tol):
+    # Whether stored scores already cover a fit through checkpoints, including one that stopped early.
+    previous = None
+    for n_estimators in checkpoints:
+        if n_estimators not in stored:
+            return False
+        if previous is not None and stored[previous] - stored[n_estimators] < tol * stored[previous]:
+            return True
+        previous = n_estimators
+    return True
+
+
+if __name__ == "__main__":
+    # Usage: python -m training.search [n_rows] [data/The_Dataset_v1-2.csv or -] [n_candidates]
+    # Runs the same candidates through RandomizedSearchCV (as in notebooks/model_training.ipynb) and through
+    # successive_halving_search, and compares the wall-clock time and the test RMSE of the chosen forests.
+    from scipy.stats import randint
+    from sklearn.metrics import root_mean_squared_error
+    from sklearn.model_selection import RandomizedSearchCV, train_test_split
+
+    from build_dataset import data_cleaning, schema
+
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    if len(sys.argv) > 2 and sys.argv[2] != "-":  # "-" for synthetic data
+        df = schema.read_csv(sys.argv[2], "dataset")
+        df = data_cleaning.remove_systems(data_cleaning.clean_dataset(df))
+        df = data_cleaning.weather_code_to_category(df).drop(columns=["Date", "System ID"])
+        df = df.sample(min(n_rows, len(df)), random_state=0)
+    else:
+        rng = np.random.default_rng(0)
+        df = pd.DataFrame(rng.normal(size=(n_rows, 12)), columns=[f"x{i}" for i in range(12)])
+        df["Efficiency (kWh/kW)"] = df["x0"] * 2 + np.sin(df["x1"] * 3) + df["x2"] * df["x3"] + rng.normal(size=n_rows)
+    X = df.drop(columns="Efficiency (kWh/kW)")
+    y = df["Efficiency (kWh/kW)"]
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+
+    param_dist = {
+        'n_estimators': randint(100, 300),
+        'max_depth': randint(10, 30),
+        'min_samples_leaf': [1, 2, 4],
+        'max_features': ['sqrt', None]
+    }
+    n_candidates = int(sys.argv[3]) if len(sys.argv) > 3 else 27
+
+    start = time.time()
+    random_search = RandomizedSearchCV(RandomForestRegressor(random_state=42, n_jobs=1), param_dist,
+                                       n_iter=n_candidates, cv=5, scoring="neg_root_mean_squared_error",
+                                       n_jobs=os.cpu_count(), random_state=42)
+    random_search.fit(X_train, y_train)
+    random_time = time.time() - start
+    random_rmse = root_mean_squared_error(y_test, random_search.best_estimator_.predict(X_test))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = ResultsStore(os.path.join(tmp, "results.sqlite"))
+        start = time.time()
+        best_params, _ = successive_halving_search(X_train, y_train, param_dist, n_candidates=n_candidates,
+                                                   max_estimators=300, store=store)
+        halving_time = time.time() - start
+        best_rf = RandomForestRegressor(**best_params, random_state=42, n_jobs=-1).fit(X_train, y_train)
+        halving_rmse = root_mean_squared_error(y_test, best_rf.predict(X_test))
+
+        start = time.time()
+        successive_halving_search(X_train, y_train, param_dist, n_candidates=n_candidates, max_estimators=300,
+                                  store=store)
+        rerun_time = time.time() - start
+        store.close()
+
+    print(f"RandomizedSearchCV: {random_time:.1f}s, test RMSE {random_rmse:.4f} with {random_search.best_params_}")
+    print(f"Successive halving: {halving_time:.1f}s ({random_time / halving_time:.1f}x faster), "
+          f"test RMSE {halving_rmse:.4f} with {best_params}")
+    print(f"Rerun from the results store: {rerun_time:.1f}s")
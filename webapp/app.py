@@ -1,13 +1,30 @@
+import gc
+import json
+import math
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from datetime import datetime
+from functools import lru_cache
+from zoneinfo import ZoneInfo
 
-import joblib
+import numpy as np
 import openmeteo_requests
 import pandas as pd
 import psutil
 import requests
-from flask import Flask, request, jsonify, render_template
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, g, request, jsonify, render_template
 import urllib.request
+from solar_common import elevation_grid, model_registry
+from solar_common.features import WEATHER_DUMMIES, build_matrix, synthetic_weather
+
+from cache import LRUCache, next_update_time, shared_cache_path, snap_to_grid
+from forecast_grid import MISSING_CODE, GridStore, grid_axes
+from heatmap import SCALE, cell_centres, encode_png, quantize, tile_bounds
+from metrics import Registry, RequestTimer
+from model_loading import ServedModel, load_compact_model, load_model, memory_breakdown
 
 
 process = psutil.Process(os.getpid())
@@ -15,8 +32,111 @@ def print_memory_usage():
     print(f"Memory usage: {process.memory_info().rss / 1048576:.2f} MiB")
 
 
-elevation_url = "https://api.open-elevation.com/api/v1/lookup?locations="
 open_meteo_url = "https://api.open-meteo.com/v1/forecast"
+daily_vars = ["surface_pressure_mean", "weather_code", "sunshine_duration", "daylight_duration",
+              "precipitation_sum", "precipitation_hours", "wind_direction_10m_dominant", "cloud_cover_mean",
+              "cloud_cover_min", "temperature_2m_mean", "relative_humidity_2m_min", "wind_speed_10m_mean",
+              "shortwave_radiation_sum"]
+
+# Forecasts are fetched for the centre of a grid cell of this size (in degrees, about 2 km),
+# so that nearby clicks share a cached forecast until the next model run is published.
+grid_resolution = 0.02
+forecast_update_hours = 3
+forecast_update_delay_minutes = 30
+# Elevation comes from the offline UK grid (see solar_common/elevation_grid.py). Points it does not cover are
+# predicted with fallback_elevation, flagged as degraded.
+elevation_grid_path = os.getenv("ELEVATION_GRID", "uk_elevation.npy")
+# Limits for /predict/batch
+max_batch_sites = 500
+max_locations_per_request = 100
+uk_elevation = elevation_grid.load_grid(elevation_grid_path)
+if uk_elevation is None:
+    print(f"There is no elevation grid at {elevation_grid_path}, so every prediction will assume the fallback "
+          f"elevation. Build it with python -m solar_common.elevation_grid {elevation_grid_path}.")
+forecast_cache = LRUCache(max_entries=10000, filepath=shared_cache_path("forecast"))
+
+# Upstream calls get a timeout per attempt, and the whole lookup must finish before the deadline,
+# otherwise a degraded response is returned.
+upstream_timeout = 4
+upstream_deadline = 5
+batch_upstream_deadline = 20
+# Used when a point has no elevation, so a forecast can still be given (flagged as degraded).
+fallback_elevation = 100
+
+# Set FORECAST_GRID=1 to answer /predict from a national grid of predictions (see forecast_grid.py), computed
+# in the background after each forecast model run. Points outside it, or with no data, use the live path.
+# A grid point costs one Open-Meteo location per refresh, so keep the resolution coarse on the free tier.
+forecast_grid_enabled = os.getenv("FORECAST_GRID", "0") == "1"
+forecast_grid_bounds = elevation_grid.UK_BOUNDS
+forecast_grid_resolution = float(os.getenv("FORECAST_GRID_RESOLUTION", "0.25"))
+forecast_grid_interpolate = os.getenv("FORECAST_GRID_INTERPOLATE", "1") == "1"
+# How long an expired grid is still used while the next one is computed, in seconds.
+forecast_grid_grace = 3600
+forecast_grid_retry = 300
+forecast_grid = GridStore(os.getenv("FORECAST_GRID_DIR", "forecast_grid"))
+london = ZoneInfo("Europe/London")
+grid_refresher_pid = None
+
+# /heatmap splits each map tile into heatmap_cells x heatmap_cells cells (see heatmap.py), read from the forecast
+# grid, so tiles cost no Open-Meteo requests and are only served when FORECAST_GRID=1. They are cached per grid.
+heatmap_cells = int(os.getenv("HEATMAP_CELLS", "16"))
+heatmap_days = 7
+heatmap_zoom = (5, 14)
+heatmap_cache = LRUCache(max_entries=5000, filepath=shared_cache_path("heatmap"))
+
+# Models are served from a registry of versions (see solar_common/model_registry.py) when it has one.
+# Every worker checks which version is current every MODEL_RELOAD_INTERVAL seconds, and when it changes
+# loads and checks the new model in a background thread, then swaps it in while requests are being served.
+# MODEL_ENGINE=compact (the default) predicts from flattened NumPy arrays (see forest_engine.py), which are
+# memory-mapped and shared between workers unless MODEL_MMAP=0. MODEL_ENGINE=sklearn uses the scikit-learn
+# forest itself, loaded into each worker's private memory.
+model_registry_dir = os.getenv("MODEL_REGISTRY", "models")
+model_reload_interval = float(os.getenv("MODEL_RELOAD_INTERVAL", "30"))
+model_engine = os.getenv("MODEL_ENGINE", "compact")
+model_mmap = os.getenv("MODEL_MMAP", "1") == "1"
+# A model whose warm-up predictions fall outside this range (kWh/kW per day) is not served.
+plausible_efficiency = (0, 10)
+model_reloader_pid = None
+
+
+# Set METRICS_DIR to add up the metrics of all gunicorn workers (see gunicorn.conf.py).
+metrics = Registry(os.getenv("METRICS_DIR"))
+metrics.histogram("solar_request_duration_seconds", "Time to handle a request.")
+metrics.histogram("solar_stage_duration_seconds", "Time spent in each stage of a prediction, by model version.")
+metrics.counter("solar_upstream_requests_total", "Requests made to upstream APIs.")
+metrics.counter("solar_upstream_errors_total", "Upstream lookups that failed or missed the deadline.")
+metrics.counter("solar_cache_lookups_total", "Cache lookups by result, where \"grid\" is the offline elevation grid.")
+
+
+class UpstreamTimeout(Exception):
+    pass
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    # Pooled adapter that applies a default timeout to every request sent through it.
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def make_session(timeout, pool_size=16):
+    adapter = TimeoutHTTPAdapter(timeout, pool_connections=4, pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# A long-lived pooled session and a shared thread pool, so forecasts are fetched over kept-alive connections
+# while the rest of a request is worked out.
+open_meteo = openmeteo_requests.Client(session=make_session(upstream_timeout))
+upstream_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="upstream")
+
 weather_code_mapping = {
     0: "Clear sky ☀️",
     1: "Mainly clear 🌤️", 2: "Partly cloudy ⛅", 3: "Overcast ☁️",
@@ -33,7 +153,10 @@ weather_code_mapping = {
 }
 
 model_path = "rf_100_v1.pkl"
-if not os.path.exists(model_path):
+registry_version = model_registry.current_version(model_registry_dir)
+if registry_version is not None:
+    model_path = model_registry.model_path(model_registry_dir, registry_version)
+elif not os.path.exists(model_path):
     model_url = "https://github.com/DixonScott/Solar_Power/releases/download/v1.0/rf_100_v1.pkl"
     print(f"Model not found, downloading from {model_url}")
     print_memory_usage()
@@ -42,135 +165,586 @@ if not os.path.exists(model_path):
     end = time.time()
     print(f"Download time: {(end - start):.1f}s")
     print_memory_usage()
-rf = joblib.load(model_path)
-print("Model loaded.")
-print_memory_usage()
+
+
+def load_version(path, freeze=True):
+    if model_engine == "compact":
+        return load_compact_model(path, mmap=model_mmap, freeze=freeze)
+    return load_model(path, freeze=freeze)
+
+
+def warmup_batch(n_rows=64):
+    # Raw forecast columns covering the range of UK weather, for checking a model before it is served.
+    rng = np.random.default_rng(0)
+    return {"Elevation (m)": rng.uniform(0, 400, n_rows), **synthetic_weather(n_rows, rng)}
+
+
+def check_model(model):
+    """
+    Checks that a model can be served: every one of its features must be built from the forecast and the
+    elevation, and it must give finite, plausible predictions for a warm-up batch. The warm-up also reads
+    a memory-mapped model's pages in, so its first requests are not slowed down by page faults.
+
+    Raises:
+        ValueError: If the model cannot be served.
+    """
+    feature_names = [str(name) for name in getattr(model, "feature_names_in_", [])]
+    if not feature_names:
+        raise ValueError("The model has no feature_names_in_.")
+    known = set(daily_vars) | {"Elevation (m)"} | set(WEATHER_DUMMIES)
+    unknown = [name for name in feature_names if name not in known]
+    if unknown:
+        raise ValueError(f"The model needs features that are not in the forecast: {unknown}.")
+    X, _ = build_matrix(warmup_batch(), feature_names)
+    predictions = np.asarray(model.predict(X))
+    if predictions.shape != (len(X),) or not np.isfinite(predictions).all():
+        raise ValueError(f"The model gave {predictions.shape} predictions for {len(X)} rows, or non-finite ones.")
+    low, high = plausible_efficiency
+    if predictions.min() < low or predictions.max() > high:
+        raise ValueError(f"The model's warm-up predictions range from {predictions.min():.2f} to "
+                         f"{predictions.max():.2f} kWh/kW, outside {low}-{high}.")
+
+
+rf, load_time = load_version(model_path)
+check_model(rf)
+print(f"Model loaded in {load_time:.2f}s.")
+# The model and its version, replaced as a whole when a new version is loaded. Each request reads it once
+# (into g.served), so a request that is running during a swap finishes with the model it started with.
+# The version is reported on every response and as a label on the metrics, so a change in latency or
+# accuracy can be matched to a model.
+if registry_version is not None:
+    served = ServedModel(rf, registry_version, model_registry.read_meta(model_registry_dir, registry_version))
+else:
+    served = ServedModel(rf, os.getenv("MODEL_VERSION", os.path.splitext(os.path.basename(model_path))[0]), {})
+del rf
+grid_wakeup = threading.Event()
+metrics.gauge("solar_model_info", "The model being served.",
+              lambda: [((("version", served.version), ("engine", model_engine)), 1)])
+metrics.counter("solar_model_reloads_total", "Attempts to load a new model version, by result.")
+metrics.gauge("solar_process_resident_memory_bytes", "Resident memory of each worker process.",
+              lambda: [((("pid", pid),), psutil.Process(pid).memory_info().rss) for pid in metrics.pids()
+                       if psutil.pid_exists(pid)])
+print(f"Memory: {memory_breakdown(process)}")
 
 app = Flask(__name__)
 
 
+@app.before_request
+def start_timer():
+    g.served = served
+    g.timer = RequestTimer(metrics, "solar_stage_duration_seconds", (("model_version", g.served.version),))
+    start_grid_refresher()
+    start_model_reloader()
+
+
+@app.after_request
+def record_request(response):
+    timer = g.get("timer")
+    if timer is not None:
+        version = g.served.version
+        labels = (("endpoint", request.endpoint or "unknown"), ("status", response.status_code),
+                  ("model_version", version))
+        metrics.observe("solar_request_duration_seconds", labels, timer.elapsed())
+        response.headers["Server-Timing"] = timer.server_timing()
+        response.headers["X-Model-Version"] = version
+    return response
+
+
 @app.route('/')
 def index():
     print_memory_usage()
     return render_template('index.html')
 
 
-@app.route('/predict', methods=['POST'])
-def predict():
-    print_memory_usage()
+def get_elevations(points):
+    # Returns one elevation per (lat, lon) point from the offline grid, or a LookupError for a point it does not cover.
+    if uk_elevation is None:
+        return [LookupError(f"There is no elevation grid at {elevation_grid_path}.")] * len(points)
+    elevations = [uk_elevation.lookup_one(lat, lon) for lat, lon in points]
+    n_grid = sum(not math.isnan(elevation) for elevation in elevations)
+    if n_grid:
+        metrics.inc("solar_cache_lookups_total", (("cache", "elevation"), ("result", "grid")), n_grid)
+    if n_grid < len(points):
+        metrics.inc("solar_cache_lookups_total", (("cache", "elevation"), ("result", "miss")), len(points) - n_grid)
+    return [LookupError(f"({lat}, {lon}) is outside the elevation grid.") if math.isnan(elevation) else elevation
+            for (lat, lon), elevation in zip(points, elevations)]
 
-    data = request.get_json()
-    lat = data.get("latitude")
-    lon = data.get("longitude")
-    power_rating = data.get("power_rating", None)
-    print(f"Received coordinates: {lat}, {lon}")
 
-    # fetch the elevation from open-elevation.com
-    response = requests.get(elevation_url + f"{lat},{lon}")
-    print(f"Got response {response} from open-elevation.")
-    elevation = response.json()["results"][0]["elevation"]
-
-    # fetch the weather forecast from open-meteo.com
-    open_meteo = openmeteo_requests.Client()
-
-    params = {
-        "latitude": lat,
-        "longitude": lon,
-        "daily": ["surface_pressure_mean", "weather_code", "sunshine_duration", "daylight_duration",
-                  "precipitation_sum", "precipitation_hours", "wind_direction_10m_dominant", "cloud_cover_mean",
-                  "cloud_cover_min", "temperature_2m_mean", "relative_humidity_2m_min", "wind_speed_10m_mean",
-                  "shortwave_radiation_sum"],
-        "timezone": "Europe/London"
-    }
+@lru_cache(maxsize=64)
+def forecast_dates(start, end, interval):
+    # Every forecast from the same model run has the same dates, so the index is built once and shared.
+    return pd.date_range(
+        start=pd.to_datetime(start, unit="s", utc=True).tz_convert("Europe/London"),
+        end=pd.to_datetime(end, unit="s", utc=True).tz_convert("Europe/London"),
+        freq=pd.Timedelta(seconds=interval),
+        inclusive="left"
+    )
 
-    try:
-        response = open_meteo.weather_api(open_meteo_url, params=params)[0]
-        print("Successfully fetched forecast from open-meteo.")
-    except Exception as e:
-        print("Request Failed: ", e)
 
-    lat = response.Latitude()
-    lon = response.Longitude()
+def parse_forecast(response):
     daily = response.Daily()
-    daily_data = {
-        "date": pd.date_range(
-            start=pd.to_datetime(daily.Time(), unit="s", utc=True).tz_convert("Europe/London"),
-            end=pd.to_datetime(daily.TimeEnd(), unit="s", utc=True).tz_convert("Europe/London"),
-            freq=pd.Timedelta(seconds=daily.Interval()),
-            inclusive="left"
-        ),
-        "Elevation (m)": elevation
-    }
-    for var_no, var_name in enumerate(params["daily"]):
+    daily_data = {"date": forecast_dates(daily.Time(), daily.TimeEnd(), daily.Interval())}
+    for var_no, var_name in enumerate(daily_vars):
         daily_data[var_name] = daily.Variables(var_no).ValuesAsNumpy()
-    forecast = pd.DataFrame(data=daily_data)
+    return pd.DataFrame(data=daily_data)
 
-    # Clean the data in the same way as the training data
-    forecast = forecast.dropna().copy()
-    forecast['cloud_cover_mean'] = forecast['cloud_cover_mean'].clip(upper=100)
-    forecast = forecast[forecast['cloud_cover_min'] != -1]
 
-    weather_codes = forecast["weather_code"].copy()  # Save the original "weather_code" before it's changed
-    conditions = weather_codes.map(weather_code_mapping)  # Convert weather codes to user-friendly descriptions
-    forecast = weather_code_to_category(forecast)  #  Convert weather codes to categories for use by the model
+def get_forecasts(points):
+    # Returns, for each (lat, lon) point, the daily forecast for the grid cell containing it and the
+    # coordinates of the forecast, or the exception raised while fetching it.
+    keys = [snap_to_grid(lat, lon, grid_resolution) for lat, lon in points]
+    forecasts = {key: forecast_cache.get(key) for key in set(keys)}
+    missing = [key for key, forecast in forecasts.items() if forecast is None]
+    metrics.inc("solar_cache_lookups_total", (("cache", "forecast"), ("result", "miss")), len(missing))
+    metrics.inc("solar_cache_lookups_total", (("cache", "forecast"), ("result", "hit")), len(forecasts) - len(missing))
+
+    # fetch the weather forecasts from open-meteo.com, several grid cells per request
+    expires = next_update_time(forecast_update_hours, forecast_update_delay_minutes)
+    for start in range(0, len(missing), max_locations_per_request):
+        chunk = missing[start:start + max_locations_per_request]
+        params = {
+            "latitude": [lat for lat, _ in chunk],
+            "longitude": [lon for _, lon in chunk],
+            "daily": daily_vars,
+            "timezone": "Europe/London"
+        }
+        metrics.inc("solar_upstream_requests_total", (("upstream", "open_meteo"),))
+        try:
+            responses = open_meteo.weather_api(open_meteo_url, params=params)
+            print(f"Successfully fetched {len(responses)} forecast(s) from open-meteo.")
+        except Exception as e:
+            print("Request Failed: ", e)
+            metrics.inc("solar_upstream_errors_total", (("upstream", "open_meteo"), ("kind", "error")))
+            for key in chunk:
+                forecasts[key] = e
+            continue
+        for key, response in zip(chunk, responses):
+            forecasts[key] = (parse_forecast(response), response.Latitude(), response.Longitude())
+            forecast_cache.put(key, forecasts[key], expires=expires)
+
+    results = []
+    for key in keys:
+        if isinstance(forecasts[key], Exception):
+            results.append(forecasts[key])
+        else:
+            forecast, lat, lon = forecasts[key]
+            results.append((forecast.copy(), lat, lon))
+    return results
 
-    predictions = rf.predict(forecast[rf.feature_names_in_])
-    print("Predictions made.")
 
+def timed(timer, stage, func, *args):
+    # Runs func in an upstream thread, recording how long it took as a span of the request's timer.
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        if timer is not None:
+            timer.record(stage, time.perf_counter() - start)
+
+
+def fetch_upstream(points, deadline=upstream_deadline):
+    # Looks up elevations in the offline grid while the forecasts are fetched. Returns a list of each, with an
+    # exception in place of any result that failed or was not ready by the deadline (in seconds).
+    start = time.monotonic()
+    timer = g.get("timer")
+    future = upstream_pool.submit(timed, timer, "forecast", get_forecasts, points)
+    elevations = timed(timer, "elevation", get_elevations, points)
+    try:
+        forecasts = future.result(timeout=max(0.0, deadline - (time.monotonic() - start)))
+    except TimeoutError:
+        print(f"The forecast lookup missed the {deadline}s deadline.")
+        metrics.inc("solar_upstream_errors_total", (("upstream", "open_meteo"), ("kind", "timeout")))
+        forecasts = [UpstreamTimeout("forecast lookup timed out")] * len(points)
+    except Exception as e:
+        print(f"The forecast lookup failed: {e}")
+        metrics.inc("solar_upstream_errors_total", (("upstream", "open_meteo"), ("kind", "error")))
+        forecasts = [e] * len(points)
+    return elevations, forecasts
+
+
+def build_features(forecast, elevation, model):
+    # Returns the inputs of model for a forecast, in the order of model.feature_names_in_, with the dates and
+    # user-friendly weather conditions of the rows that were kept.
+    # Cleaned in the same way as the training data (see solar_common/features.py).
+    columns = {**forecast, "Elevation (m)": np.full(len(forecast), elevation, dtype=np.float64)}
+    X, kept = build_matrix(columns, model.feature_names_in_)
+    conditions = forecast["weather_code"][kept].map(weather_code_mapping)  # user-friendly descriptions
+    return X, forecast["date"][kept], conditions
+
+
+def format_predictions(dates, conditions, predictions, power_rating=None):
+    # dates, conditions and predictions can be Series, arrays or lists, as long as they are in the same order.
     predictions_list = []
-    for i in range(len(predictions)):
+    for date, condition, prediction in zip(dates, conditions, predictions):
         pred_dict = {
-            "date": forecast["date"].iloc[i].strftime("%a %d/%m"),
-            "condition": conditions[i],
-            "value": float(predictions[i]),
+            "date": date.strftime("%a %d/%m"),
+            "condition": condition,
+            "value": float(prediction),
         }
         if power_rating is not None:
-            pred_dict["output"] = float(predictions[i]) * power_rating
+            pred_dict["output"] = float(prediction) * power_rating
         predictions_list.append(pred_dict)
+    return predictions_list
+
+
+def compute_forecast_grid(current):
+    # Fetches the forecast at every point of the national grid and predicts them all with one call to the forest
+    # of current, a ServedModel.
+    lats, lons = grid_axes(forecast_grid_bounds, forecast_grid_resolution)
+    lat_grid, lon_grid = np.meshgrid(lats, lons, indexing="ij")
+    lat_grid, lon_grid = lat_grid.ravel(), lon_grid.ravel()
+    elevations = np.full(len(lat_grid), np.nan)
+    todo = np.arange(len(lat_grid))
+    if uk_elevation is not None:
+        elevations = uk_elevation.lookup(lat_grid, lon_grid)
+        # Points at sea are skipped.
+        todo = np.flatnonzero(~uk_elevation.is_sea(lat_grid, lon_grid))
+    print(f"Computing the forecast grid for {len(todo)} of {len(lat_grid)} points...")
+
+    forecasts = []
+    for start in range(0, len(todo), max_locations_per_request):
+        chunk = todo[start:start + max_locations_per_request]
+        params = {
+            "latitude": [round(float(lat), 4) for lat in lat_grid[chunk]],
+            "longitude": [round(float(lon), 4) for lon in lon_grid[chunk]],
+            "daily": daily_vars,
+            "timezone": "Europe/London"
+        }
+        metrics.inc("solar_upstream_requests_total", (("upstream", "open_meteo"),))
+        forecasts += [parse_forecast(response) for response in open_meteo.weather_api(open_meteo_url, params=params)]
+
+    n_days = len(forecasts[0])
+    if any(len(forecast) != n_days for forecast in forecasts):
+        raise ValueError("The grid forecasts do not all cover the same days.")
+    columns = {var: np.concatenate([forecast[var].to_numpy() for forecast in forecasts]) for var in daily_vars}
+    elevations = np.where(np.isnan(elevations), fallback_elevation, elevations)
+    columns["Elevation (m)"] = np.repeat(elevations[todo], n_days)
+    X, kept = build_matrix(columns, current.model.feature_names_in_)
+    values = np.full(len(kept), np.nan, dtype=np.float32)
+    values[kept] = current.model.predict(X)
+
+    shape = (len(lats), len(lons), n_days)
+    predictions = np.full((len(lat_grid), n_days), np.nan, dtype=np.float32)
+    predictions[todo] = values.reshape(len(todo), n_days)
+    weather_codes = np.full((len(lat_grid), n_days), MISSING_CODE, dtype=np.int8)
+    weather_codes[todo] = np.nan_to_num(columns["weather_code"], nan=MISSING_CODE).reshape(len(todo), n_days)
+    meta = {
+        "bounds": list(forecast_grid_bounds),
+        "resolution": forecast_grid_resolution,
+        "dates": [date.strftime("%Y-%m-%d") for date in forecasts[0]["date"]],
+        "expires": next_update_time(forecast_update_hours, forecast_update_delay_minutes),
+        "model_version": current.version
+    }
+    path = forecast_grid.publish(predictions.reshape(shape), weather_codes.reshape(shape), meta)
+    print(f"Published the forecast grid to {path}.")
+
+
+def refresh_forecast_grid():
+    # Runs in a background thread of every worker. Whichever worker gets the lock computes the new grid
+    # after each forecast model run, and the others pick it up from disk.
+    # It also wakes up when a new model is swapped in, as the grid is only used for the model that made it.
+    while True:
+        failed = False
+        grid_wakeup.clear()
+        current = served
+        grid = forecast_grid.current(force=True)
+        if grid is None or not grid.is_current(current.version):
+            lock = forecast_grid.try_lock()
+            if lock is not None:
+                try:
+                    # Another worker may have published it while this one was waiting for the lock.
+                    grid = forecast_grid.current(force=True)
+                    if grid is None or not grid.is_current(current.version):
+                        timer = RequestTimer(metrics, "solar_stage_duration_seconds",
+                                             (("model_version", current.version),))
+                        with timer.span("forecast_grid"):
+                            compute_forecast_grid(current)
+                except Exception as e:
+                    print(f"Could not compute the forecast grid: {e}")
+                    failed = True
+                finally:
+                    lock.close()
+        wait = next_update_time(forecast_update_hours, forecast_update_delay_minutes) - time.time()
+        grid_wakeup.wait(min(wait, forecast_grid_retry) if failed else max(wait, 1))
+
+
+def start_grid_refresher():
+    # Called on the first request of each process, so that it runs in the gunicorn workers and not the master.
+    global grid_refresher_pid
+    if forecast_grid_enabled and grid_refresher_pid != os.getpid():
+        grid_refresher_pid = os.getpid()
+        threading.Thread(target=refresh_forecast_grid, name="forecast-grid", daemon=True).start()
+
+
+def swap_model(model, version, meta):
+    # Replaces the served model in one assignment. The old one is freed once the requests still using it finish.
+    global served
+    old_version = served.version
+    served = ServedModel(model, version, meta)
+    grid_wakeup.set()
+    gc.collect()
+    print(f"Now serving model {version} (was {old_version}). Memory: {memory_breakdown(process)}")
+
 
+def reload_models():
+    # Runs in a background thread of every worker, loading each new version of the registry once.
+    failed_version = None
+    while True:
+        time.sleep(model_reload_interval)
+        version = model_registry.current_version(model_registry_dir)
+        if version is None or version in (served.version, failed_version):
+            continue
+        print(f"Loading model {version}...")
+        try:
+            path = model_registry.model_path(model_registry_dir, version)
+            timer = RequestTimer(metrics, "solar_stage_duration_seconds", (("model_version", version),))
+            with timer.span("model_reload"):
+                # Not frozen, so that its memory can be released when it is replaced in turn.
+                model, load_time = load_version(path, freeze=False)
+                check_model(model)
+            meta = model_registry.read_meta(model_registry_dir, version)
+        except Exception as e:
+            print(f"Could not load model {version}, still serving {served.version}: {e}")
+            metrics.inc("solar_model_reloads_total", (("result", "failed"),))
+            failed_version = version
+            continue
+        metrics.inc("solar_model_reloads_total", (("result", "loaded"),))
+        print(f"Model {version} loaded and checked in {load_time:.2f}s.")
+        swap_model(model, version, meta)
+        del model
+
+
+def start_model_reloader():
+    # Called on the first request of each process, like start_grid_refresher.
+    global model_reloader_pid
+    if model_reload_interval > 0 and model_reloader_pid != os.getpid():
+        model_reloader_pid = os.getpid()
+        threading.Thread(target=reload_models, name="model-reload", daemon=True).start()
+
+
+def grid_prediction(lat, lon, power_rating=None):
+    # The response for a point from the national grid, or None if the live path has to be used.
+    if not forecast_grid_enabled or not isinstance(lat, (int, float)) or not isinstance(lon, (int, float)):
+        return None
+    grid = forecast_grid.current()
+    if grid is None or not grid.is_current(g.served.version, grace=forecast_grid_grace):
+        metrics.inc("solar_cache_lookups_total", (("cache", "forecast_grid"), ("result", "stale")))
+        return None
+    found = grid.lookup(lat, lon, interpolate=forecast_grid_interpolate)
+    if found is None:
+        metrics.inc("solar_cache_lookups_total", (("cache", "forecast_grid"), ("result", "miss")))
+        return None
+    metrics.inc("solar_cache_lookups_total", (("cache", "forecast_grid"), ("result", "hit")))
+
+    values, codes = found
+    # Days that have passed since the grid was computed are left out, as are days that were not predicted.
+    today = np.datetime64(datetime.now(london).date(), "D")
+    keep = ~np.isnan(values) & (grid.dates >= today)
+    conditions = [weather_code_mapping.get(code) for code in codes[keep].tolist()]
+    return {
+        "predictions": format_predictions(grid.dates[keep].tolist(), conditions, values[keep], power_rating),
+        "latitude": round(lat, 4),
+        "longitude": round(lon, 4)
+    }
+
+
+@app.route('/predict', methods=['POST'])
+def predict():
     print_memory_usage()
 
-    return jsonify({
+    data = request.get_json()
+    lat = data.get("latitude")
+    lon = data.get("longitude")
+    power_rating = data.get("power_rating", None)
+    print(f"Received coordinates: {lat}, {lon}")
+
+    with g.timer.span("grid"):
+        result = grid_prediction(lat, lon, power_rating)
+    if result is not None:
+        return jsonify(result)
+
+    with g.timer.span("upstream"):
+        (elevation,), (forecast,) = fetch_upstream([(lat, lon)])
+    if isinstance(forecast, Exception):
+        # Without a forecast there is nothing to predict from.
+        return jsonify({
+            "error": "The weather forecast is unavailable right now. Please try again shortly.",
+            "degraded": True
+        }), 503
+    warnings = []
+    if isinstance(elevation, Exception):
+        elevation = fallback_elevation
+        warnings.append(f"Elevation unavailable, assumed {fallback_elevation} m.")
+
+    forecast, lat, lon = forecast
+    with g.timer.span("features"):
+        features, dates, conditions = build_features(forecast, elevation, g.served.model)
+
+    with g.timer.span("predict"):
+        predictions = g.served.model.predict(features)
+    print("Predictions made.")
+
+    with g.timer.span("format"):
+        predictions_list = format_predictions(dates, conditions, predictions, power_rating)
+
+    print_memory_usage()
+
+    result = {
         "predictions": predictions_list,
         "latitude": round(lat, 4),
         "longitude": round(lon, 4)
-    })
+    }
+    if warnings:
+        result["degraded"] = True
+        result["warnings"] = warnings
+    return jsonify(result)
 
 
-def weather_code_to_category(data):
-    weather_map = {
-        0: 'clear',
-        1: 'partly_cloudy', 2: 'partly_cloudy',
-        3: 'overcast',
-        45: 'fog', 48: 'fog',
-        51: 'drizzle', 53: 'drizzle', 55: 'drizzle', 56: 'drizzle', 57: 'drizzle',
-        61: 'rain', 63: 'rain', 65: 'rain', 66: 'rain', 67: 'rain',
-        71: 'snow', 73: 'snow', 75: 'snow', 77: 'snow', 85: 'snow', 86: 'snow',
-        80: 'rain_showers', 81: 'rain_showers', 82: 'rain_showers',
-        95: 'thunderstorm', 96: 'thunderstorm', 99: 'thunderstorm'
-    }
-    data['weather_category'] = data['weather_code'].map(weather_map)
-
-    expected_weather_dummies = [
-        'weather_category_clear',
-        'weather_category_partly_cloudy',
-        'weather_category_overcast',
-        'weather_category_fog',
-        'weather_category_drizzle',
-        'weather_category_rain',
-        'weather_category_snow',
-        'weather_category_rain_showers',
-        'weather_category_thunderstorm'
-    ]
-
-    data = pd.get_dummies(data, columns=['weather_category'], drop_first=False)
-    # Add back missing columns
-    for col in expected_weather_dummies:
-        if col not in data.columns:
-            data[col] = False
-    data = data.drop(columns=['weather_code', 'weather_category_clear'])
-
-    return data
+@app.route('/predict/batch', methods=['POST'])
+def predict_batch():
+    # Takes {"sites": [{"latitude": ..., "longitude": ..., "power_rating": ...}, ...]} and streams back
+    # one JSON object per line for each site, in the same order, with either "predictions" or "error".
+    print_memory_usage()
+
+    data = request.get_json(silent=True) or {}
+    sites = data.get("sites")
+    if not isinstance(sites, list) or not sites:
+        return jsonify({"error": "Expected a non-empty list of sites."}), 400
+    if len(sites) > max_batch_sites:
+        return jsonify({"error": f"At most {max_batch_sites} sites per batch."}), 400
+    print(f"Received batch of {len(sites)} sites.")
+
+    results = [{"index": i} for i in range(len(sites))]
+    points = {}
+    for i, site in enumerate(sites):
+        try:
+            lat = float(site["latitude"])
+            lon = float(site["longitude"])
+        except (KeyError, TypeError, ValueError):
+            results[i]["error"] = "Each site needs numeric latitude and longitude."
+            continue
+        points[i] = (lat, lon)
+
+    with g.timer.span("upstream"):
+        elevations, forecasts = fetch_upstream(list(points.values()), deadline=batch_upstream_deadline)
+
+    # Build one feature matrix for every site, so the forest is only called once.
+    site_features = []
+    with g.timer.span("features"):
+        for i, elevation, forecast in zip(points, elevations, forecasts):
+            if isinstance(forecast, Exception):
+                results[i]["error"] = "Could not fetch the forecast for this site."
+                continue
+            if isinstance(elevation, Exception):
+                elevation = fallback_elevation
+                results[i]["degraded"] = True
+                results[i]["warnings"] = [f"Elevation unavailable, assumed {fallback_elevation} m."]
+            forecast, lat, lon = forecast
+            try:
+                features, dates, conditions = build_features(forecast, elevation, g.served.model)
+            except Exception as e:
+                print(f"Could not build features for site {i}: {e}")
+                results[i]["error"] = "Could not build features for this site."
+                continue
+            results[i]["latitude"] = round(lat, 4)
+            results[i]["longitude"] = round(lon, 4)
+            site_features.append((i, features, dates, conditions))
+
+    if site_features:
+        with g.timer.span("predict"):
+            predictions = g.served.model.predict(np.concatenate([features for _, features, _, _ in site_features]))
+        print(f"Predictions made for {len(site_features)} sites.")
+        start = 0
+        with g.timer.span("format"):
+            for i, features, dates, conditions in site_features:
+                site_predictions = predictions[start:start + len(features)]
+                start += len(features)
+                results[i]["predictions"] = format_predictions(dates, conditions, site_predictions,
+                                                               sites[i].get("power_rating"))
+
+    print_memory_usage()
+
+    def generate():
+        for result in results:
+            yield json.dumps(result) + "\n"
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+def heatmap_tile(day, z, x, y, grid):
+    # Predicted efficiency of each cell of a map tile on a day of the forecast, quantized (see heatmap.py), read
+    # from the national forecast grid so that tiles never fetch forecasts of their own.
+    # Returns the cells and the date, or None for a day the grid does not cover.
+    lats, lons = cell_centres(z, x, y, heatmap_cells)
+    index = int((np.datetime64(datetime.now(london).date(), "D") + day - grid.dates[0]).astype(int))
+    if not 0 <= index < grid.n_days:
+        return quantize(np.full(lats.shape, np.nan)), None
+    values = grid.lookup_many(lats, lons, index, interpolate=forecast_grid_interpolate)
+    if uk_elevation is not None:
+        # Cells at sea whose nearest grid point is on land.
+        values[uk_elevation.is_sea(lats.ravel(), lons.ravel()).reshape(lats.shape)] = np.nan
+    return quantize(values), str(grid.dates[index])
+
+
+@app.route('/heatmap/<int:day>/<int:z>/<int:x>/<int:y>.<fmt>')
+def heatmap(day, z, x, y, fmt):
+    # A map tile of predicted efficiency on a day of the forecast (0 is today), for a Leaflet tile layer.
+    # fmt "png" is a coloured image, and "bin" is one byte per cell, row by row from the north-west corner:
+    # the efficiency in steps of X-Heatmap-Scale kWh/kW, or 255 where there is no prediction.
+    if fmt not in ("png", "bin") or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return jsonify({"error": "Unknown tile."}), 404
+    if not 0 <= day < heatmap_days or not heatmap_zoom[0] <= z <= heatmap_zoom[1]:
+        return jsonify({"error": f"Tiles are available for days 0-{heatmap_days - 1} and zoom levels "
+                                 f"{heatmap_zoom[0]}-{heatmap_zoom[1]}."}), 400
+    if not forecast_grid_enabled:
+        return jsonify({"error": "The heatmap needs the forecast grid (FORECAST_GRID=1)."}), 404
+    grid = forecast_grid.current()
+    if grid is None or not grid.is_current(g.served.version, grace=forecast_grid_grace):
+        response = jsonify({"error": "The forecast grid is being computed."})
+        response.headers["Retry-After"] = str(forecast_grid_retry)
+        return response, 503
+
+    # Tiles of older grids are left to expire.
+    key = (grid.name, day, z, x, y)
+    tile = heatmap_cache.get(key)
+    metrics.inc("solar_cache_lookups_total", (("cache", "heatmap"), ("result", "miss" if tile is None else "hit")))
+    if tile is None:
+        with g.timer.span("heatmap"):
+            tile = heatmap_tile(day, z, x, y, grid)
+        heatmap_cache.put(key, tile, expires=grid.expires + forecast_grid_grace)
+    cells, date = tile
+    expires = next_update_time(forecast_update_hours, forecast_update_delay_minutes)
+
+    if fmt == "png":
+        response = Response(encode_png(cells), mimetype="image/png")
+    else:
+        response = Response(cells.tobytes(), mimetype="application/octet-stream")
+    min_lat, max_lat, min_lon, max_lon = tile_bounds(z, x, y)
+    response.headers["Cache-Control"] = f"public, max-age={max(0, int(expires - time.time()))}"
+    response.headers["X-Heatmap-Date"] = date or ""
+    response.headers["X-Heatmap-Size"] = str(heatmap_cells)
+    response.headers["X-Heatmap-Scale"] = str(SCALE)
+    response.headers["X-Heatmap-Bounds"] = f"{min_lat:.6f},{min_lon:.6f},{max_lat:.6f},{max_lon:.6f}"
+    return response
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/model')
+def model_info():
+    # The version this worker is serving, and what the registry recorded about it.
+    return jsonify({"version": g.served.version, "engine": model_engine, "meta": g.served.meta})
+
+
+@app.route('/cache-stats')
+def cache_stats():
+    return jsonify({
+        "forecast": forecast_cache.stats(),
+        "heatmap": heatmap_cache.stats()
+    })
 
 
 if __name__ == '__main__':
@@ -0,0 +1,139 @@
+import math
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe in-process LRU cache with optional expiry times, optionally backed by a SQLite file so
+    that several gunicorn workers can share entries.
+
+    Parameters:
+        max_entries (int): Maximum number of entries kept in memory (and in the shared file).
+        filepath (str): Path of a SQLite file shared between processes. Default is memory only.
+    """
+
+    def __init__(self, max_entries=1024, filepath=None):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.filepath = filepath
+        self.connection = None
+        self.pid = None
+
+    def _connect(self):
+        # The shared file's connection, opened in each process the first time it is used. A SQLite connection
+        # must not be used across fork(), and the app is imported in the gunicorn master before the workers
+        # are forked (see gunicorn.conf.py). Called with the lock held.
+        if self.filepath is None:
+            return None
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.connection = sqlite3.connect(self.filepath, timeout=5, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, expires REAL, last_access REAL)"
+            )
+            self.connection.commit()
+        return self.connection
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self.entries[key]
+
+            connection = self._connect()
+            if connection is not None:
+                row = connection.execute(
+                    "SELECT value, expires FROM entries WHERE key = ? AND (expires IS NULL OR expires > ?)",
+                    (repr(key), now)
+                ).fetchone()
+                if row is not None:
+                    value = pickle.loads(row[0])
+                    self._put_memory(key, value, row[1])
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def put(self, key, value, expires=None):
+        # expires is a Unix timestamp. None keeps the entry until it is evicted.
+        with self.lock:
+            self._put_memory(key, value, expires)
+            connection = self._connect()
+            if connection is not None:
+                try:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                        (repr(key), pickle.dumps(value), expires, time.time())
+                    )
+                    connection.execute(
+                        "DELETE FROM entries WHERE key NOT IN "
+                        "(SELECT key FROM entries ORDER BY last_access DESC LIMIT ?)",
+                        (self.max_entries,)
+                    )
+                    connection.commit()
+                except sqlite3.OperationalError as e:
+                    # Another worker holds the lock. The entry is still cached in this process.
+                    print(f"Could not write to shared cache: {e}")
+
+    def _put_memory(self, key, value, expires):
+        self.entries[key] = (value, expires)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        # Empties this process's entries. The shared file, if any, is left alone.
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+
+def snap_to_grid(lat, lon, resolution):
+    # Returns the centre of the grid cell containing the point, so every point in a cell shares one key.
+    return (
+        round((math.floor(lat / resolution) + 0.5) * resolution, 4),
+        round((math.floor(lon / resolution) + 0.5) * resolution, 4)
+    )
+
+
+def next_update_time(cycle_hours, delay_minutes=0, now=None):
+    # Forecast models are rerun every cycle_hours (from 00:00 UTC) and take delay_minutes to be published.
+    # A forecast fetched now stays current until the next run is published.
+    if now is None:
+        now = time.time()
+    cycle = cycle_hours * 3600
+    delay = delay_minutes * 60
+    return (math.floor((now - delay) / cycle) + 1) * cycle + delay
+
+
+def shared_cache_path(name):
+    # Set CACHE_DIR to share the caches between gunicorn workers on the same machine.
+    cache_dir = os.getenv("CACHE_DIR")
+    if not cache_dir:
+        return None
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, f"{name}.sqlite")
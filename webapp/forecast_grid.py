@@ -0,0 +1,203 @@
+import json
+import os
+import time
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows, where there is only ever one development server
+    fcntl = None
+
+
+MISSING_CODE = -1
+
+
+def grid_axes(bounds, resolution):
+    # Latitudes and longitudes of the grid points, from the south-west corner.
+    min_lat, max_lat, min_lon, max_lon = bounds
+    n_rows = int(round((max_lat - min_lat) / resolution)) + 1
+    n_cols = int(round((max_lon - min_lon) / resolution)) + 1
+    return min_lat + np.arange(n_rows) * resolution, min_lon + np.arange(n_cols) * resolution
+
+
+class ForecastGrid:
+    """
+    Daily predictions for every point of a regular lat/lon grid, memory-mapped read-only from a
+    snapshot written by GridStore.publish().
+
+    predictions has shape (rows, columns, days) in kWh/kW, with NaN where there is no prediction,
+    and weather_codes has the forecast weather code of each day, or MISSING_CODE.
+
+    Parameters:
+        path (str): Path of the snapshot, without the extensions.
+    """
+
+    def __init__(self, path):
+        with open(path + ".json") as f:
+            self.meta = json.load(f)
+        self.name = os.path.basename(path)
+        self.min_lat, self.max_lat, self.min_lon, self.max_lon = self.meta["bounds"]
+        self.resolution = self.meta["resolution"]
+        self.dates = np.array(self.meta["dates"], dtype="datetime64[D]")
+        self.expires = self.meta["expires"]
+        self.model_version = self.meta["model_version"]
+        # Plain array views of the memory maps, which are quicker to index than np.memmap.
+        self.predictions = np.asarray(np.load(path + ".predictions.npy", mmap_mode="r"))
+        self.weather_codes = np.asarray(np.load(path + ".codes.npy", mmap_mode="r"))
+        self.n_rows, self.n_cols, self.n_days = self.predictions.shape
+
+    def is_current(self, model_version, grace=0, now=None):
+        # A grid is only used for the model that made it, and until grace seconds after the next forecast run.
+        if now is None:
+            now = time.time()
+        return self.model_version == model_version and now < self.expires + grace
+
+    def lookup(self, lat, lon, interpolate=True):
+        """
+        Looks up one point in constant time.
+
+        Parameters:
+            lat (float): Latitude.
+            lon (float): Longitude.
+            interpolate (bool): Interpolate the predictions bilinearly between the four surrounding grid
+                points, when they all have data. Otherwise (and for the weather codes) the nearest point is used.
+
+        Returns:
+            tuple: (predictions, weather codes) as arrays with one value per day, or None outside the
+                grid or where it has no data.
+        """
+        y = (lat - self.min_lat) / self.resolution
+        x = (lon - self.min_lon) / self.resolution
+        if not (0 <= y <= self.n_rows - 1 and 0 <= x <= self.n_cols - 1):
+            return None
+        nearest = np.array(self.predictions[int(round(y)), int(round(x))])
+        if np.isnan(nearest).all():
+            return None
+        codes = np.array(self.weather_codes[int(round(y)), int(round(x))])
+        if not interpolate or self.n_rows < 2 or self.n_cols < 2:
+            return nearest, codes
+
+        row = min(int(y), self.n_rows - 2)
+        col = min(int(x), self.n_cols - 2)
+        dy = y - row
+        dx = x - col
+        corners = self.predictions[row:row + 2, col:col + 2]
+        if np.isnan(corners).any():
+            # On the coast, or a day was dropped by cleaning at one of the corners.
+            return nearest, codes
+        top = corners[0, 0] * (1 - dx) + corners[0, 1] * dx
+        bottom = corners[1, 0] * (1 - dx) + corners[1, 1] * dx
+        return (top * (1 - dy) + bottom * dy).astype(np.float32), codes
+
+    def lookup_many(self, lats, lons, day, interpolate=True):
+        # Vectorised lookup() of one day's predictions, with NaN outside the grid or where it has no data.
+        lats, lons = np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64)
+        y = (lats - self.min_lat) / self.resolution
+        x = (lons - self.min_lon) / self.resolution
+        values = np.full(lats.shape, np.nan, dtype=np.float32)
+        inside = (y >= 0) & (y <= self.n_rows - 1) & (x >= 0) & (x <= self.n_cols - 1)
+        y, x = y[inside], x[inside]
+        day_predictions = self.predictions[:, :, day]
+        nearest = day_predictions[np.round(y).astype(np.intp), np.round(x).astype(np.intp)]
+        if not interpolate or self.n_rows < 2 or self.n_cols < 2:
+            values[inside] = nearest
+            return values
+
+        row = np.minimum(y.astype(np.intp), self.n_rows - 2)
+        col = np.minimum(x.astype(np.intp), self.n_cols - 2)
+        dy = y - row
+        dx = x - col
+        top = day_predictions[row, col] * (1 - dx) + day_predictions[row, col + 1] * dx
+        bottom = day_predictions[row + 1, col] * (1 - dx) + day_predictions[row + 1, col + 1] * dx
+        interpolated = top * (1 - dy) + bottom * dy
+        # Where a corner has no data, the nearest point is used, like lookup().
+        values[inside] = np.where(np.isnan(interpolated), nearest, interpolated)
+        return values
+
+
+class GridStore:
+    """
+    Publishes grids to a directory and keeps the newest one open. Several processes can share the
+    directory: the file "current" names the newest snapshot and is replaced atomically when a new one
+    is published, and readers check it at most every check_interval seconds.
+
+    Parameters:
+        directory (str): Directory of the snapshots.
+        check_interval (float): Seconds between checks for a newer snapshot.
+        keep (int): Number of snapshots kept on disk.
+    """
+
+    def __init__(self, directory, check_interval=10, keep=2):
+        self.directory = directory
+        self.check_interval = check_interval
+        self.keep = keep
+        self.name = None
+        self.grid = None
+        self.checked = -np.inf
+
+    def current(self, force=False):
+        # Returns the newest ForecastGrid, or None if none has been published.
+        now = time.monotonic()
+        if force or now - self.checked >= self.check_interval:
+            self.checked = now
+            try:
+                with open(os.path.join(self.directory, "current")) as f:
+                    name = f.read().strip()
+            except FileNotFoundError:
+                name = None
+            if name != self.name:
+                try:
+                    self.grid = ForecastGrid(os.path.join(self.directory, name)) if name else None
+                    self.name = name
+                except FileNotFoundError:
+                    # Replaced again while it was being opened. The next check will find the newer one.
+                    pass
+        return self.grid
+
+    def publish(self, predictions, weather_codes, meta):
+        """
+        Saves a new snapshot and makes it the current one.
+
+        Parameters:
+            predictions (np.ndarray): Shape (rows, columns, days), NaN where there is no prediction.
+            weather_codes (np.ndarray): Same shape, MISSING_CODE where there is no forecast.
+            meta (dict): "bounds", "resolution", "dates" (ISO strings), "expires" (Unix time) and
+                "model_version".
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"grid-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        path = os.path.join(self.directory, name)
+        np.save(path + ".predictions.npy", predictions.astype(np.float32))
+        np.save(path + ".codes.npy", weather_codes.astype(np.int8))
+        with open(path + ".json", "w") as f:
+            json.dump(meta, f)
+
+        pointer = os.path.join(self.directory, "current")
+        with open(pointer + ".tmp", "w") as f:
+            f.write(name)
+        os.replace(pointer + ".tmp", pointer)
+
+        # Older snapshots can be removed even if another process still has them mapped.
+        snapshots = sorted(filename[:-len(".json")] for filename in os.listdir(self.directory)
+                           if filename.startswith("grid-") and filename.endswith(".json"))
+        for old in [snapshot for snapshot in snapshots[:-self.keep] if snapshot != name]:
+            for extension in (".json", ".predictions.npy", ".codes.npy"):
+                try:
+                    os.remove(os.path.join(self.directory, old + extension))
+                except FileNotFoundError:
+                    pass
+        return path
+
+    def try_lock(self):
+        # Returns an open lock file if this process may compute the next grid, or None if another one is.
+        # Closing the file releases the lock.
+        os.makedirs(self.directory, exist_ok=True)
+        lock = open(os.path.join(self.directory, "refresh.lock"), "w")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                return None
+        return lock
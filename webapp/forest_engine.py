@@ -0,0 +1,188 @@
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+
+ARRAYS = ("feature", "threshold", "left", "right", "value", "roots")
+
+
+def _round_down_float32(values):
+    # The trees compare float32 inputs with float64 thresholds. For a float32 x, x <= t exactly when
+    # x <= (the largest float32 not above t), so rounding thresholds down to float32 loses nothing.
+    rounded = values.astype(np.float32)
+    too_big = rounded.astype(np.float64) > values
+    rounded[too_big] = np.nextafter(rounded[too_big], np.float32(-np.inf))
+    return rounded
+
+
+def _smallest_lossless(values, dtypes):
+    for dtype in dtypes:
+        if np.array_equal(values.astype(dtype).astype(values.dtype), values):
+            return values.astype(dtype)
+    return values
+
+
+def flatten_forest(rf):
+    """
+    Flattens a fitted single-output RandomForestRegressor into contiguous NumPy arrays.
+
+    All trees are concatenated into one node table. Children are absolute node indices. Leaves point
+    to themselves (with feature 0 and threshold 0), so traversal can keep stepping once a leaf is reached
+    without checking for leaves.
+
+    Returns:
+        dict: The arrays (see ARRAYS), plus "feature_names" and "max_depth".
+    """
+    trees = [estimator.tree_ for estimator in rf.estimators_]
+    if any(tree.n_outputs != 1 for tree in trees):
+        raise ValueError("Only single-output forests are supported.")
+
+    node_counts = np.array([tree.node_count for tree in trees])
+    roots = np.concatenate([[0], np.cumsum(node_counts)[:-1]])
+    feature, threshold, left, right, value = [], [], [], [], []
+    for root, tree in zip(roots, trees):
+        nodes = np.arange(tree.node_count)
+        is_leaf = tree.children_left == -1
+        feature.append(np.where(is_leaf, 0, tree.feature))
+        threshold.append(np.where(is_leaf, 0.0, tree.threshold))
+        left.append(np.where(is_leaf, nodes, tree.children_left) + root)
+        right.append(np.where(is_leaf, nodes, tree.children_right) + root)
+        value.append(tree.value[:, 0, 0])
+
+    n_nodes = int(node_counts.sum())
+    index_dtype = np.int32 if n_nodes < 2 ** 31 else np.int64
+    feature_names = getattr(rf, "feature_names_in_", None)
+    return {
+        "feature": _smallest_lossless(np.concatenate(feature), (np.uint8, np.uint16, np.int32)),
+        "threshold": _round_down_float32(np.concatenate(threshold)),
+        "left": np.concatenate(left).astype(index_dtype),
+        "right": np.concatenate(right).astype(index_dtype),
+        "value": _smallest_lossless(np.concatenate(value), (np.float32,)),
+        "roots": roots.astype(index_dtype),
+        "feature_names": [] if feature_names is None else [str(name) for name in feature_names],
+        "max_depth": int(max(tree.max_depth for tree in trees))
+    }
+
+
+class CompactForest:
+    """
+    Predicts from the flattened arrays of a random forest, stepping the (row, tree) pairs that are not at
+    a leaf yet down one level at a time with vectorised NumPy indexing.
+
+    Parameters:
+        arrays (dict): As returned by flatten_forest().
+    """
+
+    def __init__(self, arrays, rows_per_chunk=20000):
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.feature_names_in_ = np.array(arrays["feature_names"], dtype=object)
+        self.max_depth = arrays["max_depth"]
+        self.n_features_in_ = len(self.feature_names_in_)
+        self.rows_per_chunk = rows_per_chunk
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2:
+            raise ValueError("X must be 2-dimensional.")
+        predictions = np.empty(len(X), dtype=np.float64)
+        for start in range(0, len(X), self.rows_per_chunk):
+            predictions[start:start + self.rows_per_chunk] = self._predict_chunk(X[start:start + self.rows_per_chunk])
+        return predictions
+
+    def _predict_chunk(self, X):
+        # One entry per (row, tree) pair. Only the pairs that have not reached a leaf are stepped, so the loop
+        # stops once every pair is at a leaf, and shallow leaves are not stepped max_depth times.
+        n_trees = len(self.roots)
+        nodes = np.tile(self.roots.astype(np.intp), len(X))
+        rows = np.repeat(np.arange(len(X)), n_trees)
+        active = np.flatnonzero(self.left[nodes] != nodes)
+        while len(active):
+            current = nodes[active]
+            go_left = X[rows[active], self.feature[current]] <= self.threshold[current]
+            following = np.where(go_left, self.left[current], self.right[current])
+            nodes[active] = following
+            active = active[self.left[following] != following]
+        return self.value[nodes].reshape(len(X), n_trees).mean(axis=1, dtype=np.float64)
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in ARRAYS)
+
+
+def save_forest(arrays, directory):
+    # One uncompressed .npy file per array, so they can be memory-mapped and shared between processes.
+    os.makedirs(directory, exist_ok=True)
+    for name in ARRAYS:
+        np.save(os.path.join(directory, f"{name}.npy"), np.ascontiguousarray(arrays[name]))
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump({"feature_names": arrays["feature_names"], "max_depth": arrays["max_depth"]}, f)
+    return directory
+
+
+def load_forest(directory, mmap=True):
+    with open(os.path.join(directory, "meta.json")) as f:
+        arrays = json.load(f)
+    for name in ARRAYS:
+        arrays[name] = np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r" if mmap else None)
+    return CompactForest(arrays)
+
+
+def forest_path(model_path):
+    base, _ = os.path.splitext(model_path)
+    return f"{base}.forest"
+
+
+def export_forest(rf, directory, X_check=None, rtol=1e-6, atol=1e-6):
+    """
+    Flattens a forest and saves it to a directory, checking that it predicts the same as scikit-learn.
+
+    Parameters:
+        rf (RandomForestRegressor): The fitted forest.
+        directory (str): Where to save the arrays.
+        X_check (array-like): Rows to compare predictions on. Default is random rows.
+
+    Returns:
+        CompactForest: The exported forest.
+    """
+    arrays = flatten_forest(rf)
+    forest = CompactForest(arrays)
+    if X_check is None:
+        X_check = np.random.default_rng(0).normal(size=(1000, rf.n_features_in_)) * 100
+        if arrays["feature_names"]:
+            import pandas as pd
+            X_check = pd.DataFrame(X_check, columns=arrays["feature_names"])
+    expected = rf.predict(X_check)
+    actual = forest.predict(X_check)
+    if not np.allclose(actual, expected, rtol=rtol, atol=atol):
+        raise ValueError(f"Exported forest does not match: max difference {np.abs(actual - expected).max()}.")
+    save_forest(arrays, directory)
+    return forest
+
+
+if __name__ == "__main__":
+    # Usage: python forest_engine.py rf_100_v1.pkl [rf_100_v1.forest]
+    import joblib
+    import pandas as pd
+
+    model_path = sys.argv[1]
+    directory = sys.argv[2] if len(sys.argv) > 2 else forest_path(model_path)
+    rf = joblib.load(model_path)
+    X_check = pd.DataFrame(np.random.default_rng(0).normal(size=(7, rf.n_features_in_)) * 100,
+                           columns=rf.feature_names_in_)
+    forest = export_forest(rf, directory)
+
+    start = time.perf_counter()
+    for _ in range(100):
+        rf.predict(X_check)
+    sklearn_time = (time.perf_counter() - start) / 100
+    start = time.perf_counter()
+    for _ in range(100):
+        forest.predict(X_check)
+    compact_time = (time.perf_counter() - start) / 100
+
+    print(f"Saved to {directory}: {forest.nbytes() / 1048576:.2f} MiB of arrays "
+          f"(model file is {os.path.getsize(model_path) / 1048576:.2f} MiB).")
+    print(f"7-row prediction: scikit-learn {sklearn_time * 1000:.2f} ms, compact {compact_time * 1000:.2f} ms.")
@@ -0,0 +1,22 @@
+import os
+
+import psutil
+
+from metrics import clear_directory
+from model_loading import memory_breakdown
+
+
+# Load the app (and the model) once in the master process. Workers are forked from it and share the
+# compact model's memory-mapped arrays (see model_loading.load_compact_model) instead of each loading a copy.
+preload_app = True
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+timeout = 120
+
+
+def post_fork(server, worker):
+    server.log.info(f"Worker {worker.pid} memory: {memory_breakdown(psutil.Process(worker.pid))}")
+
+
+def on_starting(server):
+    # Worker metrics are added up from files in METRICS_DIR (see metrics.py), so start from an empty directory.
+    clear_directory(os.getenv("METRICS_DIR"))
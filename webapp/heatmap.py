@@ -0,0 +1,92 @@
+import math
+import struct
+import zlib
+
+import numpy as np
+
+
+# Predictions are stored as one byte per cell: the efficiency in steps of SCALE kWh/kW, or NO_DATA.
+SCALE = 0.03
+NO_DATA = 255
+# Colour ramp from low (blue) to high (red) efficiency, as (position, RGB) stops.
+COLOUR_STOPS = [
+    (0.0, (49, 54, 149)),
+    (0.25, (69, 117, 180)),
+    (0.5, (254, 224, 144)),
+    (0.75, (244, 109, 67)),
+    (1.0, (165, 0, 38))
+]
+
+
+def tile_bounds(z, x, y):
+    # (min lat, max lat, min lon, max lon) of a Web Mercator (slippy map) tile, as used by Leaflet.
+    n = 2 ** z
+    return tile_latitude(y + 1, n), tile_latitude(y, n), x / n * 360 - 180, (x + 1) / n * 360 - 180
+
+
+def tile_latitude(y, n):
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+
+def cell_centres(z, x, y, size):
+    """
+    Centres of a size x size grid of cells covering a tile, evenly spaced in the map's projection so
+    each cell is a square block of pixels.
+
+    Returns:
+        tuple: (latitudes, longitudes), each of shape (size, size), with the first row at the top (north).
+    """
+    n = 2 ** z
+    offsets = (np.arange(size) + 0.5) / size
+    lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + offsets) / n))))
+    lons = (x + offsets) / n * 360 - 180
+    return np.meshgrid(lats, lons, indexing="ij")
+
+
+def quantize(values):
+    # float predictions (NaN for no data) to one byte per cell.
+    steps = np.clip(np.round(np.nan_to_num(values, nan=0) / SCALE), 0, NO_DATA - 1)
+    return np.where(np.isnan(values), NO_DATA, steps).astype(np.uint8)
+
+
+def make_palette():
+    positions = np.linspace(0, 1, NO_DATA)
+    stops = [position for position, _ in COLOUR_STOPS]
+    palette = np.zeros((256, 3), dtype=np.uint8)
+    for channel in range(3):
+        palette[:NO_DATA, channel] = np.interp(positions, stops, [colour[channel] for _, colour in COLOUR_STOPS])
+    return palette
+
+
+PALETTE = make_palette()
+
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+def encode_png(cells, max_value=7.5):
+    """
+    Encodes quantized cells as an 8-bit indexed PNG, with NO_DATA transparent. No imaging library is
+    needed, as an indexed PNG is just the palette and the zlib-compressed rows.
+
+    Parameters:
+        cells (np.ndarray): uint8 array from quantize(), first row at the top.
+        max_value (float): Efficiency (kWh/kW) at the top of the colour ramp.
+
+    Returns:
+        bytes: The PNG file.
+    """
+    height, width = cells.shape
+    # Spread the values up to max_value over the whole colour ramp.
+    indices = np.where(cells == NO_DATA, NO_DATA,
+                       np.minimum(cells.astype(np.float32) * SCALE / max_value * (NO_DATA - 1), NO_DATA - 1))
+    indices = indices.astype(np.uint8)
+    rows = np.hstack([np.zeros((height, 1), dtype=np.uint8), indices])  # filter type 0 before each row
+    alpha = bytes([255] * NO_DATA + [0])
+    return (b"\x89PNG\r\n\x1a\n"
+            + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0))
+            + _png_chunk(b"PLTE", PALETTE.tobytes())
+            + _png_chunk(b"tRNS", alpha)
+            + _png_chunk(b"IDAT", zlib.compress(rows.tobytes(), 6))
+            + _png_chunk(b"IEND", b""))
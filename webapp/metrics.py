@@ -0,0 +1,237 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import psutil
+
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Maximum number of series (each histogram bucket is one) per process.
+CAPACITY = 4096
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+
+class Registry:
+    """
+    Counters and histograms kept in one float64 array, and rendered in the Prometheus text format.
+
+    Each series (a metric name and its labels) gets a slot in the array the first time it is used,
+    so recording a value is a dict lookup and an addition. With a directory (set METRICS_DIR), each
+    process keeps its array in a memory-mapped file there, with its list of series next to it, and
+    render() adds up the files of every gunicorn worker. Otherwise only this process is reported.
+
+    Parameters:
+        directory (str): Directory shared by the worker processes. Default is this process only.
+        capacity (int): Maximum number of series. Later series are dropped with a warning.
+    """
+
+    def __init__(self, directory=None, capacity=CAPACITY):
+        self.directory = directory
+        self.capacity = capacity
+        self.families = {}
+        self.gauges = []
+        self.keys = []
+        self.slots = {}
+        self.lock = threading.Lock()
+        self.pid = None
+        self.values = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def counter(self, name, help_text):
+        self.families[name] = ("counter", help_text, None)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.families[name] = ("histogram", help_text, tuple(buckets))
+
+    def gauge(self, name, help_text, func):
+        # func() returns a list of (labels, value), and is called each time the metrics are rendered.
+        self.gauges.append((name, help_text, func))
+
+    def _array(self):
+        # The array is created on first use in each process, so forked workers do not share the master's.
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            if self.directory:
+                self.values = np.memmap(os.path.join(self.directory, f"{self.pid}.bin"), dtype=np.float64,
+                                        mode="w+", shape=(self.capacity,))
+                self._save_keys()
+            else:
+                self.values = np.zeros(self.capacity)
+        return self.values
+
+    def _save_keys(self):
+        path = os.path.join(self.directory, f"{self.pid}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.keys, f)
+        os.replace(path + ".tmp", path)
+
+    def _slot(self, name, labels):
+        key = (name, labels)
+        slot = self.slots.get(key)
+        if slot is None:
+            if len(self.keys) >= self.capacity:
+                print(f"WARNING: Metrics are full, dropping {name}{format_labels(labels)}.")
+                return None
+            slot = self.slots[key] = len(self.keys)
+            self.keys.append(key)
+            if self.directory:
+                self._save_keys()
+        return slot
+
+    def inc(self, name, labels=(), amount=1):
+        # labels is a tuple of (name, value) pairs, in the same order every time.
+        with self.lock:
+            values = self._array()
+            slot = self._slot(name, labels)
+            if slot is not None:
+                values[slot] += amount
+
+    def observe(self, name, labels, value):
+        buckets = self.families[name][2]
+        # Buckets are counted separately here and made cumulative when rendered.
+        le = bisect.bisect_left(buckets, value)
+        with self.lock:
+            values = self._array()
+            for key, amount in (((f"{name}_bucket", labels + (("le", le),)), 1),
+                                ((f"{name}_sum", labels), value),
+                                ((f"{name}_count", labels), 1)):
+                slot = self._slot(*key)
+                if slot is not None:
+                    values[slot] += amount
+
+    def collect(self):
+        # Returns {(name, labels): value}, summed over every process writing to the directory.
+        with self.lock:
+            self._array()
+            if not self.directory:
+                return {key: float(value) for key, value in zip(self.keys, self.values)}
+        totals = {}
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json"):
+                continue
+            base = os.path.join(self.directory, filename[:-len(".json")])
+            try:
+                with open(base + ".json") as f:
+                    keys = json.load(f)
+                values = np.fromfile(base + ".bin", dtype=np.float64, count=len(keys))
+            except (OSError, ValueError):
+                continue
+            for (name, labels), value in zip(keys, values):
+                key = (name, tuple(tuple(label) for label in labels))
+                totals[key] = totals.get(key, 0.0) + float(value)
+        return totals
+
+    def pids(self):
+        # Live processes with metrics in the directory, for per-process gauges.
+        if not self.directory:
+            return [os.getpid()]
+        pids = {os.getpid()}
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".bin") and filename[:-4].isdigit() and psutil.pid_exists(int(filename[:-4])):
+                pids.add(int(filename[:-4]))
+        return sorted(pids)
+
+    def render(self):
+        totals = self.collect()
+        by_name = {}
+        for (name, labels), value in totals.items():
+            by_name.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name, (kind, help_text, buckets) in self.families.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            if kind == "counter":
+                lines += [f"{name}{format_labels(labels)} {format_value(value)}"
+                          for labels, value in by_name.get(name, [])]
+                continue
+            counts = {}
+            for labels, value in by_name.get(f"{name}_bucket", []):
+                counts[(labels[:-1], labels[-1][1])] = value
+            sums = dict(by_name.get(f"{name}_sum", []))
+            for labels, count in by_name.get(f"{name}_count", []):
+                cumulative = 0
+                for i, bound in enumerate(buckets + ("+Inf",)):
+                    cumulative += counts.get((labels, i), 0)
+                    bucket_labels = format_labels(labels + (("le", bound),))
+                    lines.append(f"{name}_bucket{bucket_labels} {format_value(cumulative)}")
+                lines.append(f"{name}_sum{format_labels(labels)} {format_value(sums.get(labels, 0.0))}")
+                lines.append(f"{name}_count{format_labels(labels)} {format_value(count)}")
+        for name, help_text, func in self.gauges:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            lines += [f"{name}{format_labels(labels)} {format_value(value)}" for labels, value in func()]
+        return "\n".join(lines) + "\n"
+
+
+def clear_directory(directory):
+    # Removes the files of a previous server, so that its totals are not added to the new one's.
+    if directory and os.path.isdir(directory):
+        for filename in os.listdir(directory):
+            if filename.endswith((".bin", ".json", ".tmp")):
+                os.remove(os.path.join(directory, filename))
+
+
+class RequestTimer:
+    """
+    Timed spans of one request. Each span is recorded in a histogram with a "stage" label, and kept
+    for the request's Server-Timing header.
+
+    Parameters:
+        registry (Registry): Where the spans are recorded.
+        histogram (str): Name of the histogram.
+        labels (tuple): Other (name, value) labels of every span, e.g. the model version.
+    """
+
+    def __init__(self, registry, histogram, labels=()):
+        self.registry = registry
+        self.histogram = histogram
+        self.labels = tuple(labels)
+        self.start = time.perf_counter()
+        self.spans = []
+
+    def record(self, stage, seconds):
+        # Safe to call from the upstream threads, as list.append is atomic.
+        self.spans.append((stage, seconds))
+        self.registry.observe(self.histogram, (("stage", stage),) + self.labels, seconds)
+
+    def span(self, stage):
+        return _Span(self, stage)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        spans = self.spans + [("total", self.elapsed())]
+        return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in spans)
+
+
+class _Span:
+    def __init__(self, timer, stage):
+        self.timer = timer
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timer.record(self.stage, time.perf_counter() - self.start)
+        return False
@@ -0,0 +1,96 @@
+import gc
+import os
+import shutil
+import time
+from collections import namedtuple
+
+import joblib
+import pandas as pd
+
+import forest_engine
+
+
+# A model being served, with its version and what the model registry recorded about it.
+ServedModel = namedtuple("ServedModel", ["model", "version", "meta"])
+
+
+class SklearnModel:
+    """
+    A scikit-learn model that takes the float32 feature matrices the app builds (see solar_common/features.py),
+    passing them on as a DataFrame with the model's feature names.
+
+    Parameters:
+        model: A fitted model with feature_names_in_.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.feature_names_in_ = model.feature_names_in_
+
+    def predict(self, X):
+        return self.model.predict(pd.DataFrame(X, columns=self.feature_names_in_, copy=False))
+
+
+def load_model(model_path, freeze=True):
+    """
+    Loads a joblib model into private memory. Scikit-learn copies each tree's arrays when it is unpickled,
+    so its arrays cannot be memory-mapped; use load_compact_model for that.
+
+    Parameters:
+        model_path (str): Path of the joblib/pickle file.
+        freeze (bool): Whether to gc.freeze() everything loaded, for a model loaded before gunicorn forks.
+            Default is True.
+
+    Returns:
+        SklearnModel: The model, and the load time in seconds.
+    """
+    start = time.time()
+    model = SklearnModel(joblib.load(model_path))
+    # Moves everything loaded so far out of the garbage collector's reach, so that collections in forked
+    # gunicorn workers do not write to the object headers they share with the master process.
+    # A model loaded later by a worker is not frozen, so that it can be freed when it is replaced.
+    gc.collect()
+    if freeze:
+        gc.freeze()
+    return model, time.time() - start
+
+
+def memory_breakdown(process):
+    # Splits the resident memory into pages shared with other processes (e.g. other gunicorn workers
+    # forked after the model was loaded) and pages private to this process.
+    info = process.memory_full_info()
+    rss = info.rss / 1048576
+    private = info.uss / 1048576
+    return {
+        "rss_mib": round(rss, 2),
+        "private_mib": round(private, 2),
+        "shared_mib": round(rss - private, 2),
+        "pss_mib": round(getattr(info, "pss", 0) / 1048576, 2)
+    }
+
+
+def load_compact_model(model_path, mmap=True, freeze=True):
+    """
+    Loads the flattened array version of a random forest (see forest_engine), exporting it from the
+    joblib model first if it has not been exported yet.
+
+    Returns:
+        CompactForest: The model, and the load time in seconds.
+    """
+    start = time.time()
+    directory = forest_engine.forest_path(model_path)
+    if not os.path.isdir(directory):
+        print(f"Exporting {model_path} to {directory}...")
+        # Exported to a temporary directory and renamed, as other workers may be exporting the same model.
+        staging = f"{directory}.{os.getpid()}.tmp"
+        forest_engine.export_forest(joblib.load(model_path), staging)
+        try:
+            os.rename(staging, directory)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)  # another worker got there first
+        gc.collect()
+    model = forest_engine.load_forest(directory, mmap=mmap)
+    gc.collect()
+    if freeze:
+        gc.freeze()
+    return model, time.time() - start
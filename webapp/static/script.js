@@ -18,6 +18,20 @@ document.addEventListener("DOMContentLoaded", function () {
     attribution: "© OpenStreetMap contributors",
   }).addTo(map);
 
+  // Heatmaps of predicted efficiency, one per forecast day, chosen from the layers control
+  const heatmaps = {};
+  for (let day = 0; day < 7; day++) {
+    const date = new Date();
+    date.setDate(date.getDate() + day);
+    const label = day === 0 ? "Today" : date.toLocaleDateString("en-GB", { weekday: "short", day: "numeric", month: "short" });
+    heatmaps[`Predicted efficiency: ${label}`] = L.tileLayer(`/heatmap/${day}/{z}/{x}/{y}.png`, {
+      minZoom: 5,
+      maxZoom: 14,
+      opacity: 0.6
+    });
+  }
+  L.control.layers(null, heatmaps).addTo(map);
+
   // Marker to show clicked location
   let marker = null;
 
@@ -75,7 +89,10 @@ document.addEventListener("DOMContentLoaded", function () {
         body: JSON.stringify({ latitude: lat, longitude: lon, power_rating: power }),
       });
 
-      if (!response.ok) throw new Error("Prediction request failed.");
+      if (!response.ok) {
+        const error = await response.json().catch(() => ({}));
+        throw new Error(error.error || "Prediction request failed.");
+      }
       const data = await response.json();
       const hasEnergy = "output" in data.predictions[0];
       if (data.predictions) {
@@ -101,6 +118,7 @@ document.addEventListener("DOMContentLoaded", function () {
               `).join("")}
             </tbody>
           </table>
+          ${data.warnings ? `<p>Note: ${data.warnings.join(" ")}</p>` : ""}
         `;
       } else {
         resultDiv.textContent = "No predictions received.";